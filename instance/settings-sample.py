@@ -22,6 +22,109 @@ SQLALCHEMY_DATABASE_URI = 'sqlite:///test.db'
 #: Cache type
 CACHE_TYPE = 'redis'
 
+#: In-process cache of access tokens used by resource endpoints (default 10000 tokens, 60 seconds)
+TOKEN_CACHE_SIZE = 10000
+TOKEN_CACHE_TTL = 60
+
+#: Seconds for which /api/1/token/verify and /api/1/token/get_scope results are
+#: cached (in the cache above) and may be cached by resource servers (default 120).
+#: Results for a token that expires sooner are cached only until it expires
+TOKEN_VERIFY_CACHE_TTL = 120
+
+#: Maximum number of tokens accepted by /api/1/token/verify_many in one call (default 1000)
+TOKEN_VERIFY_MANY_LIMIT = 1000
+
+#: Access records below are held in each process and written at the end of the first request
+#: after their flush interval has passed, and when the process exits.
+#: Client credential "last used" timestamps are written in bulk every CLIENT_ACCESS_FLUSH_INTERVAL
+#: seconds (default 60) and only if the stored value is older than CLIENT_ACCESS_PRECISION
+#: seconds (default 60)
+CLIENT_ACCESS_FLUSH_INTERVAL = 60
+CLIENT_ACCESS_PRECISION = 60
+
+#: Browser session access is written in bulk every SESSION_ACCESS_FLUSH_INTERVAL seconds
+#: (default 60), and is not recorded at all if the session was last accessed less than
+#: SESSION_ACCESS_PRECISION seconds ago (default 300) from the same IP address and User-Agent
+SESSION_ACCESS_FLUSH_INTERVAL = 60
+SESSION_ACCESS_PRECISION = 300
+
+#: Sketches of daily active users for the dashboard are written every
+#: ACTIVE_USERS_FLUSH_INTERVAL seconds (default 60)
+ACTIVE_USERS_FLUSH_INTERVAL = 60
+
+#: User search backend for autocomplete: 'sql' (PostgreSQL only) or 'memory'.
+#: Defaults to 'sql' on PostgreSQL and 'memory' elsewhere
+# USER_SEARCH_BACKEND = 'sql'
+
+#: Autocomplete results are cached per process for up to AUTOCOMPLETE_CACHE_SIZE
+#: queries (default 10000) for AUTOCOMPLETE_CACHE_TTL seconds (default 300)
+AUTOCOMPLETE_CACHE_SIZE = 10000
+AUTOCOMPLETE_CACHE_TTL = 300
+
+#: Redis server for background jobs, and for the shared limit on password hashes below
+REDIS_URL = 'redis://localhost:6379/0'
+
+#: Bcrypt cost factor for password hashes (default 12). Hashes with another cost
+#: factor are rehashed when the user next logs in
+BCRYPT_ROUNDS = 12
+#: Maximum password hashes computed at once by each process (default: CPU cores on
+#: the host), and seconds a request waits for one before giving up (default 2)
+BCRYPT_CONCURRENCY = None
+BCRYPT_TIMEOUT = 2
+#: Share BCRYPT_CONCURRENCY among all processes using the Redis server at REDIS_URL
+#: (default False), so set it to the cores on all hosts. Each process falls back to
+#: its own limit while Redis is down. Seconds after which a slot held by a process
+#: that died is reclaimed (default 60)
+BCRYPT_SHARED_LIMIT = False
+BCRYPT_LEASE = 60
+
+#: The dashboard's users by client report reads a rollup of client activity that
+#: `python manage.py update_client_activity` refreshes. Run it from cron at least
+#: hourly, or the report's last hour column will be out of date
+#: Expired records are deleted by `python manage.py purge_expired`, to be run from cron,
+#: JANITOR_BATCH_SIZE rows at a time (default 1000). JANITOR_RETENTION is the number of
+#: days to keep records after they expire, by table name. See lastuser_core.janitor.Janitor
+JANITOR_BATCH_SIZE = 1000
+JANITOR_RETENTION = {
+    'authcode': 1,
+    'authtoken': 1,
+    'user_session': 30,
+    'passwordresetrequest': 1,
+    'userflashmessage': 7,
+    }
+
+#: On PostgreSQL, user_session and session_client are partitioned by ranges of session
+#: id. Sessions stay in a default partition unless SESSION_PARTITION_SIZE is set (default
+#: None). purge_expired then creates partitions of that many sessions ahead of use, about
+#: a month of logins, and drops each whole once every session in it has ended
+# SESSION_PARTITION_SIZE = 1000000
+
+#: Notices to client apps are saved to an outbox with the change they are about, and
+#: relayed to the delivery queue by `python manage.py relay_notices` every NOTIFY_DEBOUNCE
+#: seconds (default 5), merged into one notice per client and user, org or team, at most
+#: NOTIFY_RELAY_BATCH notices at a time (default 1000)
+NOTIFY_DEBOUNCE = 5
+NOTIFY_RELAY_BATCH = 1000
+
+#: Notice delivery: at most NOTIFY_CONCURRENCY deliveries at once per worker (default 10)
+#: and NOTIFY_PER_HOST to one host (default 2), waiting NOTIFY_TIMEOUT seconds for a
+#: response (default 10). Failures are retried NOTIFY_RETRIES times (default 3), first
+#: after NOTIFY_BACKOFF seconds (default 1) and doubling. A host that fails
+#: NOTIFY_FAILURE_THRESHOLD times in a row (default 5) is skipped for NOTIFY_RESET_AFTER
+#: seconds (default 60)
+NOTIFY_CONCURRENCY = 10
+NOTIFY_PER_HOST = 2
+NOTIFY_TIMEOUT = 10
+NOTIFY_RETRIES = 3
+NOTIFY_BACKOFF = 1
+NOTIFY_FAILURE_THRESHOLD = 5
+NOTIFY_RESET_AFTER = 60
+
+#: When an organization's domain changes, users with email addresses at that domain
+#: are added to its members team as the change is saved, unless there are more than
+#: DOMAIN_MEMBERS_JOB_THRESHOLD of them (default 1000): then a background job adds them
+DOMAIN_MEMBERS_JOB_THRESHOLD = 1000
+
 #: Secret key
 SECRET_KEY = 'make this something random'
 
@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+
+"""
+Webhook delivery
+"""
+
+import time
+import threading
+from multiprocessing.pool import ThreadPool
+from urlparse import urlsplit
+import requests
+from requests.adapters import HTTPAdapter
+
+__all__ = ['DeliveryError', 'CircuitOpen', 'WebhookDelivery']
+
+
+class DeliveryError(Exception):
+    """
+    A notice could not be delivered after all retries.
+    """
+    pass
+
+
+class CircuitOpen(DeliveryError):
+    """
+    A notice was not attempted because its host has been failing.
+    """
+    pass
+
+
+class HostCircuit(object):
+    """
+    Circuit breaker for one host. Opens after ``threshold`` consecutive failures,
+    rejecting deliveries for ``reset_after`` seconds, then lets one delivery through
+    to test the host again.
+    """
+    def __init__(self, threshold, reset_after):
+        self.threshold = threshold
+        self.reset_after = reset_after
+        self.failures = 0
+        self.opened_at = None
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            if time.time() - self.opened_at >= self.reset_after:
+                # Half-open: let this delivery through, and re-open at once if it fails
+                self.opened_at = None
+                self.failures = self.threshold - 1
+                return True
+            return False
+
+    def succeeded(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+
+    def failed(self):
+        with self._lock:
+            self.failures += 1
+            if self.failures >= self.threshold:
+                self.opened_at = time.time()
+
+
+class WebhookDelivery(object):
+    """
+    Delivers HTTP notices to client apps. Each host gets a keep-alive session of its
+    own and at most ``per_host`` concurrent deliveries; :meth:`deliver_many` runs up
+    to ``concurrency`` deliveries at once. Failed deliveries (connection errors,
+    timeouts and 5xx responses) are retried ``retries`` times with exponential
+    backoff, and a host that fails ``failure_threshold`` deliveries in a row is not
+    contacted again for ``reset_after`` seconds.
+
+    Counters are available from :meth:`stats`. All state is per process.
+
+    :param int concurrency: Maximum concurrent deliveries
+    :param int per_host: Maximum concurrent deliveries to one host
+    :param float timeout: Seconds to wait for a host to respond
+    :param int retries: Retries after the first attempt
+    :param float backoff: Seconds before the first retry, doubling for each retry after
+    :param int failure_threshold: Consecutive failures that open a host's circuit
+    :param float reset_after: Seconds a host's circuit stays open
+    """
+    def __init__(self, concurrency=10, per_host=2, timeout=10, retries=3, backoff=1,
+            failure_threshold=5, reset_after=60):
+        self.concurrency = concurrency
+        self.per_host = per_host
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.failure_threshold = failure_threshold
+        self.reset_after = reset_after
+        self._lock = threading.Lock()
+        self._hosts = {}
+        self._pool = None
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.counters = {'delivered': 0, 'failed': 0, 'retried': 0, 'rejected': 0}
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+
+    def stats(self):
+        """
+        Return delivery counters and latency (of successful deliveries, in seconds).
+        """
+        with self._lock:
+            stats = dict(self.counters)
+            stats['latency_avg'] = self.latency_total / stats['delivered'] if stats['delivered'] else 0.0
+            stats['latency_max'] = self.latency_max
+        return stats
+
+    def _count(self, counter, latency=None):
+        with self._lock:
+            self.counters[counter] += 1
+            if latency is not None:
+                self.latency_total += latency
+                self.latency_max = max(self.latency_max, latency)
+
+    def _host(self, url):
+        host = urlsplit(url).netloc
+        with self._lock:
+            if host not in self._hosts:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.per_host)
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                self._hosts[host] = (session, threading.BoundedSemaphore(self.per_host),
+                    HostCircuit(self.failure_threshold, self.reset_after))
+            return self._hosts[host]
+
+    def deliver(self, url, params=None, data=None, method='POST'):
+        """
+        Deliver one notice. Returns the response, or raises :exc:`CircuitOpen` or
+        :exc:`DeliveryError`.
+        """
+        session, slots, circuit = self._host(url)
+        if not circuit.allow():
+            self._count('rejected')
+            raise CircuitOpen(url)
+        attempt = 0
+        while True:
+            error = None
+            with slots:
+                started = time.time()
+                try:
+                    response = session.request(method, url, params=params, data=data, timeout=self.timeout)
+                    if response.status_code >= 500:
+                        error = DeliveryError("%s returned %d" % (url, response.status_code))
+                except requests.RequestException as e:
+                    error = DeliveryError("%s: %s" % (url, e))
+                latency = time.time() - started
+            if error is None:
+                circuit.succeeded()
+                self._count('delivered', latency)
+                return response
+            circuit.failed()
+            if attempt >= self.retries or not circuit.allow():
+                self._count('failed')
+                raise error
+            self._count('retried')
+            time.sleep(self.backoff * (2 ** attempt))
+            attempt += 1
+
+    def deliver_many(self, notices):
+        """
+        Deliver notices concurrently. ``notices`` is a list of dicts with keyword
+        arguments for :meth:`deliver`. Returns a list with a response or the
+        exception raised for each notice, in order.
+        """
+        def deliver(notice):
+            try:
+                return self.deliver(**notice)
+            except DeliveryError as e:
+                return e
+
+        with self._lock:
+            if self._pool is None:
+                self._pool = ThreadPool(self.concurrency)
+            pool = self._pool
+        return pool.map(deliver, notices)
@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+
+"""
+Removal of expired records
+"""
+
+import re
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from .models import db, AuthCode, AuthToken, UserSession, PasswordResetRequest, UserFlashMessage
+from .models.session import session_client
+
+
+#: Range partition bound, as described by pg_get_expr
+partition_bound_re = re.compile(r"^FOR VALUES FROM \((\d+)\) TO \((\d+)\)$")
+
+
+class Janitor(object):
+    """
+    Deletes records that are no longer of use, in batches of ``batch_size`` rows
+    with a commit after each batch, so that no transaction holds many locks for
+    long. Each category is selected with an indexed column. Records are kept for
+    ``retention`` days after they stop being of use, keyed on table name:
+
+    * ``authcode``: Authorization codes, used or not, after their three minute validity
+    * ``authtoken``: Access tokens after they expire
+    * ``user_session``: User sessions after they are revoked, or after a year of disuse
+      when they can no longer be resumed. Their access tokens and codes are deleted too
+    * ``passwordresetrequest``: Password reset requests after their 24 hour validity.
+      Requests that were used are already deleted
+    * ``userflashmessage``: Messages saved for trusted clients that were never collected
+
+    On PostgreSQL, user_session and session_client are partitioned (see
+    :func:`~lastuser_core.models.session.partition_session_tables`). If
+    ``partition_size`` is set, range partitions of that many sessions are created
+    ahead of use, and dropped whole once every session in them has ended, with
+    their codes and tokens. Sessions in the default partition are deleted in batches.
+
+    :param int batch_size: Rows to delete in each transaction
+    :param int partition_size: Sessions in each range partition (default None, for none)
+    :param int partitions_ahead: Number of empty range partitions to keep ready
+    """
+    def __init__(self, batch_size=1000, partition_size=None, partitions_ahead=2):
+        self.batch_size = batch_size
+        self.partition_size = partition_size
+        self.partitions_ahead = partitions_ahead
+        self.retention = {
+            'authcode': 1,
+            'authtoken': 1,
+            'user_session': 30,
+            'passwordresetrequest': 1,
+            'userflashmessage': 7,
+            }
+
+    def cutoff(self, name, now):
+        return now - timedelta(days=self.retention[name])
+
+    def purge_rows(self, table, condition, dependents=()):
+        """
+        Delete rows in table matching condition, a batch at a time, deleting rows in
+        dependent tables that refer to them first. Returns the number of rows deleted.
+
+        :param dependents: List of (table, column) referring to table's id
+        """
+        count = 0
+        while True:
+            ids = [row[0] for row in db.session.execute(
+                db.select([table.c.id]).where(condition).limit(self.batch_size))]
+            if not ids:
+                break
+            for dependent, column in dependents:
+                db.session.execute(dependent.delete().where(column.in_(ids)))
+            db.session.execute(table.delete().where(table.c.id.in_(ids)))
+            db.session.commit()
+            count += len(ids)
+            if len(ids) < self.batch_size:
+                break
+        return count
+
+    def purge(self, now=None):
+        """
+        Delete expired records in all categories. Returns a dict of table name to
+        the number of rows deleted.
+        """
+        now = now or datetime.utcnow()
+        counts = OrderedDict()
+
+        table = AuthCode.__table__
+        counts['authcode'] = self.purge_rows(table,
+            table.c.created_at < self.cutoff('authcode', now) - timedelta(minutes=3))
+
+        table = AuthToken.__table__
+        counts['authtoken'] = self.purge_rows(table, table.c.expires_at < self.cutoff('authtoken', now))
+
+        cutoff = self.cutoff('user_session', now)
+        partitions = self.session_partitions()
+        if partitions is None:
+            table = UserSession.__table__
+            counts['user_session'] = 0
+        else:
+            table = db.table('user_session_default', db.column('id'), db.column('revoked_at'), db.column('accessed_at'))
+            counts['user_session'] = self.purge_partitions(partitions, cutoff)
+            if self.partition_size:
+                self.create_partitions(partitions)
+        counts['user_session'] += self.purge_rows(table,
+            db.or_(table.c.revoked_at < cutoff, table.c.accessed_at < cutoff - timedelta(days=365)),
+            dependents=[
+                (session_client, session_client.c.user_session_id),
+                (AuthCode.__table__, AuthCode.__table__.c.session_id),
+                (AuthToken.__table__, AuthToken.__table__.c.user_session_id)])
+
+        table = PasswordResetRequest.__table__
+        counts['passwordresetrequest'] = self.purge_rows(table,
+            table.c.created_at < self.cutoff('passwordresetrequest', now) - timedelta(days=1))
+
+        table = UserFlashMessage.__table__
+        counts['userflashmessage'] = self.purge_rows(table,
+            table.c.created_at < self.cutoff('userflashmessage', now))
+
+        return counts
+
+    def session_partitions(self):
+        """
+        Return a list of (name, lower, upper) for each range partition of user_session
+        in order, or None if the table isn't partitioned.
+        """
+        if db.engine.dialect.name != 'postgresql' or not db.session.execute(db.text(
+                "SELECT count(*) FROM pg_partitioned_table WHERE partrelid = to_regclass('user_session')")).scalar():
+            return None
+        partitions = []
+        for name, bound in db.session.execute(db.text(
+                "SELECT c.relname, pg_get_expr(c.relpartbound, c.oid) FROM pg_inherits i "
+                "JOIN pg_class c ON c.oid = i.inhrelid WHERE i.inhparent = to_regclass('user_session')")):
+            match = partition_bound_re.match(bound)
+            if match:  # Not the default partition
+                lower, upper = match.groups()
+                partitions.append((name, int(lower), int(upper)))
+        return sorted(partitions, key=lambda partition: partition[2])
+
+    def last_session_id(self):
+        return db.session.execute(db.text(
+            "SELECT last_value FROM user_session_id_seq")).scalar()
+
+    def purge_partitions(self, partitions, cutoff):
+        """
+        Drop the oldest session partitions, and the matching session_client partitions,
+        while every session in them ended before the cutoff. Returns the number of
+        sessions removed. A partition that may still receive sessions is never dropped.
+        """
+        count = 0
+        last_id = self.last_session_id()
+        for name, lower, upper in partitions:
+            if upper > last_id:
+                break
+            partition = db.table(name, db.column('revoked_at'), db.column('accessed_at'))
+            if db.session.execute(db.select([db.exists().where(db.and_(
+                    db.or_(partition.c.revoked_at == None, partition.c.revoked_at >= cutoff),  # NOQA
+                    partition.c.accessed_at >= cutoff - timedelta(days=365)))])).scalar():
+                break
+            # Rows referring to the sessions must go first, or the partition can't be detached
+            for column in (AuthCode.__table__.c.session_id, AuthToken.__table__.c.user_session_id,
+                    db.table('user_session_buid', db.column('user_session_id')).c.user_session_id):
+                db.session.execute(column.table.delete().where(db.and_(column >= lower, column < upper)))
+            count += db.session.execute(db.select([db.func.count()]).select_from(partition)).scalar()
+            client_partition = 'session_client' + name[len('user_session'):]
+            for parent, child in (('session_client', client_partition), ('user_session', name)):
+                db.session.execute(db.text('ALTER TABLE {0} DETACH PARTITION {1}'.format(parent, child)))
+                db.session.execute(db.text('DROP TABLE {0}'.format(child)))
+            db.session.commit()
+        return count
+
+    def create_partitions(self, partitions):
+        """
+        Create session and session_client partitions of ``partition_size`` sessions,
+        following the last one, so that at least ``partitions_ahead`` are ready.
+        """
+        def next_lower():
+            lower = partitions[-1][2] if partitions else self.last_session_id() + 1
+            # Sessions beyond the last partition are in the default partition, and stay there
+            overflow = db.session.execute(db.text(
+                "SELECT max(id) FROM user_session_default WHERE id >= :lower"), {'lower': lower}).scalar()
+            return lower if overflow is None else overflow + 1
+
+        if next_lower() >= self.last_session_id() + self.partition_size * self.partitions_ahead:
+            return
+        # New sessions wait while partitions are added, so none land in the range of a new one
+        db.session.execute(db.text('LOCK TABLE user_session, session_client IN SHARE ROW EXCLUSIVE MODE'))
+        lower = next_lower()
+        while lower < self.last_session_id() + self.partition_size * self.partitions_ahead:
+            for table in ('user_session', 'session_client'):
+                db.session.execute(db.text(
+                    'CREATE TABLE {table}_p{lower} PARTITION OF {table} FOR VALUES FROM ({lower}) TO ({upper})'.format(
+                        table=table, lower=lower, upper=lower + self.partition_size)))
+            lower += self.partition_size
+        db.session.commit()
+
+
+#: Janitor used by the ``purge_expired`` job and command. Configured in :meth:`LastuserOAuthBlueprint.init_app`
+janitor = Janitor()
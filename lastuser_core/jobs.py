@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+
+"""
+Background jobs, run by the RQ worker in rq.sh
+"""
+
+from flask import current_app
+from flask_rq import job
+from .models import db, Team
+from .models.session import update_client_user_activity
+from .janitor import janitor
+
+
+@job('lastuser')
+def add_domain_members(team_id):
+    """
+    Add users with an email address at the team's domain to the team. Queued when
+    an organization's domain changes and too many users match to add them while
+    the request waits.
+    """
+    try:
+        team = Team.query.get(team_id)
+        if team is not None and team.domain:
+            team.add_domain_members()
+            db.session.commit()
+    finally:
+        db.session.remove()
+
+
+@job('lastuser')
+def update_client_activity():
+    """
+    Roll up recent client activity for the dashboard. Run on a schedule, with
+    ``python manage.py update_client_activity`` from cron or by queueing this job.
+    """
+    try:
+        update_client_user_activity()
+        db.session.commit()
+    finally:
+        db.session.remove()
+
+
+@job('lastuser')
+def purge_expired():
+    """
+    Delete expired records. Run on a schedule, with ``python manage.py purge_expired``
+    from cron or by queueing this job. Returns a dict of table name to rows deleted.
+    """
+    try:
+        counts = janitor.purge()
+        current_app.logger.info("Purged expired records: %s", ', '.join(
+            '%s %d' % (name, count) for name, count in counts.items()))
+        return counts
+    finally:
+        db.session.remove()
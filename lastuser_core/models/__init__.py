@@ -2,12 +2,14 @@
 
 from coaster.sqlalchemy import TimestampMixin, BaseMixin, BaseScopedNameMixin  # Imported from here by other models  # NOQA
 from coaster.db import db
+from sqlalchemy.orm import joinedload, subqueryload
 
 
 from .user import *          # NOQA
 from .session import *       # NOQA
 from .client import *        # NOQA
 from .notification import *  # NOQA
+from .user import merge_user_rows
 
 
 def getuser(name):
@@ -33,13 +35,151 @@ def getuser(name):
         return User.get(username=name)
 
 
+def getusers(names):
+    """
+    Bulk version of :func:`getuser`. Returns a list of users (or None where not
+    found) in the same order as the given names, with the same precedence rules,
+    using a fixed number of queries however many names are given. The users'
+    old ids are loaded along with them.
+    """
+    handles = set()
+    emails = set()
+    usernames = set()
+    for name in names:
+        if '@' in name:
+            if name.startswith('@'):
+                handles.add(name[1:])
+            else:
+                emails.update([name, name.lower()])
+        else:
+            usernames.add(name)
+
+    # Twitter handles. See the TODO in getuser
+    by_handle = {}
+    if handles:
+        for extid in UserExternalId.query.filter(UserExternalId.service == 'twitter',
+                UserExternalId.username.in_(handles)).options(joinedload(UserExternalId.user).subqueryload(User.oldids)):
+            by_handle[extid.username] = extid.user
+
+    # Verified email addresses first, then unverified claims ordered by user id
+    by_email = {}
+    claims_by_email = {}
+    if emails:
+        for useremail in UserEmail.query.filter(UserEmail.email.in_(emails)).options(
+                joinedload(UserEmail.user).subqueryload(User.oldids)):
+            by_email[useremail.email] = useremail.user
+        for claim in UserEmailClaim.query.filter(UserEmailClaim.email.in_(emails)).order_by(
+                UserEmailClaim.user_id).options(joinedload(UserEmailClaim.user).subqueryload(User.oldids)):
+            claims_by_email.setdefault(claim.email, []).append(claim)
+
+    # Usernames, following merged accounts as in User.get
+    by_username = {}
+    if usernames:
+        found = User.query.filter(User.username.in_(usernames)).options(subqueryload(User.oldids)).all()
+        merged = [user.userid for user in found if user.status == USER_STATUS.MERGED]
+        if merged:
+            redirects = dict((oldid.userid, oldid.user) for oldid in UserOldId.query.filter(
+                UserOldId.userid.in_(merged)).options(joinedload(UserOldId.user).subqueryload(User.oldids)))
+        for user in found:
+            if user.status == USER_STATUS.MERGED:
+                by_username[user.username] = redirects.get(user.userid)
+            else:
+                by_username[user.username] = user
+
+    results = []
+    for name in names:
+        user = None
+        if '@' in name:
+            if name.startswith('@'):
+                user = by_handle.get(name[1:])
+            else:
+                user = by_email.get(name) or by_email.get(name.lower())
+                if user is None or not user.is_active:
+                    claims = claims_by_email.get(name, [])
+                    if name.lower() != name:
+                        claims = sorted(claims + claims_by_email.get(name.lower(), []), key=lambda c: c.user_id)
+                    user = claims[0].user if claims else None
+        else:
+            user = by_username.get(name)
+        results.append(user if user is not None and user.is_active else None)
+    return results
+
+
 def getextid(service, userid):
     return UserExternalId.get(service=service, userid=userid)
 
 
-def merge_users(user1, user2):
+class UserMerge(object):
+    """
+    Merges user accounts. The plan of what to do for each model is built once, on
+    first use: models with a ``migrate_user`` classmethod handle their own rows, and
+    rows in other models with a ``user_id`` column are moved with
+    :func:`merge_user_rows`, a bulk UPDATE. Either way
+    the statements executed don't depend on the number of rows.
+    """
+    def __init__(self):
+        self._plan = None
+        self._tables = None
+
+    def build(self):
+        """
+        Build the plan from the models and tables in the metadata.
+        """
+        plan = []
+        for model in db.Model.__subclasses__():
+            if model is User:
+                continue
+            if hasattr(model, 'migrate_user'):
+                plan.append((model, None))
+            elif 'user_id' in model.__table__.c:
+                plan.append((None, model.__table__))
+        # organization_membership is derived from team_membership and is refreshed by Team.migrate_user
+        tables = [table for table in db.Model.metadata.sorted_tables
+            if 'user_id' in table.c and table.name != 'organization_membership']
+        # Tables without a model, other than team_membership which Team.migrate_user handles
+        model_tables = set(model.__table__ for model in db.Model.__subclasses__())
+        for table in tables:
+            if table not in model_tables and table.name != 'team_membership':
+                plan.append((None, table))
+        self._plan, self._tables = plan, tables
+        return plan, tables
+
+    def counts(self, user):
+        """
+        Return a dict of table name to the number of the user's rows in that table,
+        for rows that a merge would move, with one query.
+        """
+        tables = self._tables if self._tables is not None else self.build()[1]
+        query = db.union_all(*[db.select([db.literal(table.name).label('name'), db.func.count().label('count')]).where(
+            table.c.user_id == user.id) for table in tables])
+        return dict((name, count) for name, count in db.session.execute(query) if count)
+
+    def merge(self, keep_user, merge_user):
+        """
+        Move all of merge_user's rows to keep_user, in the current transaction.
+        """
+        plan = self._plan if self._plan is not None else self.build()[0]
+        db.session.flush()
+        connection = db.session.connection()
+        keep_user_id, merge_user_id = keep_user.id, merge_user.id
+        for model, table in plan:
+            if model is not None:
+                model.migrate_user(olduser=merge_user, newuser=keep_user)
+            else:
+                merge_user_rows(connection, table, merge_user_id, keep_user_id)
+        db.session.expire_all()
+
+
+#: Merge engine used by :func:`merge_users`
+user_merge = UserMerge()
+
+
+def merge_users(user1, user2, dry_run=False):
     """
     Merge two user accounts and return the new user account.
+
+    If ``dry_run`` is True, nothing is changed. Instead, returns a dict of table name
+    to the number of rows that would be moved to the new user account.
     """
     # Always keep the older account and merge from the newer account
     if user1.created_at < user2.created_at:
@@ -47,16 +187,11 @@ def merge_users(user1, user2):
     else:
         keep_user, merge_user = user2, user1
 
-    # 1. Inspect all tables for foreign key references to merge_user and switch to keep_user.
-    for model in db.Model.__subclasses__():
-        if model != User:
-            # a. This is a model and it's not the User model. Does it have a migrate_user classmethod?
-            if hasattr(model, 'migrate_user'):
-                model.migrate_user(olduser=merge_user, newuser=keep_user)
-            # b. No migrate_user? Does it have a user_id column?
-            elif hasattr(model, 'user_id') and hasattr(model, 'query'):
-                for row in model.query.filter_by(user_id=merge_user.id).all():
-                    row.user_id = keep_user.id
+    if dry_run:
+        return user_merge.counts(merge_user)
+
+    # 1. Move all rows that refer to merge_user to keep_user.
+    user_merge.merge(keep_user, merge_user)
     # 2. Add merge_user's userid to olduserids. Commit session.
     db.session.add(UserOldId(user=keep_user, userid=merge_user.userid, uuid=merge_user.uuid))
     # 3. Mark merge_user as merged. Commit session.
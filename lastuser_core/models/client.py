@@ -3,6 +3,7 @@
 from datetime import datetime, timedelta
 import urlparse
 from hashlib import sha256
+from sqlalchemy import event
 from sqlalchemy.ext.declarative import declared_attr
 from sqlalchemy.orm import load_only
 from sqlalchemy.orm.query import Query as QueryBaseClass
@@ -11,7 +12,7 @@ from coaster.utils import buid, newsecret
 from baseframe import _
 
 from . import db, BaseMixin, BaseScopedNameMixin
-from .user import User, Organization, Team
+from .user import User, Organization, Team, migrate_user_rows
 from .session import UserSession
 
 __all__ = ['Client', 'UserFlashMessage', 'Resource', 'ResourceAction', 'AuthCode', 'AuthToken',
@@ -46,6 +47,14 @@ class ScopeMixin(object):
             additional = [additional]
         self.scope = list(set(self.scope).union(set(additional)))
 
+    @classmethod
+    def scope_includes(cls, *tokens):
+        """
+        SQL clause matching rows whose scope includes any of the given tokens.
+        """
+        scope = db.literal(u' ') + cls._scope + db.literal(u' ')
+        return db.or_(*[scope.like(u'% ' + token + u' %') for token in tokens])
+
 
 class Client(ScopeMixin, BaseMixin, db.Model):
     """OAuth client applications"""
@@ -73,6 +82,8 @@ class Client(ScopeMixin, BaseMixin, db.Model):
     redirect_uri = db.Column(db.Unicode(250), nullable=True, default=u'')
     #: Back-end notification URI
     notification_uri = db.Column(db.Unicode(250), nullable=True, default=u'')
+    #: Accepts notices about multiple users at once (as a list of userids)?
+    notify_multiple_users = db.Column(db.Boolean, nullable=False, default=False)
     #: Front-end notification URI
     iframe_uri = db.Column(db.Unicode(250), nullable=True, default=u'')
     #: Active flag
@@ -118,7 +129,7 @@ class Client(ScopeMixin, BaseMixin, db.Model):
     def owner_is(self, user):
         if not user:
             return False
-        return self.user == user or (self.org and self.org in user.organizations_owned())
+        return self.user == user or (self.org_id is not None and self.org_id in user.organizations_owned_ids())
 
     def orgs_with_team_access(self):
         """
@@ -226,6 +237,8 @@ class UserFlashMessage(BaseMixin, db.Model):
     category = db.Column(db.Unicode(20), nullable=False)
     message = db.Column(db.Unicode(250), nullable=False)
 
+    __table_args__ = (db.Index('ix_userflashmessage_created_at', 'created_at'),)
+
 
 class Resource(BaseScopedNameMixin, db.Model):
     """
@@ -325,6 +338,8 @@ class AuthCode(ScopeMixin, BaseMixin, db.Model):
     redirect_uri = db.Column(db.Unicode(1024), nullable=False)
     used = db.Column(db.Boolean, default=False, nullable=False)
 
+    __table_args__ = (db.Index('ix_authcode_created_at', 'created_at'),)
+
     def is_valid(self):
         # Time limit: 3 minutes. Should be reasonable enough to load a page
         # on a slow mobile connection, without keeping the code valid too long
@@ -355,6 +370,8 @@ class AuthToken(ScopeMixin, BaseMixin, db.Model):
     _algorithm = db.Column('algorithm', db.String(20), nullable=True)
     #: Token's validity, 0 = unlimited
     validity = db.Column(db.Integer, nullable=False, default=0)  # Validity period in seconds
+    #: When the token expires, set from validity when saved. Null for unlimited validity
+    expires_at = db.Column(db.DateTime, nullable=True, index=True)
     #: Refresh token, to obtain a new token
     refresh_token = db.Column(db.String(22), nullable=True, unique=True)
 
@@ -420,28 +437,24 @@ class AuthToken(ScopeMixin, BaseMixin, db.Model):
             return False
         return True
 
+    @classmethod
+    def valid_clause(cls, now=None):
+        """
+        SQL clause matching tokens that :meth:`is_valid` would accept.
+        """
+        return db.or_(cls.expires_at == None, cls.expires_at >= (now or datetime.utcnow()))  # NOQA
+
     @classmethod
     def migrate_user(cls, olduser, newuser):
         if not olduser or not newuser:
             return  # Don't mess with client-only tokens
-        oldtokens = cls.query.filter_by(user=olduser).all()
-        newtokens = {}  # Client: token mapping
-        for token in cls.query.filter_by(user=newuser).all():
-            newtokens.setdefault(token.client_id, []).append(token)
-
-        for token in oldtokens:
-            merge_performed = False
-            if token.client_id in newtokens:
-                for newtoken in newtokens[token.client_id]:
-                    if newtoken.user == newuser:
-                        # There's another token for  newuser with the same client.
-                        # Just extend the scope there
-                        newtoken.scope = set(newtoken.scope) | set(token.scope)
-                        db.session.delete(token)
-                        merge_performed = True
-                        break
-            if merge_performed is False:
-                token.user = newuser  # Reassign this token to newuser
+        from ..signals import model_authtokens_migrated  # Imports models, so import here
+        # Tokens of both users are moved, merged or deleted below without passing through the ORM
+        tokens = [token for token, in db.session.query(cls.token).filter(
+            cls.user_id.in_([olduser.id, newuser.id]))]
+        # Where both users have a token for the same client, extend the scope of newuser's token
+        migrate_user_rows(cls.__table__, olduser, newuser, merge_column='scope')
+        model_authtokens_migrated.send(olduser, newuser=newuser, tokens=tokens)
 
     @classmethod
     def get(cls, token):
@@ -473,6 +486,17 @@ class AuthToken(ScopeMixin, BaseMixin, db.Model):
         return []
 
 
+@event.listens_for(AuthToken, 'before_insert')
+@event.listens_for(AuthToken, 'before_update')
+def _set_authtoken_expiry(mapper, connection, target):
+    if target.validity:
+        # New tokens don't have created_at until the INSERT, a moment from now
+        created_at = target.created_at if isinstance(target.created_at, datetime) else datetime.utcnow()
+        target.expires_at = created_at + timedelta(seconds=target.validity)
+    else:
+        target.expires_at = None
+
+
 class Permission(BaseMixin, db.Model):
     __tablename__ = 'permission'
     #: User who created this permission
@@ -497,7 +521,8 @@ class Permission(BaseMixin, db.Model):
         name='permission_user_id_or_org_id'),)  # NOQA
 
     def owner_is(self, user):
-        return user is not None and self.user == user or (self.org and self.org in user.organizations_owned())
+        return user is not None and (
+            self.user == user or (self.org_id is not None and self.org_id in user.organizations_owned_ids()))
 
     @property
     def owner(self):
@@ -563,20 +588,8 @@ class UserClientPermissions(BaseMixin, db.Model):
 
     @classmethod
     def migrate_user(cls, olduser, newuser):
-        for operm in olduser.client_permissions:
-            merge_performed = False
-            for nperm in newuser.client_permissions:
-                if nperm.client == operm.client:
-                    # Merge permission strings
-                    tokens = set(operm.access_permissions.split(' '))
-                    tokens.update(set(nperm.access_permissions.split(' ')))
-                    if u' ' in tokens:
-                        tokens.remove(u' ')
-                    nperm.access_permissions = u' '.join(sorted(tokens))
-                    db.session.delete(operm)
-                    merge_performed = True
-            if not merge_performed:
-                operm.user = newuser
+        # Where both users have permissions on the same client, merge the permission strings
+        migrate_user_rows(cls.__table__, olduser, newuser, merge_column='permissions')
 
 
 # This model's name is in plural because it defines multiple permissions within each instance
@@ -2,13 +2,14 @@
 
 from sqlalchemy.ext.declarative import declared_attr
 from coaster.utils import LabeledEnum
+from coaster.sqlalchemy import JsonDict
 from baseframe import __
 from ..registry import OrderedDict
 from . import db, BaseMixin, BaseScopedNameMixin
 from .user import User, UserEmail, UserPhone
 from .client import Client
 
-__all__ = ['SMSMessage', 'SMS_STATUS']
+__all__ = ['SMSMessage', 'SMS_STATUS', 'ClientNotice']
 
 
 # --- Flags -------------------------------------------------------------------
@@ -117,6 +118,20 @@ class SMSMessage(BaseMixin, db.Model):
     fail_reason = db.Column(db.Unicode(25), nullable=True)
 
 
+class ClientNotice(BaseMixin, db.Model):
+    """
+    Outbox of notices to client apps. Notices are added in the same transaction
+    as the change they are about, and are relayed to the delivery queue after
+    commit, so that no notice is sent for a change that was rolled back.
+    """
+    __tablename__ = 'client_notice'
+    #: Client app to notify
+    client_id = db.Column(None, db.ForeignKey('client.id', ondelete='CASCADE'), nullable=False, index=True)
+    client = db.relationship(Client)
+    #: The notice
+    data = db.Column(JsonDict, nullable=False)
+
+
 # class ChannelMixin(object):
 #     @declared_attr
 #     def _channels(self):
@@ -4,13 +4,16 @@ from datetime import datetime, timedelta
 from werkzeug import cached_property
 from ua_parser import user_agent_parser
 from flask import request
+from sqlalchemy import event
+from sqlalchemy.dialects import postgresql
 from coaster.utils import buid as make_buid
 from coaster.sqlalchemy import make_timestamp_columns
 from . import db, BaseMixin
 from .user import User
-from ..signals import session_revoked
+from ..signals import session_revoked, session_accessed
+from ..sketch import HyperLogLog
 
-__all__ = ['UserSession']
+__all__ = ['UserSession', 'ActiveUserSketch']
 
 
 session_client = db.Table(
@@ -21,6 +24,28 @@ session_client = db.Table(
     )
 
 
+def upsert_session_client(user_session_id, client_id):
+    """
+    Return a single statement that records the given client's use of the given
+    session, inserting a new row or updating the timestamp on an existing row.
+    Concurrent calls for the same session and client are safe.
+    """
+    if db.engine.dialect.name == 'postgresql':
+        statement = postgresql.insert(session_client).values(
+            user_session_id=user_session_id, client_id=client_id)
+        return statement.on_conflict_do_update(
+            index_elements=[session_client.c.user_session_id, session_client.c.client_id],
+            set_={'updated_at': db.func.utcnow()})
+    else:
+        # SQLite 3.24+ has the same syntax, but SQLAlchemy < 1.4 can't compile it for SQLite
+        now = datetime.utcnow()
+        return db.text('INSERT INTO session_client (created_at, updated_at, user_session_id, client_id) '
+            'VALUES (:now, :now, :user_session_id, :client_id) '
+            'ON CONFLICT (user_session_id, client_id) DO UPDATE SET updated_at = excluded.updated_at'
+            ).bindparams(db.bindparam('now', now, type_=db.DateTime),
+                user_session_id=user_session_id, client_id=client_id)
+
+
 class UserSession(BaseMixin, db.Model):
     __tablename__ = 'user_session'
 
@@ -33,8 +58,8 @@ class UserSession(BaseMixin, db.Model):
     ipaddr = db.Column(db.String(45), nullable=False)
     user_agent = db.Column(db.Unicode(250), nullable=False)
 
-    accessed_at = db.Column(db.DateTime, nullable=False)
-    revoked_at = db.Column(db.DateTime, nullable=True)
+    accessed_at = db.Column(db.DateTime, nullable=False, index=True)
+    revoked_at = db.Column(db.DateTime, nullable=True, index=True)
     sudo_enabled_at = db.Column(db.DateTime, nullable=False, default=db.func.utcnow())
 
     def __init__(self, **kwargs):
@@ -52,19 +77,13 @@ class UserSession(BaseMixin, db.Model):
         # crucial context: when the session was revoked remotely. `accessed_at` won't
         # be updated at that time.
         self.accessed_at = db.func.utcnow()
-        with db.session.no_autoflush:
-            if client:
-                if client not in self.clients:  # self.clients is defined via Client.sessions
-                    self.clients.append(client)
-                else:
-                    # If we've seen this client in this session before, only update the timestamp
-                    db.session.execute(session_client.update().where(
-                        session_client.c.user_session_id == self.id).where(
-                        session_client.c.client_id == client.id).values(
-                        updated_at=db.func.utcnow()))
-            else:
-                self.ipaddr = request.remote_addr or u''
-                self.user_agent = unicode(request.user_agent.string[:250]) or u''
+        session_accessed.send(self, client=client)
+        if client:
+            # Recorded in session_client, seen as self.clients (defined via Client.sessions)
+            db.session.execute(upsert_session_client(self.id, client.id))
+        else:
+            self.ipaddr = request.remote_addr or u''
+            self.user_agent = unicode(request.user_agent.string[:250]) or u''
 
     @cached_property
     def ua(self):
@@ -107,3 +126,200 @@ def active_sessions(self):
         UserSession.revoked_at == None).all()  # NOQA
 
 User.active_sessions = active_sessions
+
+
+#: Records every session's buid under a unique key once user_session is partitioned,
+#: since unique indexes on a partitioned table must include the partition key
+session_buid_ddl = """
+    CREATE TABLE user_session_buid (
+        buid VARCHAR(22) NOT NULL PRIMARY KEY,
+        user_session_id INTEGER NOT NULL REFERENCES user_session (id) ON DELETE CASCADE);
+    CREATE INDEX ix_user_session_buid_user_session_id ON user_session_buid (user_session_id);
+    INSERT INTO user_session_buid (buid, user_session_id) SELECT buid, id FROM user_session;
+    CREATE OR REPLACE FUNCTION user_session_buid() RETURNS trigger LANGUAGE plpgsql AS $$
+    BEGIN
+        IF TG_OP = 'INSERT' THEN
+            INSERT INTO user_session_buid (buid, user_session_id) VALUES (NEW.buid, NEW.id);
+        ELSIF NEW.buid IS DISTINCT FROM OLD.buid THEN
+            UPDATE user_session_buid SET buid = NEW.buid WHERE user_session_id = NEW.id;
+        END IF;
+        RETURN NULL;
+    END $$;
+    CREATE TRIGGER user_session_buid AFTER INSERT OR UPDATE OF buid ON user_session
+        FOR EACH ROW EXECUTE FUNCTION user_session_buid();
+    """
+
+
+def partition_session_tables(connection):
+    """
+    Partition user_session by ranges of id, and session_client by the same ranges of
+    user_session_id. Needs PostgreSQL 12 or later. The existing tables become the
+    default partitions, so no rows are copied, and all sessions stay in them until
+    :class:`~lastuser_core.janitor.Janitor` is configured to create range partitions.
+    The session_partitions migration does the same for an existing database.
+    """
+    if connection.dialect.server_version_info < (12,):
+        raise RuntimeError("Lastuser needs PostgreSQL 12 or later")
+    if connection.execute(db.text(
+            "SELECT count(*) FROM pg_partitioned_table WHERE partrelid = to_regclass('user_session')")).scalar():
+        return
+    # Foreign keys to either table are made again once they refer to the partitioned tables
+    references = connection.execute(db.text(
+        "SELECT conrelid::regclass::text, conname, pg_get_constraintdef(oid) FROM pg_constraint "
+        "WHERE contype = 'f' AND conparentid = 0 "
+        "AND confrelid IN ('user_session'::regclass, 'session_client'::regclass)")).fetchall()
+    for table, name, definition in references:
+        connection.execute(db.text('ALTER TABLE {0} DROP CONSTRAINT {1}'.format(table, name)))
+
+    for table, key in (('user_session', 'id'), ('session_client', 'user_session_id')):
+        default = table + '_default'
+        constraints = connection.execute(db.text(
+            "SELECT conname, contype, pg_get_constraintdef(oid) FROM pg_constraint "
+            "WHERE conrelid = to_regclass(:table) AND contype IN ('p', 'u', 'f')"), table=table).fetchall()
+        indexes = connection.execute(db.text(
+            "SELECT indexname, indexdef FROM pg_indexes WHERE tablename = :table AND indexname NOT IN "
+            "(SELECT conname FROM pg_constraint WHERE conrelid = to_regclass(:table))"), table=table).fetchall()
+        sequence = connection.execute(db.text("SELECT pg_get_serial_sequence(:table, :key)"),
+            table=table, key=key).scalar() if key == 'id' else None
+
+        connection.execute(db.text('ALTER TABLE {0} RENAME TO {1}'.format(table, default)))
+        for name, contype, definition in constraints:
+            if contype == 'p':
+                connection.execute(db.text('ALTER TABLE {0} RENAME CONSTRAINT {1} TO {0}_pkey'.format(default, name)))
+            elif contype == 'u':  # buid, now unique in user_session_buid
+                connection.execute(db.text('ALTER TABLE {0} DROP CONSTRAINT {1}'.format(default, name)))
+        for name, definition in indexes:
+            connection.execute(db.text('ALTER INDEX {0} RENAME TO {0}_default'.format(name)))
+
+        connection.execute(db.text('CREATE TABLE {0} (LIKE {1} INCLUDING DEFAULTS) PARTITION BY RANGE ({2})'.format(
+            table, default, key)))
+        for name, contype, definition in constraints:
+            if contype == 'p' or (contype == 'f' and name not in [ref[1] for ref in references if ref[0] == table]):
+                connection.execute(db.text('ALTER TABLE {0} ADD CONSTRAINT {1} {2}'.format(table, name, definition)))
+        for name, definition in indexes:
+            connection.execute(db.text(definition))
+        if table == 'user_session':
+            connection.execute(db.text('CREATE INDEX ix_user_session_buid ON user_session (buid)'))
+        if sequence:
+            connection.execute(db.text('ALTER SEQUENCE {0} OWNED BY {1}.id'.format(sequence, table)))
+        connection.execute(db.text('ALTER TABLE {0} ATTACH PARTITION {1} DEFAULT'.format(table, default)))
+
+    connection.execute(db.text(session_buid_ddl))
+    for table, name, definition in references:
+        connection.execute(db.text('ALTER TABLE {0} ADD CONSTRAINT {1} {2} NOT VALID'.format(table, name, definition)))
+        connection.execute(db.text('ALTER TABLE {0} VALIDATE CONSTRAINT {1}'.format(table, name)))
+
+
+@event.listens_for(db.Model.metadata, 'after_create')
+def _partition_session_tables(metadata, connection, tables=(), **kwargs):
+    if connection.dialect.name == 'postgresql' and UserSession.__table__ in tables:
+        partition_session_tables(connection)
+
+
+@event.listens_for(db.Model.metadata, 'before_drop')
+def _drop_session_buid(metadata, connection, **kwargs):
+    if connection.dialect.name == 'postgresql':
+        connection.execute(db.text('DROP TABLE IF EXISTS user_session_buid'))
+
+
+#: Most recent activity of each user at each client, rolled up from session_client
+#: by :func:`update_client_user_activity` for the dashboard. One row per user and
+#: client, so counting users active in any period is a scan of this table alone
+client_user_activity = db.Table(
+    'client_user_activity', db.Model.metadata,
+    db.Column('client_id', None, db.ForeignKey('client.id', ondelete='CASCADE'), nullable=False, primary_key=True),
+    db.Column('user_id', None, db.ForeignKey('user.id', ondelete='CASCADE'), nullable=False, primary_key=True),
+    db.Column('active_at', db.DateTime, nullable=False, index=True)
+    )
+
+
+def update_client_user_activity(overlap=timedelta(minutes=10), retention=timedelta(days=366)):
+    """
+    Roll up session_client rows updated since the last run into client_user_activity,
+    and drop rows older than ``retention``. Rows are read again for ``overlap`` before
+    the last recorded activity, to include transactions that committed late. Running
+    this again is harmless. Returns the number of user and client pairs updated.
+    """
+    now = datetime.utcnow()
+    last = db.session.query(db.func.max(client_user_activity.c.active_at)).scalar()
+    since = max(last - overlap, now - retention) if last is not None else now - retention
+
+    recent = db.select([
+        session_client.c.client_id,
+        UserSession.__table__.c.user_id,
+        db.func.max(session_client.c.updated_at).label('active_at')]).where(db.and_(
+            session_client.c.user_session_id == UserSession.__table__.c.id,
+            session_client.c.updated_at >= since)).group_by(
+            session_client.c.client_id, UserSession.__table__.c.user_id)
+    columns = ['client_id', 'user_id', 'active_at']
+
+    if db.engine.dialect.name == 'postgresql':
+        statement = postgresql.insert(client_user_activity).from_select(columns, recent)
+        statement = statement.on_conflict_do_update(
+            index_elements=[client_user_activity.c.client_id, client_user_activity.c.user_id],
+            set_={'active_at': db.func.greatest(client_user_activity.c.active_at, statement.excluded.active_at)})
+    else:
+        # The overlap means every replaced row is read again, so replacing can't go backwards
+        statement = client_user_activity.insert().prefix_with('OR REPLACE').from_select(columns, recent)
+    count = db.session.execute(statement).rowcount
+    db.session.execute(client_user_activity.delete().where(client_user_activity.c.active_at < now - retention))
+    return count
+
+
+class ActiveUserSketch(BaseMixin, db.Model):
+    """
+    Sketch of the users active on a day, site-wide or at one client. Sketches are
+    merged to count the users active over several days, at the accuracy
+    documented in :class:`~lastuser_core.sketch.HyperLogLog`. There may be more
+    than one row for a day and client if two processes created them at once,
+    which merging makes harmless.
+    """
+    __tablename__ = 'active_user_sketch'
+    #: Sketch precision. Changing this makes existing rows unreadable
+    precision = 12
+
+    day = db.Column(db.Date, nullable=False, index=True)
+    #: Client the users were active at, or None for all activity
+    client_id = db.Column(None, db.ForeignKey('client.id', ondelete='CASCADE'), nullable=True)
+    registers = db.Column(db.LargeBinary, nullable=False)
+
+    @classmethod
+    def add_sketches(cls, connection, sketches):
+        """
+        Merge sketches into the stored rows, creating rows as required.
+
+        :param connection: Connection to write with, in a transaction
+        :param dict sketches: Dict of (day, client_id) to a sketch
+        """
+        table = cls.__table__
+        # Rows are locked in a consistent order to avoid deadlocks between processes
+        for (day, client_id), sketch in sorted(sketches.items()):
+            row = connection.execute(db.select([table.c.id, table.c.registers]).where(db.and_(
+                table.c.day == day, table.c.client_id == client_id)).order_by(table.c.id).limit(1).with_for_update()).first()
+            if row is None:
+                connection.execute(table.insert().values(day=day, client_id=client_id, registers=sketch.to_bytes()))
+            else:
+                merged = HyperLogLog(cls.precision, row.registers)
+                merged.update(sketch)
+                connection.execute(table.update().where(table.c.id == row.id).values(
+                    registers=merged.to_bytes(), updated_at=db.func.utcnow()))
+
+    @classmethod
+    def merged(cls, start, end, client=None):
+        """
+        Return a sketch of the users active from the start day to the end day, inclusive.
+        """
+        sketch = HyperLogLog(cls.precision)
+        for registers, in db.session.query(cls.registers).filter(cls.day >= start, cls.day <= end,
+                cls.client_id == (client.id if client is not None else None)):  # NOQA
+            sketch.update(HyperLogLog(cls.precision, registers))
+        return sketch
+
+    @classmethod
+    def active_users(cls, days, client=None, today=None):
+        """
+        Return the estimated number of users active over the last given number of
+        days, including today: 1 for daily active users, 7 for weekly and 30 for monthly.
+        """
+        today = today or datetime.utcnow().date()
+        return cls.merged(today - timedelta(days=days - 1), today, client).count()
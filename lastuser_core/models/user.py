@@ -1,17 +1,20 @@
 # -*- coding: utf-8 -*-
 
+from collections import namedtuple
 from datetime import datetime, timedelta
 from hashlib import md5
 from werkzeug import check_password_hash, cached_property
-import bcrypt
+from flask import current_app
 from sqlalchemy import or_, event, DDL
-from sqlalchemy.orm import defer, deferred, foreign, remote
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.orm import defer, deferred, foreign, remote, joinedload, subqueryload, attributes, Session
 from sqlalchemy.ext.hybrid import hybrid_property
 from sqlalchemy.ext.associationproxy import association_proxy
 from sqlalchemy_utils import UUIDType
 from coaster.utils import buid, newsecret, newpin, valid_username, uuid1mc
 from coaster.sqlalchemy import Query as CoasterQuery, make_timestamp_columns, failsafe_add
 from baseframe import _
+from ..utils import password_hasher, PasswordHasherBusy
 
 from . import db, TimestampMixin, BaseMixin
 
@@ -27,6 +30,10 @@ class USER_STATUS:
     INVITED = 3    # Invited to make an account, doesn't have one yet
 
 
+#: A user's teams and organizations, as returned by :meth:`User.organization_graph`
+OrganizationGraph = namedtuple('OrganizationGraph', ['teams', 'owned', 'memberof', 'all', 'owned_org_teams'])
+
+
 class User(BaseMixin, db.Model):
     __tablename__ = 'user'
     #: UUID that replaces userid going forward
@@ -99,7 +106,7 @@ class User(BaseMixin, db.Model):
         if password is None:
             self.pw_hash = None
         else:
-            self.pw_hash = bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt())
+            self.pw_hash = password_hasher.hash(password)
         self.pw_set_at = db.func.utcnow()
         # Expire passwords after one year. TODO: make this configurable
         self.pw_expires_at = self.pw_set_at + timedelta(days=365)
@@ -145,9 +152,17 @@ class User(BaseMixin, db.Model):
             return False
 
         if self.pw_hash.startswith('sha1$'):  # XXX: DEPRECATED
-            return check_password_hash(self.pw_hash, password)
+            valid = check_password_hash(self.pw_hash, password)
         else:
-            return bcrypt.hashpw(password.encode('utf-8'), self.pw_hash.encode('utf-8')) == self.pw_hash.encode('utf-8')
+            valid = password_hasher.verify(password, self.pw_hash)
+        if valid and password_hasher.needs_rehash(self.pw_hash):
+            # Upgrade legacy hashes and hashes with an old cost factor. This doesn't
+            # count as a password change, so pw_set_at and pw_expires_at are untouched
+            try:
+                self.pw_hash = password_hasher.hash(password)
+            except PasswordHasherBusy:
+                pass  # The password is still valid. Try again at the next login
+        return valid
 
     def __repr__(self):
         return u'<User {username} "{fullname}">'.format(username=self.username or self.userid,
@@ -176,10 +191,9 @@ class User(BaseMixin, db.Model):
                     emailob.primary = False
         useremail = UserEmail(user=self, email=email, primary=primary, type=type, private=private)
         useremail = failsafe_add(db.session, useremail, user=self, email=email)
-        with db.session.no_autoflush:
-            for team in Team.query.filter_by(domain=useremail.domain):
-                if self not in team.users:
-                    team.users.append(self)
+        # Join all teams that claim this domain, with one INSERT ... SELECT
+        if insert_domain_members(db.session.connection(), user_ids=[self.id], domain=useremail.domain):
+            db.session.expire(self, ['teams'])
         return useremail
 
     def del_email(self, email):
@@ -237,39 +251,71 @@ class User(BaseMixin, db.Model):
         # to get the phone number as a string.
         return u''
 
+    def _organizations_query(self, *conditions):
+        return Organization.query.join(organization_membership,
+            organization_membership.c.org_id == Organization.id).filter(
+            organization_membership.c.user_id == self.id, *conditions).order_by(Organization.title)
+
+    def _organization_ids(self, *conditions):
+        return [row.org_id for row in db.session.query(organization_membership.c.org_id).filter(
+            organization_membership.c.user_id == self.id, *conditions)]
+
     def organizations(self):
         """
         Return the organizations this user is a member of.
         """
-        return sorted(set([team.org for team in self.teams]), key=lambda o: o.title)
+        return self._organizations_query().all()
 
     def organizations_owned(self):
         """
         Return the organizations this user is an owner of.
         """
-        return sorted(set([team.org for team in self.teams if team.org.owners == team]),
-            key=lambda o: o.title)
+        return self._organizations_query(organization_membership.c.is_owner == True).all()  # NOQA
 
     def organizations_owned_ids(self):
         """
         Return the database ids of the organizations this user is an owner of. This is used
         for database queries.
         """
-        return list(set([team.org.id for team in self.teams if team.org.owners == team]))
+        return self._organization_ids(organization_membership.c.is_owner == True)  # NOQA
 
     def organizations_memberof(self):
         """
         Return the organizations this user is a member of.
         """
-        return sorted(set([team.org for team in self.teams if team.org.members == team]),
-            key=lambda o: o.title)
+        return self._organizations_query(organization_membership.c.is_member == True).all()  # NOQA
 
     def organizations_memberof_ids(self):
         """
         Return the database ids of the organizations this user is a member of. This is used
         for database queries.
         """
-        return list(set([team.org.id for team in self.teams if team.org.members == team]))
+        return self._organization_ids(organization_membership.c.is_member == True)  # NOQA
+
+    def organization_graph(self, owned_org_teams=False):
+        """
+        Return this user's teams and organizations as an :class:`OrganizationGraph`,
+        loaded in a fixed number of queries however many teams the user is in. The
+        ``owned``, ``memberof`` and ``all`` organization lists match
+        :meth:`organizations_owned`, :meth:`organizations_memberof` and
+        :meth:`organizations`.
+
+        :param bool owned_org_teams: Also load all teams in the organizations this
+            user owns (one more query). Otherwise ``owned_org_teams`` is empty
+        """
+        # Organization.domain comes from the members team, so load that along with the org
+        teams = Team.query.join(team_membership).filter(team_membership.c.user_id == self.id).options(
+            joinedload(Team.org).joinedload(Organization.members)).all()
+        owned = sorted(set([team.org for team in teams if team.id == team.org.owners_id]),
+            key=lambda o: o.title)
+        memberof = sorted(set([team.org for team in teams if team.id == team.org.members_id]),
+            key=lambda o: o.title)
+        orgs = sorted(set([team.org for team in teams]), key=lambda o: o.title)
+        if owned_org_teams and owned:
+            org_teams = Team.query.filter(Team.org_id.in_([org.id for org in owned])).order_by(Team.title).all()
+        else:
+            org_teams = []
+        return OrganizationGraph(teams, owned, memberof, orgs, org_teams)
 
     def is_profile_complete(self):
         """
@@ -339,9 +385,17 @@ class User(BaseMixin, db.Model):
 
         if defercols:
             query = query.options(*cls._defercols)
-        for user in query.all():
-            user = user.merged_user()
-            if user.is_active:
+        # Load old ids along with users, and resolve all merged users in one more query,
+        # so that the number of queries doesn't grow with the number of users
+        found = query.options(subqueryload(cls.oldids)).all()
+        merged = [user.userid for user in found if user.status == USER_STATUS.MERGED]
+        if merged:
+            redirects = dict((oldid.userid, oldid.user) for oldid in UserOldId.query.filter(
+                UserOldId.userid.in_(merged)).options(joinedload(UserOldId.user).subqueryload(User.oldids)))
+        for user in found:
+            if user.status == USER_STATUS.MERGED:
+                user = redirects.get(user.userid)
+            if user is not None and user.is_active:
                 users.add(user)
         return list(users)
 
@@ -349,44 +403,19 @@ class User(BaseMixin, db.Model):
     def autocomplete(cls, query):
         """
         Return users whose names begin with the query, for autocomplete widgets.
-        Looks up users by fullname, username, external ids and email addresses.
+        Looks up users by fullname, username, external ids and email addresses,
+        using the configured search backend (see :mod:`lastuser_core.search`).
 
         :param str query: Letters to start matching with
         """
-        # Escape the '%' and '_' wildcards in SQL LIKE clauses.
-        # Some SQL dialects respond to '[' and ']', so remove them.
-        query = query.replace(u'%', ur'\%').replace(u'_', ur'\_').replace(u'[', u'').replace(u']', u'') + u'%'
-        # Use User._username since 'username' is a hybrid property that checks for validity
-        # before passing on to _username, the actual column name on the model.
-        # We convert to lowercase and use the LIKE operator since ILIKE isn't standard
-        # and doesn't use an index on PostgreSQL (there's a functional index defined below).
-        if not query:
-            return []
-        users = cls.query.filter(cls.status == USER_STATUS.ACTIVE,
-            or_(  # Match against userid (exact value only), fullname or username, case insensitive
-                cls.userid == query[:-1],
-                db.func.lower(cls.fullname).like(db.func.lower(query)),
-                db.func.lower(cls._username).like(db.func.lower(query))
-                )
-            ).options(*cls._defercols).limit(100).all()  # Limit to 100 results
-        if query.startswith('@') and UserExternalId.__at_username_services__:
-            # Add Twitter/GitHub accounts to the head of results
-            users = cls.query.filter(cls.status == USER_STATUS.ACTIVE, cls.id.in_(
-                db.session.query(UserExternalId.user_id).filter(
-                    UserExternalId.service.in_(UserExternalId.__at_username_services__),
-                    db.func.lower(UserExternalId.username).like(db.func.lower(query[1:]))
-                ).subquery())).options(*cls._defercols).limit(100).all() + users
-        elif '@' in query:
-            users = cls.query.filter(cls.status == USER_STATUS.ACTIVE, cls.id.in_(
-                db.session.query(UserEmail.user_id).filter(UserEmail.user_id != None).filter(  # NOQA
-                    db.func.lower(UserEmail.email).like(db.func.lower(query))
-                ).subquery())).options(*cls._defercols).limit(100).all() + users
-        return users
+        from ..search import user_search, normalize_query  # Imports this module, so import here
+        return user_search().search(normalize_query(query))
 
 
 create_user_index = DDL(
     'CREATE INDEX ix_user_username_lower ON "user" (lower(username) varchar_pattern_ops); '
-    'CREATE INDEX ix_user_fullname_lower ON "user" (lower(fullname) varchar_pattern_ops);')
+    'CREATE INDEX ix_user_fullname_lower ON "user" (lower(fullname) varchar_pattern_ops); '
+    'CREATE INDEX ix_user_fullname_tsvector ON "user" USING gin (to_tsvector(\'simple\', fullname));')
 event.listen(User.__table__, 'after_create',
     create_user_index.execute_if(dialect='postgresql'))
 
@@ -474,20 +503,15 @@ class Organization(BaseMixin, db.Model):
 
     @domain.setter
     def domain(self, value):
-        from ..signals import user_data_changed, team_data_changed  # Import here as we can't import at top-level
         if not value:
             value = None
         if not self.members:
             self.make_teams()
         if value and value != self.members.domain:
             # Look for team members based on domain, but only if the domain value was
-            # changed
-            with db.session.no_autoflush:
-                for useremail in UserEmail.query.filter_by(domain=value).join(User):
-                    if useremail.user not in self.members.users:
-                        self.members.users.append(useremail.user)
-                        user_data_changed.send(useremail.user, changes=['team-membership'])
-            team_data_changed.send(self.members, user=None, changes=['membership'])  # The team /edit view sends 'edit'
+            # changed. This happens in bulk when the session is committed, in
+            # :func:`_add_pending_domain_members`
+            db.session.info.setdefault('domain_teams', []).append(self.members)
         self.members.domain = value
 
     @hybrid_property
@@ -631,12 +655,22 @@ class Team(BaseMixin, db.Model):
             perms.add('delete')
         return perms
 
+    def add_domain_members(self):
+        """
+        Add users with an email address at the team's domain to the team, in bulk,
+        with one notification for all of them. Returns the ids of the users added.
+        """
+        from ..signals import team_data_changed, team_members_added  # Import here as we can't import at top-level
+        user_ids = [user_id for user_id, team_id in insert_domain_members(db.session.connection(), team_ids=[self.id])]
+        if user_ids:
+            team_members_added.send(self, user_ids=user_ids)
+            team_data_changed.send(self, user=None, changes=['membership'])  # The team /edit view sends 'edit'
+        return user_ids
+
     @classmethod
     def migrate_user(cls, olduser, newuser):
-        for team in olduser.teams:
-            if team not in newuser.teams:
-                newuser.teams.append(team)
-        olduser.teams = []
+        migrate_user_rows(team_membership, olduser, newuser)
+        refresh_organization_membership(db.session.connection(), user_ids=[olduser.id, newuser.id])
 
     @classmethod
     def get(cls, userid=None):
@@ -648,6 +682,245 @@ class Team(BaseMixin, db.Model):
         return cls.query.filter_by(userid=userid).one_or_none()
 
 
+#: Each user's role in each organization they are in any team of, derived from
+#: team_membership and the organization's owners and members teams. This answers
+#: "which organizations does this user own" with one indexed query. It is kept
+#: up to date by :func:`_update_organization_membership` on every flush, so don't
+#: write to it directly
+organization_membership = db.Table(
+    'organization_membership', db.Model.metadata,
+    db.Column('user_id', None, db.ForeignKey('user.id', ondelete='CASCADE'), nullable=False, primary_key=True),
+    db.Column('org_id', None, db.ForeignKey('organization.id', ondelete='CASCADE'), nullable=False,
+        primary_key=True, index=True),
+    db.Column('is_owner', db.Boolean, nullable=False, default=False),
+    db.Column('is_member', db.Boolean, nullable=False, default=False),
+    )
+
+
+def refresh_organization_membership(connection, user_ids=(), org_ids=()):
+    """
+    Rebuild organization_membership rows for the given users (in all their
+    organizations) and the given organizations (for all their users).
+    """
+    conditions = []
+    source_conditions = []
+    if user_ids:
+        conditions.append(organization_membership.c.user_id.in_(user_ids))
+        source_conditions.append(team_membership.c.user_id.in_(user_ids))
+    if org_ids:
+        conditions.append(organization_membership.c.org_id.in_(org_ids))
+        source_conditions.append(Team.org_id.in_(org_ids))
+    if not conditions:
+        return
+    connection.execute(organization_membership.delete().where(or_(*conditions)))
+    connection.execute(organization_membership.insert().from_select(
+        ['user_id', 'org_id', 'is_owner', 'is_member'],
+        db.select([
+            team_membership.c.user_id,
+            Team.org_id,
+            db.func.max(db.case([(Team.id == Organization.owners_id, 1)], else_=0)) > 0,
+            db.func.max(db.case([(Team.id == Organization.members_id, 1)], else_=0)) > 0,
+            ]).select_from(
+            team_membership.join(Team, team_membership.c.team_id == Team.id).join(
+                Organization, Team.org_id == Organization.id)).where(
+            or_(*source_conditions)).group_by(team_membership.c.user_id, Team.org_id)))
+
+
+def _domain_member_candidates(team_ids=(), user_ids=(), domain=None):
+    conditions = [UserEmail.user_id != None,  # NOQA
+        ~db.exists().where(db.and_(team_membership.c.user_id == UserEmail.user_id, team_membership.c.team_id == Team.id))]
+    if team_ids:
+        conditions.append(Team.id.in_(team_ids))
+    if user_ids:
+        conditions.append(UserEmail.user_id.in_(user_ids))
+    if domain:
+        conditions.append(Team.domain == domain)
+    return db.select([UserEmail.user_id, Team.id]).select_from(
+        UserEmail.__table__.join(Team.__table__, Team.domain == UserEmail.domain)).where(
+        db.and_(*conditions)).distinct()
+
+
+def count_domain_members(connection, team_ids=(), user_ids=(), domain=None, limit=None):
+    """
+    Return the number of memberships :func:`insert_domain_members` would add, or
+    ``limit`` if there are more. With a limit, the count stops as soon as it's reached.
+    """
+    candidates = _domain_member_candidates(team_ids, user_ids, domain)
+    if limit is not None:
+        candidates = candidates.limit(limit)
+    return connection.execute(db.select([db.func.count()]).select_from(candidates.alias())).scalar()
+
+
+def insert_domain_members(connection, team_ids=(), user_ids=(), domain=None):
+    """
+    Add users to the teams whose domain matches one of their email addresses,
+    for the given teams, users or domain, with one INSERT ... SELECT of the
+    memberships that don't exist yet. Returns a list of (user_id, team_id) added.
+
+    On PostgreSQL the statement skips memberships added concurrently and returns
+    the rows it inserted. Elsewhere the candidates are selected first.
+    """
+    candidates = _domain_member_candidates(team_ids, user_ids, domain)
+    if connection.dialect.name == 'postgresql':
+        added = connection.execute(postgresql.insert(team_membership).from_select(
+            ['user_id', 'team_id'], candidates).on_conflict_do_nothing().returning(
+            team_membership.c.user_id, team_membership.c.team_id)).fetchall()
+    else:
+        added = connection.execute(candidates).fetchall()
+        if added:
+            connection.execute(team_membership.insert(), [
+                {'user_id': user_id, 'team_id': team_id} for user_id, team_id in added])
+    if added:
+        user_ids = set(user_id for user_id, team_id in added)
+        org_ids = [org_id for org_id, in connection.execute(db.select([Team.org_id]).where(
+            Team.id.in_(set(team_id for user_id, team_id in added))).distinct()) if org_id is not None]
+        # Rebuild whichever is smaller: a few users' rows or a few organizations' rows
+        if len(user_ids) <= len(org_ids):
+            refresh_organization_membership(connection, user_ids=user_ids)
+        elif org_ids:
+            refresh_organization_membership(connection, org_ids=org_ids)
+    return added
+
+
+def _is_savepoint(session):
+    # Commit and rollback events also fire when a savepoint is released or rolled back
+    return session.transaction is not None and session.transaction.nested
+
+
+@event.listens_for(Session, 'before_commit')
+def _add_pending_domain_members(session):
+    """
+    Add members to teams whose domain was changed in this transaction. Teams with
+    more new members than ``DOMAIN_MEMBERS_JOB_THRESHOLD`` are left to a background
+    job, queued after commit. Savepoints are skipped: the members are added when
+    the transaction itself commits.
+    """
+    if _is_savepoint(session):
+        return
+    teams = session.info.pop('domain_teams', None)
+    if not teams:
+        return
+    session.flush()
+    threshold = current_app.config.get('DOMAIN_MEMBERS_JOB_THRESHOLD', 1000)
+    for team in set(teams):
+        if team.id is None or team.domain is None:
+            continue  # The team wasn't saved, or its domain was removed again
+        if count_domain_members(session.connection(), team_ids=[team.id], limit=threshold + 1) > threshold:
+            session.info.setdefault('domain_team_jobs', []).append(team.id)
+        else:
+            team.add_domain_members()
+
+
+@event.listens_for(Session, 'after_commit')
+def _queue_domain_member_jobs(session):
+    if _is_savepoint(session):
+        return
+    team_ids = session.info.pop('domain_team_jobs', None)
+    if team_ids:
+        from ..jobs import add_domain_members  # Import here as we can't import at top-level
+        for team_id in team_ids:
+            add_domain_members.delay(team_id)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_domain_members(session):
+    if _is_savepoint(session):
+        return
+    session.info.pop('domain_teams', None)
+    session.info.pop('domain_team_jobs', None)
+
+
+def merge_user_rows(connection, table, olduser_id, newuser_id, merge_column=None):
+    """
+    Move one user's rows in the table to another user, with a fixed number of
+    statements however many rows there are. Rows that would then duplicate one of
+    the new user's rows under a unique constraint on ``user_id`` and other columns
+    are deleted instead. If ``merge_column`` is given (a string of space-separated
+    tokens, like a scope), their tokens are first added to the new user's row.
+    Returns the number of rows moved or merged.
+    """
+    count = 0
+    uniques = [constraint.columns for constraint in table.constraints
+        if isinstance(constraint, (db.PrimaryKeyConstraint, db.UniqueConstraint))]
+    uniques.extend(index.columns for index in table.indexes if index.unique)
+    for columns in uniques:
+        if 'user_id' not in columns:
+            continue
+        existing = table.alias('existing')
+        match = db.and_(existing.c.user_id == newuser_id,
+            *[existing.c[column.name] == column for column in columns if column.name != 'user_id'])
+        if merge_column is not None:
+            tokens = {}
+            for id, new, old in connection.execute(db.select(
+                    [existing.c.id, existing.c[merge_column], table.c[merge_column]]).select_from(
+                    table.join(existing, match)).where(table.c.user_id == olduser_id)):
+                tokens.setdefault(id, set((new or u'').split())).update((old or u'').split())
+            if tokens:
+                connection.execute(table.update().where(table.c.id == db.bindparam('_id')).values(
+                    {merge_column: db.bindparam('_' + merge_column)}),
+                    [{'_id': id, '_' + merge_column: u' '.join(sorted(values))} for id, values in tokens.items()])
+        count += connection.execute(table.delete().where(table.c.user_id == olduser_id).where(
+            db.exists().where(match))).rowcount
+    count += connection.execute(table.update().where(table.c.user_id == olduser_id).values(
+        user_id=newuser_id)).rowcount
+    return count
+
+
+def migrate_user_rows(table, olduser, newuser, merge_column=None):
+    """
+    Implementation of ``migrate_user`` for models: calls :func:`merge_user_rows`
+    in the current transaction, then expires the session since loaded rows and
+    relationships may now be out of date.
+    """
+    db.session.add(newuser)
+    db.session.flush()
+    count = merge_user_rows(db.session.connection(), table, olduser.id, newuser.id, merge_column)
+    db.session.expire_all()
+    return count
+
+
+def _history(obj, attr):
+    return attributes.get_history(obj, attr, passive=attributes.PASSIVE_NO_INITIALIZE)
+
+
+@event.listens_for(Session, 'after_flush')
+def _update_organization_membership(session, flush_context):
+    """
+    Find users and organizations whose team memberships changed in this flush and
+    rebuild their organization_membership rows.
+    """
+    user_ids = set()
+    org_ids = set()
+    for obj in session.new:
+        if isinstance(obj, Organization):
+            org_ids.add(obj.id)
+        elif isinstance(obj, Team):
+            org_ids.add(obj.org_id)
+    for obj in session.deleted:
+        if isinstance(obj, Organization):
+            org_ids.add(obj.id)
+        elif isinstance(obj, Team):
+            org_ids.add(obj.org_id)
+    for obj in session.dirty:
+        if isinstance(obj, User):
+            if _history(obj, 'teams').has_changes():
+                user_ids.add(obj.id)
+        elif isinstance(obj, Team):
+            history = _history(obj, 'users')
+            user_ids.update(user.id for user in list(history.added or ()) + list(history.deleted or ()))
+            history = _history(obj, 'org_id')
+            if history.has_changes():
+                org_ids.update(history.added or ())
+                org_ids.update(history.deleted or ())
+        elif isinstance(obj, Organization):
+            if _history(obj, 'owners').has_changes() or _history(obj, 'members').has_changes():
+                org_ids.add(obj.id)
+    user_ids.discard(None)
+    org_ids.discard(None)
+    if user_ids or org_ids:
+        refresh_organization_membership(session.connection(), user_ids, org_ids)
+
+
 # -- User/Org/Team email/phone and misc
 
 class OwnerMixin(object):
@@ -981,6 +1254,8 @@ class PasswordResetRequest(BaseMixin, db.Model):
     user = db.relationship(User, primaryjoin=user_id == User.id)
     reset_code = db.Column(db.String(44), nullable=False, default=newsecret)
 
+    __table_args__ = (db.Index('ix_passwordresetrequest_created_at', 'created_at'),)
+
     def __init__(self, **kwargs):
         super(PasswordResetRequest, self).__init__(**kwargs)
         self.reset_code = newsecret()
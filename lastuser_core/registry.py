@@ -5,24 +5,137 @@ Resource registry
 """
 
 from functools import wraps
+from collections import namedtuple
+from datetime import datetime, timedelta
 import re
 try:
     from collections import OrderedDict
 except ImportError:
     from ordereddict import OrderedDict
+from werkzeug import cached_property
+from sqlalchemy import event as sqla_event, inspect as sqla_inspect
 from flask import Response, request, jsonify, abort
 from baseframe import _
 from baseframe.signals import exception_catchall
-from .models import AuthToken, UserExternalId
+from .utils import TTLCache
+from .models import AuthToken, Client, User, UserExternalId
+from .signals import model_authtokens_migrated
 
 # Bearer token, as per http://tools.ietf.org/html/draft-ietf-oauth-v2-bearer-15#section-2.1
 auth_bearer_re = re.compile('^Bearer ([a-zA-Z0-9_.~+/-]+=*)$')
 
+#: Resolved access tokens, keyed on the token string. Sized in :meth:`ResourceRegistry.init_app`
+token_cache = TTLCache(maxsize=10000, ttl=60)
+
+
+class TokenRecord(namedtuple('TokenRecord',
+        ['token', 'user_id', 'client_id', 'client_trusted', 'scope', 'created_at', 'validity'])):
+    """
+    Compact record of an :class:`AuthToken`, holding only what resource access checks
+    need. Records contain no database objects and are safe to share across requests.
+    """
+    __slots__ = ()
+
+    @classmethod
+    def load(cls, token):
+        """
+        Load a record for the given token string from the database. Returns None if
+        there is no such token.
+        """
+        authtoken = AuthToken.get(token=token)
+        if authtoken is None:
+            return None
+        user = authtoken.user
+        return cls(
+            token=authtoken.token,
+            user_id=user.id if user is not None else None,
+            client_id=authtoken.client_id,
+            client_trusted=authtoken.client.trusted,
+            scope=frozenset(authtoken.scope),
+            created_at=authtoken.created_at,
+            validity=authtoken.validity)
+
+    @classmethod
+    def get(cls, token):
+        """
+        Return a record for the given token string, from :data:`token_cache` if available.
+        """
+        record = token_cache.get(token)
+        if record is None:
+            record = cls.load(token)
+            if record is not None:
+                token_cache.set(token, record)
+        return record
+
+    def is_valid(self):
+        """Same as :meth:`AuthToken.is_valid`"""
+        if self.validity == 0:
+            return True  # This token is perpetually valid
+        return self.created_at >= datetime.utcnow() - timedelta(seconds=self.validity)
+
+
+class ResourceToken(object):
+    """
+    Request-scoped stand-in for :class:`AuthToken` that is passed to resource functions.
+    The user and client are only loaded from the database if the resource asks for them.
+    """
+    def __init__(self, record):
+        self.record = record
+
+    @property
+    def token(self):
+        return self.record.token
+
+    @property
+    def scope(self):
+        return tuple(sorted(self.record.scope))
+
+    @cached_property
+    def user(self):
+        if self.record.user_id is not None:
+            return User.query.get(self.record.user_id)
+
+    @cached_property
+    def client(self):
+        return Client.query.get(self.record.client_id)
+
+    def is_valid(self):
+        return self.record.is_valid()
+
+
+@sqla_event.listens_for(AuthToken, 'after_update')
+def _authtoken_edited(mapper, connection, target):
+    # The token string itself changes when a token is refreshed, so drop both old and new values
+    for token in sqla_inspect(target).attrs.token.history.sum():
+        token_cache.pop(token)
+
+
+@sqla_event.listens_for(AuthToken, 'after_delete')
+def _authtoken_deleted(mapper, connection, target):
+    token_cache.pop(target.token)
+
+
+@model_authtokens_migrated.connect
+def _authtokens_migrated(olduser, newuser, tokens):
+    for token in tokens:
+        token_cache.pop(token)
+
+
+@sqla_event.listens_for(Client, 'after_update')
+def _client_edited(mapper, connection, target):
+    # Records carry the client's trusted flag. This rarely changes, so just start over
+    if sqla_inspect(target).attrs.trusted.history.has_changes():
+        token_cache.clear()
+
 
 class ResourceRegistry(OrderedDict):
     """
     Dictionary of resources
     """
+    def init_app(self, app):
+        token_cache.maxsize = app.config.get('TOKEN_CACHE_SIZE', 10000)
+        token_cache.ttl = app.config.get('TOKEN_CACHE_TTL', 60)
+
     def resource(self, name, description=None, trusted=False, scope=None):
         """
         Decorator for resource functions.
@@ -64,24 +177,24 @@ class ResourceRegistry(OrderedDict):
                     if not token:
                         # No token provided in Authorization header or in request parameters
                         return resource_auth_error(_(u"An access token is required to access this resource"))
-                authtoken = AuthToken.get(token=token)
-                if not authtoken:
+                record = TokenRecord.get(token)
+                if not record:
                     return resource_auth_error(_(u"Unknown access token"))
-                if not authtoken.is_valid():
+                if not record.is_valid():
                     return resource_auth_error(_(u"Access token has expired"))
 
-                tokenscope = set(authtoken.scope)  # Read once to avoid reparsing below
+                tokenscope = record.scope
                 wildcardscope = usescope.split('/', 1)[0] + '/*'
-                if not (authtoken.client.trusted and '*' in tokenscope):
+                if not (record.client_trusted and '*' in tokenscope):
                     # If a trusted client has '*' in token scope, all good, else check further
                     if (usescope not in tokenscope) and (wildcardscope not in tokenscope):
                         # Client doesn't have access to this scope either directly or via a wildcard
                         return resource_auth_error(_(u"Token does not provide access to this resource"))
-                if trusted and not authtoken.client.trusted:
+                if trusted and not record.client_trusted:
                     return resource_auth_error(_(u"This resource can only be accessed by trusted clients"))
                 # All good. Return the result value
                 try:
-                    result = f(authtoken, args, request.files)
+                    result = f(ResourceToken(record), args, request.files)
                     response = jsonify({'status': 'ok', 'result': result})
                 except Exception as exception:
                     exception_catchall.send(exception)
@@ -0,0 +1,341 @@
+# -*- coding: utf-8 -*-
+
+"""
+User search backends for autocomplete
+"""
+
+from bisect import bisect_left
+from collections import namedtuple
+import re
+import threading
+from flask import current_app
+from .utils import TTLCache
+from .models import db, User, UserEmail, UserExternalId, USER_STATUS
+from .signals import (model_user_new, model_user_edited, model_user_deleted,
+    model_useremail_new, model_useremail_edited, model_useremail_deleted)
+
+__all__ = ['UserSearchBackend', 'SQLUserSearch', 'MemoryUserSearch', 'user_search',
+    'UserMatch', 'AutocompleteCache', 'autocomplete_cache']
+
+# Ranks for the ways a query can match a user. Higher ranks sort first.
+RANK_USERID = 5       # Exact userid
+RANK_EXACT = 4        # Exact username, email address or external username
+RANK_PREFIX = 3       # Prefix of username, email address or external username
+RANK_FULLNAME = 2     # Prefix of fullname
+RANK_WORD = 1         # Prefix of a word in the fullname
+
+word_re = re.compile(r'\w+', re.UNICODE)
+
+#: Length of a userid, which autocomplete matches exactly
+USERID_LENGTH = 22
+
+
+def normalize_query(query):
+    """
+    Normalize an autocomplete query: without surrounding whitespace and without
+    square brackets (which some SQL dialects treat as wildcards). Case is preserved
+    since userids are case sensitive; backends lowercase the query for other matches.
+    """
+    return query.replace(u'[', u'').replace(u']', u'').strip()
+
+
+class UserSearchBackend(object):
+    """
+    Base class for user search backends. Subclasses implement :meth:`search`.
+    """
+    def search(self, query, limit=100):
+        """
+        Return up to ``limit`` active users matching the query, best matches first,
+        without duplicates. The query matches a user's userid exactly, or is a prefix
+        of their username, fullname or a word in their fullname. Queries containing
+        ``@`` also match email addresses, and queries starting with ``@`` match
+        usernames at external services (:attr:`UserExternalId.__at_username_services__`).
+
+        :param unicode query: Query, normalized with :func:`normalize_query`
+        :param int limit: Maximum number of results
+        """
+        raise NotImplementedError
+
+    def invalidate(self):
+        """
+        Called when user data has changed. Backends that keep their own index should
+        discard or update it.
+        """
+        pass
+
+
+class SQLUserSearch(UserSearchBackend):
+    """
+    PostgreSQL search backend. Finds, ranks and limits matches in a single query,
+    using trigram similarity (from the ``pg_trgm`` extension) to order matches of the
+    same kind, and a ``simple`` text search vector to match words in fullnames.
+    """
+    def search(self, query, limit=100):
+        if not query:
+            return []
+        userid = query
+        query = query.lower()
+        # Escape the '%' and '_' wildcards in SQL LIKE clauses
+        like = query.replace(u'%', ur'\%').replace(u'_', ur'\_') + u'%'
+
+        def ranked(column, value, rank):
+            return db.case([(column == value, RANK_EXACT)], else_=rank) + db.func.similarity(column, value)
+
+        username = db.func.lower(User._username)
+        fullname = db.func.lower(User.fullname)
+        candidates = [
+            db.select([User.id.label('user_id'), db.literal(RANK_USERID).label('rank')]).where(
+                User.userid == userid),
+            db.select([User.id.label('user_id'), ranked(username, query, RANK_PREFIX).label('rank')]).where(
+                username.like(like)),
+            db.select([User.id.label('user_id'), (RANK_FULLNAME + db.func.similarity(fullname, query)).label('rank')]).where(
+                fullname.like(like)),
+            ]
+        words = word_re.findall(query) if u'@' not in query else []
+        if words:
+            tsquery = u' & '.join(word + u':*' for word in words)
+            candidates.append(
+                db.select([User.id.label('user_id'), (RANK_WORD + db.func.similarity(fullname, query)).label('rank')]).where(
+                    db.func.to_tsvector('simple', User.fullname).op('@@')(db.func.to_tsquery('simple', tsquery))))
+        if query.startswith(u'@') and UserExternalId.__at_username_services__:
+            extname = db.func.lower(UserExternalId.username)
+            candidates.append(
+                db.select([UserExternalId.user_id.label('user_id'), ranked(extname, query[1:], RANK_PREFIX).label('rank')]).where(
+                    db.and_(UserExternalId.service.in_(UserExternalId.__at_username_services__),
+                        extname.like(like[1:]))))
+        elif u'@' in query:
+            email = db.func.lower(UserEmail.email)
+            candidates.append(
+                db.select([UserEmail.user_id.label('user_id'), ranked(email, query, RANK_PREFIX).label('rank')]).where(
+                    db.and_(UserEmail.user_id != None, email.like(like))))  # NOQA
+
+        matches = db.union_all(*candidates).alias('matches')
+        best = db.select([matches.c.user_id, db.func.max(matches.c.rank).label('rank')]).group_by(
+            matches.c.user_id).alias('best')
+        return User.query.join(best, best.c.user_id == User.id).filter(
+            User.status == USER_STATUS.ACTIVE).options(*User._defercols).order_by(
+            best.c.rank.desc(), User.fullname).limit(limit).all()
+
+
+class MemoryUserSearch(UserSearchBackend):
+    """
+    In-memory prefix index for SQLite and tests. The index is a sorted list of
+    (key, rank, user_id) entries, with email addresses in a list of their own that
+    only queries containing ``@`` search. Both are built from the database on first
+    use and discarded by :meth:`invalidate` whenever user data changes. Each search
+    is a binary search for the start of the prefix range followed by one query to
+    load the results. The index is per process.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = None
+        self._emails = None
+        self._userids = None
+
+    def invalidate(self):
+        with self._lock:
+            self._entries = None
+            self._emails = None
+            self._userids = None
+
+    def build(self):
+        """
+        Build the index from the database.
+        """
+        entries = []
+        emails = []
+        userids = {}
+        for user_id, userid, username, fullname in db.session.query(
+                User.id, User.userid, User._username, User.fullname).filter(User.status == USER_STATUS.ACTIVE):
+            userids[userid] = user_id
+            if username:
+                entries.append((username.lower(), RANK_PREFIX, user_id))
+            if fullname:
+                fullname = fullname.lower()
+                entries.append((fullname, RANK_FULLNAME, user_id))
+                for word in word_re.findall(fullname)[1:]:
+                    entries.append((word, RANK_WORD, user_id))
+        for user_id, email in db.session.query(UserEmail.user_id, UserEmail.email).filter(
+                UserEmail.user_id != None):  # NOQA
+            emails.append((email.lower(), RANK_PREFIX, user_id))
+        if UserExternalId.__at_username_services__:
+            for user_id, username in db.session.query(UserExternalId.user_id, UserExternalId.username).filter(
+                    UserExternalId.service.in_(UserExternalId.__at_username_services__),
+                    UserExternalId.username != None):  # NOQA
+                entries.append((u'@' + username.lower(), RANK_PREFIX, user_id))
+        entries.sort()
+        emails.sort()
+        with self._lock:
+            self._entries = entries
+            self._emails = emails
+            self._userids = userids
+        return entries, emails, userids
+
+    def search(self, query, limit=100):
+        if not query:
+            return []
+        userid = query
+        query = query.lower()
+        with self._lock:
+            entries, emails, userids = self._entries, self._emails, self._userids
+        if entries is None:
+            entries, emails, userids = self.build()
+
+        best = {}
+        if userid in userids:
+            best[userids[userid]] = RANK_USERID
+        # As in SQLUserSearch, only queries containing '@' match email addresses
+        for index_entries in ([entries, emails] if u'@' in query else [entries]):
+            for index in xrange(bisect_left(index_entries, (query,)), len(index_entries)):
+                key, rank, user_id = index_entries[index]
+                if not key.startswith(query):
+                    break
+                if key == query and rank == RANK_PREFIX:
+                    rank = RANK_EXACT
+                if rank > best.get(user_id, 0):
+                    best[user_id] = rank
+        if not best:
+            return []
+        users = dict((user.id, user) for user in User.query.filter(User.id.in_(best.keys()),
+            User.status == USER_STATUS.ACTIVE).options(*User._defercols))
+        return sorted(users.values(), key=lambda u: (-best[u.id], u.fullname))[:limit]
+
+
+_backends = {
+    'sql': SQLUserSearch,
+    'memory': MemoryUserSearch,
+    }
+_backend = None
+
+
+def user_search():
+    """
+    Return the user search backend configured by ``USER_SEARCH_BACKEND`` (``sql`` or
+    ``memory``). If not configured, use ``sql`` on PostgreSQL and ``memory`` elsewhere.
+    """
+    global _backend
+    if _backend is None:
+        name = current_app.config.get('USER_SEARCH_BACKEND') or (
+            'sql' if db.engine.dialect.name == 'postgresql' else 'memory')
+        _backend = _backends[name]()
+    return _backend
+
+
+class UserMatch(namedtuple('UserMatch', ['userid', 'uuid', 'username', 'fullname'])):
+    """
+    Compact autocomplete result, holding only what the autocomplete API returns.
+    """
+    __slots__ = ()
+
+    @classmethod
+    def from_user(cls, user):
+        return cls(user.userid, user.uuid, user.username, user.fullname)
+
+    @property
+    def pickername(self):
+        if self.username:
+            return u'{fullname} (@{username})'.format(fullname=self.fullname, username=self.username)
+        else:
+            return self.fullname
+
+    def rank(self, query):
+        """
+        Rank of this match for the given lowercase query, using the username and
+        fullname only, or 0 if it doesn't match.
+        """
+        username = (self.username or u'').lower()
+        fullname = (self.fullname or u'').lower()
+        if username == query:
+            return RANK_EXACT
+        elif username.startswith(query):
+            return RANK_PREFIX
+        elif fullname.startswith(query):
+            return RANK_FULLNAME
+        elif any(word.startswith(query) for word in word_re.findall(fullname)):
+            return RANK_WORD
+        return 0
+
+
+class AutocompleteCache(object):
+    """
+    TTL and LRU cache of autocomplete results, keyed on the normalized query. Each
+    entry is a list of :class:`UserMatch` tuples.
+
+    A query that isn't cached can still be answered without the database if a
+    shorter prefix of it is cached with fewer than ``limit`` results, since that
+    result then holds every user the longer query can match. This only applies to
+    queries that can only match usernames and fullnames: those without ``@`` and
+    too short to be a userid.
+
+    The cache is cleared whenever a user or email address changes. ``hits``,
+    ``prefix_hits`` and ``misses`` count requests, for sizing the cache.
+
+    :param int maxsize: Maximum number of cached queries
+    :param int ttl: Time to live for each entry, in seconds
+    :param int limit: Maximum number of results for a query
+    """
+    def __init__(self, maxsize=10000, ttl=300, limit=100):
+        self.results = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.limit = limit
+        self.hits = 0
+        self.prefix_hits = 0
+        self.misses = 0
+
+    @property
+    def hit_rate(self):
+        """
+        Fraction of requests answered from the cache, exactly or by prefix.
+        """
+        total = self.hits + self.prefix_hits + self.misses
+        return float(self.hits + self.prefix_hits) / total if total else 0.0
+
+    def clear(self):
+        self.results.clear()
+
+    def _from_prefix(self, query):
+        for length in range(len(query) - 1, 0, -1):
+            cached = self.results.get(query[:length])
+            if cached is not None and len(cached) < self.limit:
+                ranked = [(match.rank(query), match) for match in cached]
+                return [match for rank, match in sorted(
+                    (item for item in ranked if item[0]), key=lambda item: (-item[0], item[1].fullname))]
+
+    def autocomplete(self, query):
+        """
+        Return a list of :class:`UserMatch` for the query, as :meth:`User.autocomplete` would.
+        """
+        query = normalize_query(query)
+        if not query:
+            return []
+        if len(query) < USERID_LENGTH:
+            # Only userids are case sensitive, so share entries across case
+            query = query.lower()
+        result = self.results.get(query)
+        if result is not None:
+            self.hits += 1
+            return result
+        if u'@' not in query and len(query) < USERID_LENGTH:
+            result = self._from_prefix(query)
+            if result is not None:
+                self.prefix_hits += 1
+                self.results.set(query, result)
+                return result
+        self.misses += 1
+        result = [UserMatch.from_user(user) for user in user_search().search(query, limit=self.limit)]
+        self.results.set(query, result)
+        return result
+
+
+#: Autocomplete result cache. Configured in :meth:`LastuserOAuthBlueprint.init_app`
+autocomplete_cache = AutocompleteCache()
+
+
+def _invalidate(*args, **kwargs):
+    if _backend is not None:
+        _backend.invalidate()
+    autocomplete_cache.clear()
+
+
+for signal in (model_user_new, model_user_edited, model_user_deleted,
+        model_useremail_new, model_useremail_edited, model_useremail_deleted):
+    signal.connect(_invalidate)
@@ -35,6 +35,10 @@ model_userphoneclaim_new = lastuser_signals.signal('model-useremail-new')
 model_userphoneclaim_edited = lastuser_signals.signal('model-useremail-edited')
 model_userphoneclaim_deleted = lastuser_signals.signal('model-useremail-deleted')
 
+#: Sent when a user's tokens are moved to another user with bulk statements that
+#: bypass AuthToken's listeners, with the affected token strings
+model_authtokens_migrated = lastuser_signals.signal('model-authtokens-migrated')
+
 resource_access_granted = lastuser_signals.signal('resource-access-granted')
 
 # Higher level signals
@@ -43,7 +47,9 @@ user_registered = lastuser_signals.signal('user-registered')
 user_data_changed = lastuser_signals.signal('user-data-changed')
 org_data_changed = lastuser_signals.signal('org-data-changed')
 team_data_changed = lastuser_signals.signal('team-data-changed')
+team_members_added = lastuser_signals.signal('team-members-added')
 session_revoked = lastuser_signals.signal('session-revoked')
+session_accessed = lastuser_signals.signal('session-accessed')
 
 
 @sqla_event.listens_for(User, 'after_insert')
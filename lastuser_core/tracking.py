@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+
+"""
+Write-behind access tracking
+"""
+
+from datetime import datetime, timedelta
+import time
+import threading
+from sqlalchemy import bindparam
+from .models import db, ActiveUserSketch
+from .sketch import HyperLogLog
+
+
+class AccessTracker(object):
+    """
+    Write-behind recorder for last-access timestamps (and any values that go with
+    them). Calls to :meth:`record` are held in memory and written to the table
+    with a single bulk UPDATE at most once every ``interval`` seconds, instead of
+    an UPDATE and a commit per request.
+
+    Each row's recorded timestamp is the time it was actually accessed, not the
+    time it was written, and a flush never moves a timestamp backwards. Pending
+    records are held per process; the app flushes them at the end of any request
+    once ``interval`` has passed, and again when the process exits.
+
+    :param table: Table to update, with an ``id`` primary key
+    :param str column: Name of the timestamp column
+    :param int interval: Seconds between flushes
+    :param int precision: Don't record an access if the stored timestamp is newer than this many seconds
+    """
+    def __init__(self, table, column='accessed_at', interval=60, precision=60):
+        self.table = table
+        self.column = column
+        self.interval = interval
+        self.precision = precision
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._flushed_at = time.time()
+
+    def is_fresh(self, accessed_at, now=None):
+        """
+        Is the given stored timestamp recent enough that a new access need not be recorded?
+        """
+        if accessed_at is None:
+            return False
+        return accessed_at > (now or datetime.utcnow()) - timedelta(seconds=self.precision)
+
+    def record(self, id, accessed_at=None, **values):
+        """
+        Record an access to the row with the given id. Flushes all pending records
+        if the last flush was more than ``interval`` seconds ago.
+
+        :param id: Row id
+        :param datetime accessed_at: Time of access (default now)
+        :param values: Other columns to update along with the timestamp. Every call
+            must specify the same set of columns
+        """
+        values[self.column] = accessed_at or datetime.utcnow()
+        with self._lock:
+            self._pending[id] = values
+        self.flush_if_due()
+
+    def flush_if_due(self):
+        """
+        Flush pending records if the last flush was more than ``interval`` seconds ago.
+        Returns the number of records written.
+        """
+        with self._lock:
+            due = time.time() - self._flushed_at >= self.interval
+        return self.flush() if due else 0
+
+    def pending(self, id):
+        """
+        Return pending values for the given row id, or None.
+        """
+        with self._lock:
+            return self._pending.get(id)
+
+    def flush(self):
+        """
+        Write all pending records in one bulk UPDATE, in a transaction of its own.
+        Returns the number of records written.
+        """
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            self._flushed_at = time.time()
+        if not pending:
+            return 0
+        table = self.table
+        column = table.c[self.column]
+        names = pending.values()[0].keys()
+        # Bind names can't be the same as column names in an UPDATE, hence the '_' prefix
+        statement = table.update().where(table.c.id == bindparam('_id')).where(
+            db.or_(column == None, column < bindparam('_' + self.column))).values(  # NOQA
+            {name: bindparam('_' + name) for name in names})
+        with db.engine.begin() as connection:
+            connection.execute(statement, [
+                dict([('_id', id)] + [('_' + name, value) for name, value in values.items()])
+                for id, values in pending.items()])
+        return len(pending)
+
+
+class ActiveUserTracker(object):
+    """
+    Write-behind recorder of active users. Users are added to in-memory sketches
+    for the day, site-wide and per client, which are merged into
+    :class:`~lastuser_core.models.ActiveUserSketch` rows at most once every
+    ``interval`` seconds. As with :class:`AccessTracker`, pending records are held
+    per process until a request ends after ``interval`` or the process exits.
+
+    :param int interval: Seconds between flushes
+    """
+    def __init__(self, interval=60):
+        self.interval = interval
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._flushed_at = time.time()
+
+    def record(self, userid, client_id=None, day=None):
+        """
+        Record a user as active today (in UTC), and at the given client if any.
+
+        :param str userid: The user's userid, which is set before the user is saved
+        :param int client_id: Client id
+        :param date day: Day of activity (default today)
+        """
+        day = day or datetime.utcnow().date()
+        keys = [(day, None)] if client_id is None else [(day, None), (day, client_id)]
+        with self._lock:
+            for key in keys:
+                if key not in self._pending:
+                    self._pending[key] = HyperLogLog(ActiveUserSketch.precision)
+                self._pending[key].add(userid)
+        self.flush_if_due()
+
+    def flush_if_due(self):
+        """
+        Flush pending sketches if the last flush was more than ``interval`` seconds ago.
+        Returns the number of sketches written.
+        """
+        with self._lock:
+            due = time.time() - self._flushed_at >= self.interval
+        return self.flush() if due else 0
+
+    def flush(self):
+        """
+        Merge all pending sketches into the database, in a transaction of its own.
+        Returns the number of sketches written.
+        """
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            self._flushed_at = time.time()
+        if not pending:
+            return 0
+        with db.engine.begin() as connection:
+            ActiveUserSketch.add_sketches(connection, pending)
+        return len(pending)
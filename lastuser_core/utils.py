@@ -1,9 +1,20 @@
 # -*- coding: utf-8 -*-
 
 # Id generation
+import os
 import re
+import time
+import threading
+import multiprocessing
 import urlparse
+from uuid import uuid4
+import bcrypt
+from redis import RedisError
 from urllib import urlencode as make_query_string
+try:
+    from collections import OrderedDict
+except ImportError:
+    from ordereddict import OrderedDict
 
 # --- Constants ---------------------------------------------------------------
 
@@ -59,3 +70,194 @@ def get_gravatar_md5sum(url):
     if len(md5sum) != 32:
         return None
     return md5sum
+
+
+# --- Caches ------------------------------------------------------------------
+
+class TTLCache(object):
+    """
+    Bounded, thread-safe, in-process cache. Entries expire ``ttl`` seconds after
+    they were stored and the least recently used entry is evicted when the cache
+    holds more than ``maxsize`` entries.
+
+    This cache is local to the process. Invalidations made in one worker are not
+    seen by other workers, so ``ttl`` is the upper bound on how stale an entry can be.
+
+    :param int maxsize: Maximum number of entries
+    :param int ttl: Time to live for each entry, in seconds
+    :param timer: Callable returning the current time in seconds (for tests)
+    """
+    def __init__(self, maxsize=1024, ttl=60, timer=time.time):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.timer = timer
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            return entry is not None and entry[0] > self.timer()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.pop(key, None)
+            if entry is not None and entry[0] > self.timer():
+                # Reinsert to mark as most recently used
+                self._data[key] = entry
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+            return default
+
+    def set(self, key, value):
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (self.timer() + self.ttl, value)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            entry = self._data.pop(key, None)
+        return entry[1] if entry is not None else default
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    @property
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return float(self.hits) / total if total else 0.0
+
+
+# --- Password hashing --------------------------------------------------------
+
+class PasswordHasherBusy(Exception):
+    """
+    Raised when a password hash can't be computed in time because every slot
+    for computing hashes is taken.
+    """
+    pass
+
+
+class PasswordHasher(object):
+    """
+    Bcrypt password hashing and verification. At most ``concurrency`` hashes are
+    computed at once by each process, so a burst of logins can't take every CPU
+    core on the host. If ``redis`` is given, the limit is instead shared by all
+    processes using that Redis server, falling back to the limit for each process
+    while Redis can't be reached. Callers waiting longer than ``timeout`` seconds
+    for a slot get :exc:`PasswordHasherBusy`.
+
+    In Redis, slots are members of a sorted set scored by the time they were
+    taken. A slot held for longer than ``lease`` seconds is presumed to belong to
+    a process that died while hashing, and is reclaimed.
+
+    :param int rounds: Bcrypt cost factor for new hashes
+    :param int concurrency: Maximum number of hashes computed at once (default: CPU cores on this host)
+    :param int timeout: Seconds to wait for a slot
+    :param int lease: Seconds after which a slot is reclaimed
+    :param redis: :class:`redis.StrictRedis` connection, or None
+    :param str key: Redis key for the slots
+    """
+    #: Poll interval while waiting for a slot, in seconds
+    poll_interval = 0.02
+
+    #: Reclaim slots taken before ARGV[1], then take slot ARGV[4] at time ARGV[3]
+    #: if fewer than ARGV[2] are held. Returns 1 if the slot was taken
+    acquire_script = """
+        redis.call('zremrangebyscore', KEYS[1], '-inf', ARGV[1])
+        if redis.call('zcard', KEYS[1]) < tonumber(ARGV[2]) then
+            redis.call('zadd', KEYS[1], ARGV[3], ARGV[4])
+            redis.call('expire', KEYS[1], math.ceil(ARGV[3] - ARGV[1]))
+            return 1
+        end
+        return 0
+        """
+
+    def __init__(self, rounds=12, concurrency=None, timeout=2, lease=60, redis=None, key='lastuser/bcrypt_slots'):
+        self.rounds = rounds
+        self.concurrency = concurrency or multiprocessing.cpu_count()
+        self.timeout = timeout
+        self.lease = lease
+        self.redis = redis
+        self.key = key
+        self._acquire_script = None
+        self._semaphore = None
+        self._semaphore_pid = None
+        self._local_slots = set()
+        self._lock = threading.Lock()
+
+    def _acquire(self, slot):
+        if self.redis is not None:
+            try:
+                if self._acquire_script is None:
+                    self._acquire_script = self.redis.register_script(self.acquire_script)
+                now = time.time()
+                return bool(self._acquire_script(keys=[self.key], args=[now - self.lease, self.concurrency, now, slot]))
+            except RedisError:
+                pass  # Limit this process on its own until Redis is back
+        with self._lock:
+            # A semaphore held in the parent stays held in the child, so make one in each process
+            if self._semaphore is None or self._semaphore_pid != os.getpid():
+                self._semaphore = threading.BoundedSemaphore(self.concurrency)
+                self._semaphore_pid = os.getpid()
+        if self._semaphore.acquire(False):
+            self._local_slots.add(slot)
+            return True
+        return False
+
+    def _release(self, slot):
+        if slot in self._local_slots:
+            self._local_slots.discard(slot)
+            self._semaphore.release()
+        else:
+            try:
+                self.redis.zrem(self.key, slot)
+            except RedisError:
+                pass  # The slot is reclaimed when its lease runs out
+
+    def _run(self, func, *args):
+        slot = uuid4().hex
+        deadline = time.time() + self.timeout
+        while not self._acquire(slot):
+            if time.time() >= deadline:
+                raise PasswordHasherBusy()
+            time.sleep(self.poll_interval)
+        try:
+            return func(*args)
+        finally:
+            self._release(slot)
+
+    def hash(self, password):
+        """
+        Return a new bcrypt hash for the password.
+        """
+        return self._run(lambda: bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt(self.rounds)))
+
+    def verify(self, password, pw_hash):
+        """
+        Check a password against a bcrypt hash.
+        """
+        pw_hash = pw_hash.encode('utf-8')
+        return self._run(lambda: bcrypt.hashpw(password.encode('utf-8'), pw_hash) == pw_hash)
+
+    def needs_rehash(self, pw_hash):
+        """
+        Does this hash use a cost factor other than ``rounds``, or an older algorithm?
+        """
+        parts = pw_hash.split('$')
+        # Bcrypt hashes look like $2b$12$<salt and hash>
+        return not (len(parts) == 4 and parts[0] == '' and parts[1].startswith('2') and
+            parts[2].isdigit() and int(parts[2]) == self.rounds)
+
+
+#: Password hasher for user accounts. Configured in :meth:`LastuserOAuthBlueprint.init_app`
+password_hasher = PasswordHasher()
@@ -1,14 +1,46 @@
 # -*- coding: utf-8 -*-
 
+import multiprocessing
 from itsdangerous import JSONWebSignatureSerializer
 from flask import Blueprint
 from flask_assets import Bundle
+from redis import StrictRedis
+from lastuser_core.search import autocomplete_cache
+from lastuser_core.janitor import janitor
+from lastuser_core.utils import password_hasher
 
 
 class LastuserOAuthBlueprint(Blueprint):
     def init_app(self, app):
         self.serializer = JSONWebSignatureSerializer(
             app.config.get('LASTUSER_SECRET_KEY') or app.config['SECRET_KEY'])
+        from .views.helpers import credential_access, session_access, active_users  # Views import this module, so import here
+        credential_access.interval = app.config.get('CLIENT_ACCESS_FLUSH_INTERVAL', 60)
+        credential_access.precision = app.config.get('CLIENT_ACCESS_PRECISION', 60)
+        session_access.interval = app.config.get('SESSION_ACCESS_FLUSH_INTERVAL', 60)
+        session_access.precision = app.config.get('SESSION_ACCESS_PRECISION', 300)
+        active_users.interval = app.config.get('ACTIVE_USERS_FLUSH_INTERVAL', 60)
+        autocomplete_cache.results.maxsize = app.config.get('AUTOCOMPLETE_CACHE_SIZE', 10000)
+        autocomplete_cache.results.ttl = app.config.get('AUTOCOMPLETE_CACHE_TTL', 300)
+        janitor.batch_size = app.config.get('JANITOR_BATCH_SIZE', 1000)
+        janitor.retention.update(app.config.get('JANITOR_RETENTION', {}))
+        janitor.partition_size = app.config.get('SESSION_PARTITION_SIZE')
+        password_hasher.rounds = app.config.get('BCRYPT_ROUNDS', 12)
+        password_hasher.concurrency = app.config.get('BCRYPT_CONCURRENCY') or multiprocessing.cpu_count()
+        password_hasher.timeout = app.config.get('BCRYPT_TIMEOUT', 2)
+        password_hasher.lease = app.config.get('BCRYPT_LEASE', 60)
+        password_hasher.redis = StrictRedis.from_url(app.config.get('REDIS_URL', 'redis://localhost:6379/0')
+            ) if app.config.get('BCRYPT_SHARED_LIMIT') else None
+        from .views.notify import notice_relay, webhook_delivery
+        notice_relay.interval = app.config.get('NOTIFY_DEBOUNCE', 5)
+        notice_relay.limit = app.config.get('NOTIFY_RELAY_BATCH', 1000)
+        webhook_delivery.concurrency = app.config.get('NOTIFY_CONCURRENCY', 10)
+        webhook_delivery.per_host = app.config.get('NOTIFY_PER_HOST', 2)
+        webhook_delivery.timeout = app.config.get('NOTIFY_TIMEOUT', 10)
+        webhook_delivery.retries = app.config.get('NOTIFY_RETRIES', 3)
+        webhook_delivery.backoff = app.config.get('NOTIFY_BACKOFF', 1)
+        webhook_delivery.failure_threshold = app.config.get('NOTIFY_FAILURE_THRESHOLD', 5)
+        webhook_delivery.reset_after = app.config.get('NOTIFY_RESET_AFTER', 60)
 
 
 lastuser_oauth = LastuserOAuthBlueprint('lastuser_oauth', __name__,
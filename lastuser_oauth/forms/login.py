@@ -7,6 +7,7 @@ from baseframe import _, __
 import baseframe.forms as forms
 
 from lastuser_core.models import User, UserEmail, getuser, Organization
+from lastuser_core.utils import PasswordHasherBusy
 
 
 class LoginPasswordResetException(Exception):
@@ -18,22 +19,28 @@ class LoginForm(forms.Form):
         widget_attrs={'autocorrect': 'none', 'autocapitalize': 'none'})
     password = forms.PasswordField(__("Password"), validators=[forms.validators.DataRequired()])
 
+    #: The user being logged in, looked up once by :meth:`validate_username`
+    user = None
+
     def validate_username(self, field):
-        existing = getuser(field.data)
-        if existing is None:
+        self.user = getuser(field.data)
+        if self.user is None:
             raise forms.ValidationError(_("User does not exist"))
 
     def validate_password(self, field):
         if not self.username.data:
             # Can't validate password without a user
             return
-        user = getuser(self.username.data)
+        user = self.user
         if user and not user.pw_hash:
             raise LoginPasswordResetException()
-        if user is None or not user.password_is(field.data):
+        try:
+            valid = user is not None and user.password_is(field.data)
+        except PasswordHasherBusy:
+            raise forms.ValidationError(_("We're receiving too many logins right now. Please try again"))
+        if not valid:
             if not self.username.errors:
                 raise forms.ValidationError(_("Incorrect password"))
-        self.user = user
 
 
 class RegisterForm(forms.Form):
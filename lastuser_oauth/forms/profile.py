@@ -6,6 +6,7 @@ from baseframe import _, __
 import baseframe.forms as forms
 
 from lastuser_core.models import UserEmail, getuser
+from lastuser_core.utils import PasswordHasherBusy
 
 timezones = sorted_timezones()
 
@@ -45,7 +46,11 @@ class PasswordChangeForm(forms.Form):
     def validate_old_password(self, field):
         if self.edit_user is None:
             raise forms.ValidationError(_("Not logged in"))
-        if not self.edit_user.password_is(field.data):
+        try:
+            valid = self.edit_user.password_is(field.data)
+        except PasswordHasherBusy:
+            raise forms.ValidationError(_("We're receiving too many requests right now. Please try again"))
+        if not valid:
             raise forms.ValidationError(_("Incorrect password"))
 
 
@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 
 import os
+import atexit
 from datetime import datetime, timedelta
 from functools import wraps
 from urllib import unquote
@@ -11,12 +12,78 @@ from coaster.sqlalchemy import failsafe_add
 from coaster.views import get_current_url
 from baseframe import _
 from lastuser_core.models import db, User, ClientCredential, UserSession
-from lastuser_core.signals import user_login, user_registered
+from lastuser_core.signals import user_login, user_registered, session_accessed
+from lastuser_core.tracking import AccessTracker, ActiveUserTracker
 from .. import lastuser_oauth
 from urlparse import urlparse
 
 valid_timezones = set(common_timezones)
 
+#: Last use of client credentials, written behind. Configured in :meth:`LastuserOAuthBlueprint.init_app`
+credential_access = AccessTracker(ClientCredential.__table__)
+
+#: Browser session access, written behind. Configured in :meth:`LastuserOAuthBlueprint.init_app`
+session_access = AccessTracker(UserSession.__table__)
+
+#: Daily active users, site-wide and per client. Configured in :meth:`LastuserOAuthBlueprint.init_app`
+active_users = ActiveUserTracker()
+
+
+@session_accessed.connect
+def _record_active_user(usersession, client=None):
+    active_users.record(usersession.user.userid, client.id if client is not None else None)
+
+
+def flush_trackers(due=True):
+    """
+    Write pending access records for this process. If ``due`` is True, only those
+    whose flush interval has passed.
+    """
+    for tracker in (credential_access, session_access, active_users):
+        if due:
+            tracker.flush_if_due()
+        else:
+            tracker.flush()
+
+
+@lastuser_oauth.teardown_app_request
+def flush_due_trackers(exc=None):
+    """
+    Flush access records at the end of a request once the interval has passed, so
+    a process that stops receiving requests doesn't hold them indefinitely.
+    """
+    try:
+        flush_trackers()
+    except Exception:
+        # Recording access is best effort, and must not fail the request
+        current_app.logger.exception("Could not flush access records")
+
+
+@atexit.register
+def flush_trackers_at_exit():
+    try:
+        flush_trackers(due=False)
+    except Exception:
+        # The database may be gone by now
+        pass
+
+
+def track_session_access(usersession):
+    """
+    Record an access to an existing user session, unless the last recorded access
+    (pending or stored) is recent and from the same IP address and User-Agent.
+    """
+    ipaddr = request.remote_addr or u''
+    user_agent = unicode(request.user_agent.string[:250]) or u''
+    last = session_access.pending(usersession.id) or {
+        'accessed_at': usersession.accessed_at, 'ipaddr': usersession.ipaddr, 'user_agent': usersession.user_agent}
+    if not (session_access.is_fresh(last['accessed_at']) and last['ipaddr'] == ipaddr and
+            last['user_agent'] == user_agent):
+        now = datetime.utcnow()
+        session_access.record(usersession.id, accessed_at=now, ipaddr=ipaddr, user_agent=user_agent,
+            updated_at=now)
+        active_users.record(usersession.user.userid)
+
 
 @lastuser_oauth.before_app_request
 def lookup_current_user():
@@ -46,8 +113,7 @@ def lookup_current_user():
     if 'sessionid' in lastuser_cookie:
         g.usersession = UserSession.authenticate(buid=lastuser_cookie['sessionid'])
         if g.usersession:
-            g.usersession.access()
-            db.session.commit()  # Save access
+            track_session_access(g.usersession)
             g.user = g.usersession.user
 
     # Transition users with 'userid' to 'sessionid'
@@ -176,9 +242,8 @@ def _client_login_inner():
     if credential is None or not credential.secret_is(request.authorization.password):
         return Response('Invalid client credentials', 401,
             {'WWW-Authenticate': 'Basic realm="Client credentials"'})
-    if credential:
-        credential.accessed_at = db.func.utcnow()
-        db.session.commit()
+    if not credential_access.is_fresh(credential.accessed_at):
+        credential_access.record(credential.id)
     g.client = credential.client
 
 
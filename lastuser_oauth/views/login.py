@@ -11,6 +11,7 @@ from baseframe import _, __
 from baseframe.forms import render_form, render_message, render_redirect
 
 from lastuser_core import login_registry
+from lastuser_core.utils import PasswordHasherBusy
 from .. import lastuser_oauth
 from ..mailclient import send_email_verify_link, send_password_reset_link
 from lastuser_core.models import db, User, UserEmailClaim, PasswordResetRequest, ClientCredential, UserSession
@@ -150,14 +151,18 @@ def register():
     form.email.description = current_app.config.get('EMAIL_REASON')
     form.username.description = current_app.config.get('USERNAME_REASON')
     if form.validate_on_submit():
-        user = register_internal(form.username.data, form.fullname.data, form.password.data)
-        useremail = UserEmailClaim(user=user, email=form.email.data)
-        db.session.add(useremail)
-        send_email_verify_link(useremail)
-        login_internal(user)
-        db.session.commit()
-        flash(_("You are now one of us. Welcome aboard!"), category='success')
-        return redirect(get_next_url(session=True), code=303)
+        try:
+            user = register_internal(form.username.data, form.fullname.data, form.password.data)
+        except PasswordHasherBusy:
+            form.password.errors.append(_("We're receiving too many requests right now. Please try again"))
+        else:
+            useremail = UserEmailClaim(user=user, email=form.email.data)
+            db.session.add(useremail)
+            send_email_verify_link(useremail)
+            login_internal(user)
+            db.session.commit()
+            flash(_("You are now one of us. Welcome aboard!"), category='success')
+            return redirect(get_next_url(session=True), code=303)
     return render_form(form=form, title=_("Create an account"), formid='register', submit=_("Register"),
         message=current_app.config.get('CREATE_ACCOUNT_MESSAGE'))
 
@@ -240,12 +245,16 @@ def reset_email(user, kwargs):
     form = PasswordResetForm()
     form.edit_user = user
     if form.validate_on_submit():
-        user.password = form.password.data
-        db.session.delete(resetreq)
-        db.session.commit()
-        return render_message(title=_("Password reset complete"), message=Markup(
-            _(u"Your password has been reset. You may now <a href=\"{loginurl}\">login</a> with your new password.").format(
-                loginurl=escape(url_for('.login')))))
+        try:
+            user.password = form.password.data
+        except PasswordHasherBusy:
+            form.password.errors.append(_("We're receiving too many requests right now. Please try again"))
+        else:
+            db.session.delete(resetreq)
+            db.session.commit()
+            return render_message(title=_("Password reset complete"), message=Markup(
+                _(u"Your password has been reset. You may now <a href=\"{loginurl}\">login</a> with your new password.").format(
+                    loginurl=escape(url_for('.login')))))
     return render_form(form=form, title=_("Reset password"), formid='reset', submit=_("Reset password"),
         message=Markup(_(u"Hello, <strong>{fullname}</strong>. You may now choose a new password.").format(
             fullname=escape(user.fullname))),
@@ -1,20 +1,149 @@
 # -*- coding: utf-8 -*-
 
-import requests
+import time
+from flask import current_app
 from flask_rq import job
-from lastuser_core.models import AuthToken
-from lastuser_core.signals import user_data_changed, org_data_changed, team_data_changed, session_revoked
+from sqlalchemy.orm import joinedload
+from lastuser_core.models import db, User, AuthToken, Client, ClientNotice, ClientTeamAccess, CLIENT_TEAM_ACCESS
+from lastuser_core.models.user import team_membership
+from lastuser_core.signals import (user_data_changed, org_data_changed, team_data_changed, team_members_added,
+    session_revoked)
+from lastuser_core.utils import OrderedDict
+from lastuser_core.delivery import WebhookDelivery, DeliveryError
 
 
 user_changes_to_notify = set(['merge', 'profile', 'email', 'email-claim', 'email-delete',
     'phone', 'phone-claim', 'phone-delete', 'team-membership'])
 
 
+class NoticeCoalescer(object):
+    """
+    Merges notices into one notice per client and subject (user, organization or
+    team), instead of one notice per change. Notices about users go to clients that
+    opt in to :attr:`Client.notify_multiple_users` as one notice per client, with
+    all the users in it. Logout notices are never merged, since each is about a
+    different session.
+    """
+    def __init__(self):
+        self._pending = OrderedDict()
+
+    def add(self, client, data):
+        """
+        Add a notice for the client. ``data`` is the notice, with a list of
+        ``changes``. Changes are merged with those of a pending notice on the same
+        subject. A merged notice for multiple users has a list of userids and the
+        changes for all of them.
+        """
+        multiple = data['type'] == 'user' and client.notify_multiple_users and 'sessionid' not in data
+        if multiple:
+            key = (client.id, 'user')
+        elif data['type'] == 'user':
+            key = (client.id, 'user', data['userid'], data.get('sessionid'))
+        else:
+            key = (client.id, data['type'], data['orgid'], data.get('teamid'))
+        notice = self._pending.get(key)
+        if notice is None:
+            notice = dict(data, changes=list(data['changes']))
+            if multiple:
+                notice['userid'] = [data['userid']]
+            self._pending[key] = (client.notification_uri, notice)
+        else:
+            notice = notice[1]
+            if multiple and data['userid'] not in notice['userid']:
+                notice['userid'].append(data['userid'])
+            notice['changes'].extend(change for change in data['changes'] if change not in notice['changes'])
+
+    def notices(self):
+        """
+        Return merged notices as a list of keyword arguments for :func:`send_notice`.
+        """
+        return [{'url': url, 'data': data} for url, data in self._pending.values()]
+
+
+class NoticeRelay(object):
+    """
+    Relays notices from the :class:`ClientNotice` outbox to the delivery queue.
+    Each call to :meth:`relay` takes up to ``limit`` notices, oldest first, merges
+    them with :class:`NoticeCoalescer`, enqueues them as one :func:`send_notices`
+    job and deletes them from the outbox, in one transaction. :meth:`run` relays
+    every ``interval`` seconds, so notices made within an interval are merged.
+
+    Since notices are added to the outbox in the same transaction as the change
+    they are about, notices are never sent for changes that were rolled back. If
+    the relay stops after enqueueing a batch but before it commits, the batch is
+    relayed again and clients may receive a notice twice.
+
+    :param int interval: Seconds between relays, unless the outbox is backlogged
+    :param int limit: Maximum number of notices relayed at once
+    """
+    def __init__(self, interval=5, limit=1000):
+        self.interval = interval
+        self.limit = limit
+
+    def relay(self, send=None):
+        """
+        Relay one batch of notices. Returns the number of notices taken from the outbox.
+
+        :param send: Callable that takes a list of notices (default :meth:`send_notices.delay`)
+        """
+        query = ClientNotice.query.order_by(ClientNotice.id).limit(self.limit)
+        if db.engine.dialect.name == 'postgresql':
+            # Concurrent relays skip each other's notices instead of waiting for them
+            query = query.with_for_update(skip_locked=True)
+        notices = query.all()
+        if not notices:
+            db.session.rollback()
+            return 0
+        clients = dict((client.id, client) for client in Client.query.filter(
+            Client.id.in_(set(notice.client_id for notice in notices))))
+        coalescer = NoticeCoalescer()
+        for notice in notices:
+            client = clients[notice.client_id]
+            if client.notification_uri:
+                coalescer.add(client, notice.data)
+        ClientNotice.query.filter(ClientNotice.id.in_([notice.id for notice in notices])).delete(
+            synchronize_session=False)
+        batch = coalescer.notices()
+        if batch:
+            (send or send_notices.delay)(batch)
+        db.session.commit()
+        return len(notices)
+
+    def run(self):
+        """
+        Relay notices until stopped.
+        """
+        while True:
+            try:
+                relayed = self.relay()
+            except Exception:
+                db.session.rollback()
+                current_app.logger.exception("Notice relay failed")
+                relayed = 0
+            if relayed < self.limit:
+                time.sleep(self.interval)
+
+
+#: Notice relay. Configured in :meth:`LastuserOAuthBlueprint.init_app`
+notice_relay = NoticeRelay()
+
+#: Delivery engine used by the notice jobs. Configured in :meth:`LastuserOAuthBlueprint.init_app`
+webhook_delivery = WebhookDelivery()
+
+
+def queue_notice(client_id, data):
+    """
+    Add a notice for the client to the outbox, in the current transaction. It is
+    sent by :data:`notice_relay` after the transaction is committed.
+    """
+    db.session.add(ClientNotice(client_id=client_id, data=data))
+
+
 @session_revoked.connect
 def notify_session_revoked(session):
     for client in session.clients:
         if client.notification_uri:
-            send_notice.delay(client.notification_uri, data={
+            queue_notice(client.id, {
                 'userid': session.user.userid,
                 'type': 'user',
                 'changes': ['logout'],
@@ -31,7 +160,7 @@ def notify_user_data_changed(user, changes):
     """
     if user_changes_to_notify & set(changes):
         # We have changes that apps need to hear about
-        for token in user.authtokens:
+        for token in AuthToken.query.filter_by(user=user).options(joinedload(AuthToken.client)):
             if token.is_valid() and token.client.notification_uri:
                 notify_changes = []
                 for change in changes:
@@ -48,38 +177,84 @@ def notify_user_data_changed(user, changes):
                                 'teams' in token.scope or 'teams/*' in token.scope):
                             notify_changes.append(change)
                 if notify_changes:
-                    send_notice.delay(token.client.notification_uri, data={
+                    queue_notice(token.client_id, {
                         'userid': user.userid,
                         'type': 'user',
                         'changes': notify_changes
                         })
 
 
+@team_members_added.connect
+def notify_team_members_added(team, user_ids):
+    """
+    Like :func:`notify_user_data_changed` with a ``team-membership`` change, for
+    many users at once. Finds apps to notify with one query for each thousand
+    users, and adds their notices to the outbox in bulk.
+    """
+    notices = []
+    for start in range(0, len(user_ids), 1000):
+        notices.extend({'client_id': client_id, 'data': {
+            'userid': userid,
+            'type': 'user',
+            'changes': ['team-membership'],
+            }} for client_id, userid in db.session.query(AuthToken.client_id, User.userid).join(
+                Client, AuthToken.client_id == Client.id).join(User, AuthToken.user_id == User.id).filter(
+                AuthToken.user_id.in_(user_ids[start:start + 1000]),
+                AuthToken.scope_includes(u'organizations', u'organizations/*', u'teams', u'teams/*'),
+                AuthToken.valid_clause(),
+                Client.notification_uri != None,  # NOQA
+                Client.notification_uri != u''))
+    if notices:
+        db.session.execute(ClientNotice.__table__.insert(), notices)
+
+
+def org_notice_recipients(org, user=None, team=None):
+    """
+    Return (client_id, userid) for each client app that should hear about a change
+    to the organization (or to one of its teams), in one query. These are apps that
+    accept notifications and hold valid tokens with the ``organizations`` scope from
+    the organization's owners. For changes to a team, apps must also have access to
+    the organization's teams, or hold a token with the ``teams`` scope from the user
+    who made the change. The userid is that of the user who made the change if they
+    are one of the owners with a token, else that of any owner with a token.
+    """
+    db.session.flush()  # The organization or team may be new
+    conditions = [
+        AuthToken.user_id.in_(db.select([team_membership.c.user_id]).where(
+            team_membership.c.team_id == org.owners_id)),
+        AuthToken.scope_includes(u'organizations', u'organizations/*'),
+        AuthToken.valid_clause(),
+        Client.notification_uri != None,  # NOQA
+        Client.notification_uri != u'',
+        ]
+    if team is not None:
+        team_access = Client.id.in_(db.select([ClientTeamAccess.client_id]).where(db.and_(
+            ClientTeamAccess.org_id == org.id, ClientTeamAccess.access_level == CLIENT_TEAM_ACCESS.ALL)))
+        if user is not None:
+            team_access = db.or_(team_access, Client.id.in_(
+                db.select([AuthToken.client_id]).where(db.and_(
+                    AuthToken.user_id == user.id, AuthToken.scope_includes(u'teams'))).correlate(None)))
+        conditions.append(team_access)
+    if user is not None:
+        by_user = db.func.max(db.case([(AuthToken.user_id == user.id, 1)], else_=0))
+    else:
+        by_user = db.literal(0)
+    return [(client_id, user.userid if notify_user else userid)
+        for client_id, userid, notify_user in db.session.query(
+            Client.id, db.func.min(User.userid), by_user).select_from(AuthToken).join(
+            Client, AuthToken.client_id == Client.id).join(
+            User, AuthToken.user_id == User.id).filter(*conditions).group_by(Client.id)]
+
+
 @org_data_changed.connect
 def notify_org_data_changed(org, user, changes, team=None):
     """
     Like :func:`notify_user_data_changed`, except we'll also look at
     all other owners of this org to find apps that need to be notified.
     """
-    client_users = {}
-    if team is not None:
-        team_access = set(org.clients_with_team_access()) | (set(user.clients_with_team_access()) if user else set())
-    else:
-        team_access = []
-    for token in AuthToken.all(users=org.owners.users):
-        if ('organizations' in token.scope or 'organizations/*' in token.scope) and token.client.notification_uri and token.is_valid():
-            if team is not None:
-                if token.client not in team_access:
-                    continue
-            client_users.setdefault(token.client, []).append(token.user)
-    # Now we have a list of clients to notify and a list of users to notify them with
-    for client, users in client_users.items():
-        if user is not None and user in users:
-            notify_user = user
-        else:
-            notify_user = users[0]  # First user available
-        send_notice.delay(client.notification_uri, data={
-            'userid': notify_user.userid,
+    for client_id, userid in org_notice_recipients(org, user, team):
+        queue_notice(client_id, {
+            'userid': userid,
             'type': 'org' if team is None else 'team',
             'orgid': org.userid,
             'teamid': team.userid if team is not None else None,
@@ -97,4 +272,18 @@ def notify_team_data_changed(team, user, changes):
 
 @job('lastuser')
 def send_notice(url, params=None, data=None, method='POST'):
-    requests.request(method, url, params=params, data=data)
+    webhook_delivery.deliver(url, params=params, data=data, method=method)
+
+
+@job('lastuser')
+def send_notices(notices):
+    """
+    Deliver a batch of notices concurrently. ``notices`` is a list of dicts with
+    keyword arguments for :func:`send_notice`. Returns delivery stats for this
+    worker; raises :exc:`DeliveryError` listing any notices that failed.
+    """
+    failures = [result for result in webhook_delivery.deliver_many(notices) if isinstance(result, DeliveryError)]
+    if failures:
+        raise DeliveryError("%d of %d notices failed: %s" % (
+            len(failures), len(notices), u'; '.join(unicode(failure) for failure in failures)))
+    return webhook_delivery.stats()
@@ -5,7 +5,7 @@ from coaster.utils import newsecret
 from coaster.sqlalchemy import failsafe_add
 from baseframe import _
 
-from lastuser_core.utils import make_redirect_url
+from lastuser_core.utils import make_redirect_url, PasswordHasherBusy
 from lastuser_core import resource_registry
 from lastuser_core.models import (db, User, AuthCode, AuthToken, UserFlashMessage,
     UserClientPermissions, TeamClientPermissions, getuser, Client, Resource, ClientCredential)
@@ -444,7 +444,11 @@ def oauth_token():
         user = getuser(username)
         if not user:
             return oauth_token_error('invalid_client', _("No such user"))  # XXX: invalid_client doesn't seem right
-        if not user.password_is(password):
+        try:
+            valid = user.password_is(password)
+        except PasswordHasherBusy:
+            return oauth_token_error('temporarily_unavailable', _("Too many logins right now. Please try again"))
+        if not valid:
             return oauth_token_error('invalid_client', _("Password mismatch"))
         # Validations 4.3: verify scope
         try:
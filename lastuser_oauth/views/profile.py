@@ -38,12 +38,12 @@ def profile_edit(newprofile=False):
                 useremail = UserEmailClaim(user=g.user, email=form.email.data)
                 db.session.add(useremail)
             send_email_verify_link(useremail)
-            db.session.commit()
             user_data_changed.send(g.user, changes=['profile', 'email-claim'])
+            db.session.commit()
             flash(_("Your profile has been updated. We sent you an email to confirm your address"), category='success')
         else:
-            db.session.commit()
             user_data_changed.send(g.user, changes=['profile'])
+            db.session.commit()
             flash(_("Your profile has been updated"), category='success')
 
         if newprofile:
@@ -91,8 +91,8 @@ def confirm_email(md5sum, secret):
             for claim in UserEmailClaim.query.filter(
                     UserEmailClaim.email.in_([useremail.email, useremail.email.lower()])).all():
                 db.session.delete(claim)
-            db.session.commit()
             user_data_changed.send(g.user, changes=['email'])
+            db.session.commit()
             return render_message(title=_("Email address verified"),
                 message=Markup(_(u"Hello <strong>{fullname}</strong>! "
                     u"Your email address <code>{email}</code> has now been verified").format(
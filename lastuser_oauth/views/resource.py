@@ -1,15 +1,24 @@
 # -*- coding: utf-8 -*-
 
 from urlparse import urlparse
+from hashlib import sha256
+from datetime import datetime
+from time import time
+from sqlalchemy import event as sqla_event, inspect as sqla_inspect
+from sqlalchemy.orm import Session
 from werkzeug.exceptions import BadRequest
-from flask import request, g, abort, render_template, jsonify
-from coaster.utils import getbool
+from flask import request, g, abort, render_template, jsonify, current_app
+from coaster.utils import getbool, buid
 from coaster.views import requestargs, jsonp
-from baseframe import _, __
+from baseframe import _, __, cache
 
-from lastuser_core.models import (db, getuser, User, Organization, AuthToken, Resource,
+from lastuser_core.models import (db, getuser, getusers, User, Organization, Team, AuthToken, Resource,
     ResourceAction, UserClientPermissions, TeamClientPermissions, UserSession, ClientCredential)
+from lastuser_core.models.user import team_membership
+from lastuser_core.signals import (user_data_changed, org_data_changed, team_data_changed, session_revoked,
+    model_user_edited, model_authtokens_migrated)
 from lastuser_core import resource_registry
+from lastuser_core.search import autocomplete_cache
 from .. import lastuser_oauth
 from .helpers import requires_client_login, requires_user_or_client_login, requires_client_id_or_user_or_client_login
 
@@ -37,15 +46,22 @@ def get_userinfo(user, client, scope=[], session=None, get_permissions=True):
         userinfo['email'] = unicode(user.email)
     if '*' in scope or 'phone' in scope or 'phone/*' in scope:
         userinfo['phone'] = unicode(user.phone)
-    if '*' in scope or 'organizations' in scope or 'organizations/*' in scope:
+
+    # Load all of the user's teams and orgs at once instead of walking user.teams
+    want_orgs = '*' in scope or 'organizations' in scope or 'organizations/*' in scope
+    want_teams = '*' in scope or 'teams' in scope or 'teams/*' in scope
+    if want_orgs or want_teams or (get_permissions and not client.user):
+        graph = user.organization_graph(owned_org_teams=want_teams)
+
+    if want_orgs:
         userinfo['organizations'] = {
-            'owner': [{'userid': org.userid, 'uuid': org.uuid, 'name': org.name, 'title': org.title, 'domain': org.domain} for org in user.organizations_owned()],
-            'member': [{'userid': org.userid, 'uuid': org.uuid, 'name': org.name, 'title': org.title, 'domain': org.domain} for org in user.organizations_memberof()],
-            'all': [{'userid': org.userid, 'uuid': org.uuid, 'name': org.name, 'title': org.title, 'domain': org.domain} for org in user.organizations()],
+            'owner': [{'userid': org.userid, 'uuid': org.uuid, 'name': org.name, 'title': org.title, 'domain': org.domain} for org in graph.owned],
+            'member': [{'userid': org.userid, 'uuid': org.uuid, 'name': org.name, 'title': org.title, 'domain': org.domain} for org in graph.memberof],
+            'all': [{'userid': org.userid, 'uuid': org.uuid, 'name': org.name, 'title': org.title, 'domain': org.domain} for org in graph.all],
             }
 
-    if '*' in scope or 'organizations' in scope or 'teams' in scope or 'organizations/*' in scope or 'teams/*' in scope:
-        for team in user.teams:
+    if want_orgs or want_teams:
+        for team in graph.teams:
             teams[team.userid] = {
                 'userid': team.userid,
                 'uuid': team.uuid,
@@ -53,24 +69,23 @@ def get_userinfo(user, client, scope=[], session=None, get_permissions=True):
                 'org': team.org.userid,
                 'org_uuid': team.org.uuid,
                 'domain': team.domain,
-                'owners': team == team.org.owners,
-                'members': team == team.org.members,
+                'owners': team.id == team.org.owners_id,
+                'members': team.id == team.org.members_id,
                 'member': True}
 
-    if '*' in scope or 'teams' in scope or 'teams/*' in scope:
-        for org in user.organizations_owned():
-            for team in org.teams:
-                if team.userid not in teams:
-                    teams[team.userid] = {
-                        'userid': team.userid,
-                        'uuid': team.uuid,
-                        'title': team.title,
-                        'org': team.org.userid,
-                        'org_uuid': team.org.uuid,
-                        'domain': team.domain,
-                        'owners': team == team.org.owners,
-                        'members': team == team.org.members,
-                        'member': False}
+    if want_teams:
+        for team in graph.owned_org_teams:
+            if team.userid not in teams:
+                teams[team.userid] = {
+                    'userid': team.userid,
+                    'uuid': team.uuid,
+                    'title': team.title,
+                    'org': team.org.userid,
+                    'org_uuid': team.org.uuid,
+                    'domain': team.domain,
+                    'owners': team.id == team.org.owners_id,
+                    'members': team.id == team.org.members_id,
+                    'member': False}
 
     if teams:
         userinfo['teams'] = teams.values()
@@ -82,9 +97,9 @@ def get_userinfo(user, client, scope=[], session=None, get_permissions=True):
                 userinfo['permissions'] = perms.access_permissions.split(u' ')
         else:
             permsset = set()
-            if user.teams:
+            if graph.teams:
                 perms = TeamClientPermissions.query.filter_by(client=client).filter(
-                    TeamClientPermissions.team_id.in_([team.id for team in user.teams])).all()
+                    TeamClientPermissions.team_id.in_([team.id for team in graph.teams])).all()
                 for permob in perms:
                     permsset.update(permob.access_permissions.split(u' '))
             userinfo['permissions'] = sorted(permsset)
@@ -121,8 +136,269 @@ def api_result(status, _jsonp=False, **params):
     return response
 
 
+def api_cached_result(params):
+    """
+    Like :func:`api_result` for a successful token verification, but allows the
+    resource server to cache the response for as long as it's valid.
+    """
+    response = jsonify(dict(params, status='ok'))
+    response.headers['Cache-Control'] = 'private, max-age=%d' % params['validity']
+    return response
+
+
+# --- Token verification cache ------------------------------------------------
+
+# Verification results are cached in the app's configured cache (CACHE_TYPE), shared
+# by all workers. Each result records the generations of its token and its user at
+# the time it was built. Changing a token assigns a new token generation, and changing
+# a user's data (or their orgs, teams, permissions or sessions) assigns a new userinfo
+# generation, which makes all cached results for that token or user stale without
+# having to find them. Results are never cached for longer than the token is valid.
+
+def token_cache_ttl():
+    return current_app.config.get('TOKEN_VERIFY_CACHE_TTL', 120)
+
+
+def token_cache_timeout(authtoken):
+    """
+    Seconds for which a result for this token may be cached: TOKEN_VERIFY_CACHE_TTL,
+    or less if the token expires sooner. Zero if it has expired.
+    """
+    timeout = token_cache_ttl()
+    if authtoken.expires_at is not None:
+        timeout = min(timeout, int((authtoken.expires_at - datetime.utcnow()).total_seconds()))
+    return max(timeout, 0)
+
+
+def token_cache_key(*parts):
+    return 'lastuser/token_result/' + sha256(u' '.join(parts).encode('utf-8')).hexdigest()
+
+
+def token_generation_key(token):
+    return 'lastuser/token_generation/%s' % token
+
+
+def userinfo_generation_key(user_id):
+    return 'lastuser/userinfo_generation/%s' % user_id
+
+
+def token_cache_generations(authtokens):
+    """
+    Return a dictionary of generation key: current generation (None if no generation
+    has been assigned yet) for the given tokens and their users. Read this *before*
+    building the results to be cached.
+    """
+    keys = set()
+    for authtoken in authtokens:
+        keys.add(token_generation_key(authtoken.token))
+        if authtoken.user is not None:
+            keys.add(userinfo_generation_key(authtoken.user.id))
+    keys = list(keys)
+    return dict(zip(keys, cache.get_many(*keys))) if keys else {}
+
+
+def get_cached_token_results(keys):
+    """
+    Return cached result params for each of the given keys, with None in place of
+    missing results and results for tokens or users that have changed since they were
+    cached. The validity in each result is the time it has left in the cache.
+    """
+    entries = cache.get_many(*keys) if keys else []
+    generation_keys = set()
+    for entry in entries:
+        if entry is not None:
+            generation_keys.add(token_generation_key(entry['token']))
+            if entry['user_id'] is not None:
+                generation_keys.add(userinfo_generation_key(entry['user_id']))
+    generation_keys = list(generation_keys)
+    generations = dict(zip(generation_keys, cache.get_many(*generation_keys))) if generation_keys else {}
+    now = time()
+    results = []
+    for entry in entries:
+        if entry is None or entry['expires_at'] <= now or (
+                generations[token_generation_key(entry['token'])] != entry['token_generation']) or (
+                entry['user_id'] is not None and
+                generations[userinfo_generation_key(entry['user_id'])] != entry['generation']):
+            results.append(None)
+        else:
+            results.append(dict(entry['params'], validity=int(entry['expires_at'] - now)))
+    return results
+
+
+def set_cached_token_results(results, generations):
+    """
+    Cache token results, each for the validity in its params. Results with no
+    validity left are not cached.
+
+    :param results: List of (key, authtoken, params) tuples
+    :param generations: Generations returned by :func:`token_cache_generations`
+    """
+    now = time()
+    by_timeout = {}
+    for key, authtoken, params in results:
+        if params['validity'] > 0:
+            user = authtoken.user
+            by_timeout.setdefault(params['validity'], {})[key] = {
+                'token': authtoken.token,
+                'token_generation': generations.get(token_generation_key(authtoken.token)),
+                'user_id': user.id if user is not None else None,
+                'generation': generations.get(userinfo_generation_key(user.id)) if user is not None else None,
+                'expires_at': now + params['validity'],
+                'params': params,
+                }
+    for timeout, entries in by_timeout.items():
+        cache.set_many(entries, timeout=timeout)
+
+
+def expire_cached_generations(keys):
+    """
+    Mark cached token results under the given generation keys as stale, now and
+    again after the current transaction commits. Changes are usually signalled
+    before they are committed, so a result cached in between is from the old data.
+    """
+    if keys:
+        cache.set_many({key: buid() for key in keys}, timeout=token_cache_ttl())
+        db.session.info.setdefault('token_cache_expiry', set()).update(keys)
+
+
+def expire_cached_userinfo(user_ids):
+    """
+    Mark cached token results for the given users as stale.
+    """
+    expire_cached_generations([userinfo_generation_key(user_id) for user_id in user_ids])
+
+
+def expire_cached_tokens(tokens):
+    """
+    Mark cached token results for the given token strings as stale.
+    """
+    expire_cached_generations([token_generation_key(token) for token in tokens])
+
+
+def _is_savepoint(session):
+    # These events also fire when a savepoint is released or rolled back
+    return session.transaction is not None and session.transaction.nested
+
+
+@sqla_event.listens_for(Session, 'after_commit')
+def _expire_committed_generations(session):
+    if _is_savepoint(session):
+        return
+    keys = session.info.pop('token_cache_expiry', None)
+    if keys:
+        cache.set_many({key: buid() for key in keys}, timeout=token_cache_ttl())
+
+
+@sqla_event.listens_for(Session, 'after_rollback')
+def _discard_generations(session):
+    if _is_savepoint(session):
+        return
+    # Nothing changed, so results cached during the transaction are still current
+    session.info.pop('token_cache_expiry', None)
+
+
+def org_user_ids(org):
+    """
+    Return ids of all users in any team in the given organization.
+    """
+    return [row.user_id for row in db.session.query(team_membership.c.user_id).join(
+        Team, Team.id == team_membership.c.team_id).filter(Team.org_id == org.id).distinct()]
+
+
+@user_data_changed.connect
+def expire_user_data_changed(user, changes):
+    expire_cached_userinfo([user.id])
+
+
+@model_user_edited.connect
+def expire_user_edited(user):
+    # Also catches the account merged away in a merge, which user_data_changed isn't sent for
+    expire_cached_userinfo([user.id])
+
+
+@org_data_changed.connect
+def expire_org_data_changed(org, user, changes, team=None):
+    expire_cached_userinfo(org_user_ids(org))
+
+
+@team_data_changed.connect
+def expire_team_data_changed(team, user, changes):
+    expire_cached_userinfo(org_user_ids(team.org))
+
+
+@session_revoked.connect
+def expire_session_revoked(session):
+    expire_cached_userinfo([session.user_id])
+
+
+@model_authtokens_migrated.connect
+def expire_authtokens_migrated(olduser, newuser, tokens):
+    expire_cached_tokens(tokens)
+    expire_cached_userinfo([olduser.id, newuser.id])
+
+
+@sqla_event.listens_for(AuthToken, 'after_update')
+def _expire_authtoken_edited(mapper, connection, target):
+    # The token string itself changes when a token is refreshed, so expire both old and new values
+    expire_cached_tokens(sqla_inspect(target).attrs.token.history.sum())
+
+
+@sqla_event.listens_for(AuthToken, 'after_delete')
+def _expire_authtoken_deleted(mapper, connection, target):
+    expire_cached_tokens([target.token])
+
+
+@sqla_event.listens_for(UserClientPermissions, 'after_insert')
+@sqla_event.listens_for(UserClientPermissions, 'after_update')
+@sqla_event.listens_for(UserClientPermissions, 'after_delete')
+def _expire_user_client_permissions(mapper, connection, target):
+    expire_cached_userinfo([target.user_id])
+
+
+@sqla_event.listens_for(TeamClientPermissions, 'after_insert')
+@sqla_event.listens_for(TeamClientPermissions, 'after_update')
+@sqla_event.listens_for(TeamClientPermissions, 'after_delete')
+def _expire_team_client_permissions(mapper, connection, target):
+    expire_cached_userinfo([user_id for user_id, in connection.execute(
+        db.select([team_membership.c.user_id]).where(team_membership.c.team_id == target.team_id))])
+
+
 # --- Client access endpoints -------------------------------------------------
 
+def split_client_resource(client_resource):
+    """
+    Split a client resource name into resource and action names. The action is None if
+    not specified. Raises ValueError if the name is not of the form ``resource[/action]``.
+    """
+    if '/' in client_resource:
+        parts = client_resource.split('/')
+        if len(parts) != 2:
+            raise ValueError(client_resource)
+        return tuple(parts)
+    return client_resource, None
+
+
+def token_has_client_resource(authtoken, client, client_resource):
+    """
+    Does the token grant access to this resource of this client, directly or via the namespace wildcard?
+    """
+    return (client.namespace + ':' + client_resource in authtoken.scope) or (
+        client.namespace + ':*' in authtoken.scope)
+
+
+def token_clientinfo(authtoken):
+    return {
+        'title': authtoken.client.title,
+        'userid': authtoken.client.owner.userid,
+        'buid': authtoken.client.owner.userid,
+        'uuid': authtoken.client.owner.uuid,
+        'owner_title': authtoken.client.owner.pickername,
+        'website': authtoken.client.website,
+        'key': authtoken.client.key,
+        'trusted': authtoken.client.trusted,
+        }
+
+
 @lastuser_oauth.route('/api/1/token/verify', methods=['POST'])
 @requires_client_login
 def token_verify():
@@ -135,22 +411,22 @@ def token_verify():
         # No token specified by caller
         return resource_error('no_token')
 
+    cache_key = token_cache_key(u'verify', unicode(g.client.id), token, client_resource)
+    params = get_cached_token_results([cache_key])[0]
+    if params is not None:
+        return api_cached_result(params)
+
     authtoken = AuthToken.get(token=token)
     if not authtoken:
         # No such auth token
         return api_result('error', error='no_token')
-    if (g.client.namespace + ':' + client_resource not in authtoken.scope) and (
-            g.client.namespace + ':*' not in authtoken.scope):
+    if not token_has_client_resource(authtoken, g.client, client_resource):
         # Token does not grant access to this resource
         return api_result('error', error='access_denied')
-    if '/' in client_resource:
-        parts = client_resource.split('/')
-        if len(parts) != 2:
-            return api_result('error', error='invalid_scope')
-        resource_name, action_name = parts
-    else:
-        resource_name = client_resource
-        action_name = None
+    try:
+        resource_name, action_name = split_client_resource(client_resource)
+    except ValueError:
+        return api_result('error', error='invalid_scope')
     if resource_name != '*':
         resource = Resource.get(resource_name, client=g.client)
         if not resource:
@@ -162,21 +438,120 @@ def token_verify():
                 return api_result('error', error='access_denied')
 
     # All validations passed. Token is valid for this client and scope. Return with information on the token
-    # TODO: Don't return validity. Set the HTTP cache headers instead.
-    params = {'validity': 120}  # Period (in seconds) for which this assertion may be cached.
-    if authtoken.user:
-        params['userinfo'] = get_userinfo(authtoken.user, g.client, scope=authtoken.scope)
-    params['clientinfo'] = {
-        'title': authtoken.client.title,
-        'userid': authtoken.client.owner.userid,
-        'buid': authtoken.client.owner.userid,
-        'uuid': authtoken.client.owner.uuid,
-        'owner_title': authtoken.client.owner.pickername,
-        'website': authtoken.client.website,
-        'key': authtoken.client.key,
-        'trusted': authtoken.client.trusted,
-        }
-    return api_result('ok', **params)
+    user = authtoken.user
+    generations = token_cache_generations([authtoken])
+    # Period (in seconds) for which this assertion may be cached. Also sent as Cache-Control: max-age
+    params = {'validity': token_cache_timeout(authtoken)}
+    if user:
+        params['userinfo'] = get_userinfo(user, g.client, scope=authtoken.scope)
+    params['clientinfo'] = token_clientinfo(authtoken)
+    set_cached_token_results([(cache_key, authtoken, params)], generations)
+    return api_cached_result(params)
+
+
+@lastuser_oauth.route('/api/1/token/verify_many', methods=['POST'])
+@requires_client_login
+def token_verify_many():
+    """
+    Verify many tokens in one call. Expects a JSON body of the form::
+
+        {"tokens": [{"access_token": "...", "resource": "..."}, ...]}
+
+    Returns ``results``, a list in the same order as ``tokens``, with each item
+    in the format returned by /api/1/token/verify. Items that are not strings
+    get the error ``invalid_request``.
+    """
+    pairs = (request.get_json(silent=True) or {}).get('tokens')
+    if not pairs or not isinstance(pairs, list):
+        return resource_error('no_token')
+    if len(pairs) > current_app.config.get('TOKEN_VERIFY_MANY_LIMIT', 1000):
+        return resource_error('too_many_tokens')
+
+    results = [None] * len(pairs)
+    pending = []  # (index, token, client_resource, cache_key)
+    for index, pair in enumerate(pairs):
+        token = pair.get('access_token') if isinstance(pair, dict) else None
+        client_resource = pair.get('resource') if isinstance(pair, dict) else None
+        if not client_resource:
+            results[index] = {'status': 'error', 'error': 'no_resource'}
+        elif not token:
+            results[index] = {'status': 'error', 'error': 'no_token'}
+        elif not isinstance(token, basestring) or not isinstance(client_resource, basestring):
+            results[index] = {'status': 'error', 'error': 'invalid_request'}
+        else:
+            pending.append((index, token, client_resource,
+                token_cache_key(u'verify', unicode(g.client.id), token, client_resource)))
+
+    # 1. Use cached results where available
+    misses = []
+    for item, params in zip(pending, get_cached_token_results([item[3] for item in pending])):
+        if params is not None:
+            results[item[0]] = dict(params, status='ok')
+        else:
+            misses.append(item)
+
+    # 2. Look up all remaining tokens, resources and actions with one query each
+    authtokens = {}
+    if misses:
+        authtokens = {authtoken.token: authtoken for authtoken in AuthToken.query.filter(
+            AuthToken.token.in_(set(item[1] for item in misses))).options(
+            db.joinedload('client'), db.joinedload('_user'), db.joinedload('user_session'))}
+    names = {}  # client_resource: (resource_name, action_name)
+    for index, token, client_resource, cache_key in misses:
+        authtoken = authtokens.get(token)
+        if authtoken is None:
+            results[index] = {'status': 'error', 'error': 'no_token'}
+        elif not token_has_client_resource(authtoken, g.client, client_resource):
+            results[index] = {'status': 'error', 'error': 'access_denied'}
+        else:
+            try:
+                names[client_resource] = split_client_resource(client_resource)
+            except ValueError:
+                results[index] = {'status': 'error', 'error': 'invalid_scope'}
+    resource_names = set(resource_name for resource_name, action_name in names.values() if resource_name != '*')
+    resources = {}
+    actions = set()
+    if resource_names:
+        resources = {resource.name: resource for resource in Resource.query.filter(
+            Resource.client == g.client, Resource.name.in_(resource_names))}
+        action_names = set(action_name for resource_name, action_name in names.values()
+            if resource_name in resources and action_name and action_name != '*')
+        if action_names:
+            actions = set((action.resource_id, action.name) for action in ResourceAction.query.filter(
+                ResourceAction.resource_id.in_([resource.id for resource in resources.values()]),
+                ResourceAction.name.in_(action_names)))
+
+    # 3. Build results for everything that passed validation, computing userinfo once per user and scope
+    valid = []
+    for index, token, client_resource, cache_key in misses:
+        if results[index] is not None:
+            continue
+        resource_name, action_name = names[client_resource]
+        if resource_name != '*':
+            if resource_name not in resources:
+                results[index] = {'status': 'error', 'error': 'access_denied'}
+                continue
+            if action_name and action_name != '*' and (resources[resource_name].id, action_name) not in actions:
+                results[index] = {'status': 'error', 'error': 'access_denied'}
+                continue
+        valid.append((index, authtokens[token], cache_key))
+
+    generations = token_cache_generations([authtoken for index, authtoken, cache_key in valid])
+    userinfos = {}
+    to_cache = []
+    for index, authtoken, cache_key in valid:
+        user = authtoken.user
+        params = {'validity': token_cache_timeout(authtoken)}
+        if user:
+            if (user.id, authtoken.scope) not in userinfos:
+                userinfos[(user.id, authtoken.scope)] = get_userinfo(user, g.client, scope=authtoken.scope)
+            params['userinfo'] = userinfos[(user.id, authtoken.scope)]
+        params['clientinfo'] = token_clientinfo(authtoken)
+        to_cache.append((cache_key, authtoken, params))
+        results[index] = dict(params, status='ok')
+    set_cached_token_results(to_cache, generations)
+
+    return api_result('ok', results=results)
 
 
 @lastuser_oauth.route('/api/1/token/get_scope', methods=['POST'])
@@ -187,6 +562,11 @@ def token_get_scope():
         # No token specified by caller
         return resource_error('no_token')
 
+    cache_key = token_cache_key(u'get_scope', unicode(g.client.id), token)
+    params = get_cached_token_results([cache_key])[0]
+    if params is not None:
+        return api_cached_result(params)
+
     authtoken = AuthToken.get(token=token)
     if not authtoken:
         # No such auth token
@@ -202,22 +582,16 @@ def token_get_scope():
         return api_result('error', error='no_access')
 
     # All validations passed. Token is valid for this client. Return with information on the token
-    # TODO: Don't return validity. Set the HTTP cache headers instead.
-    params = {'validity': 120}  # Period (in seconds) for which this assertion may be cached.
-    if authtoken.user:
-        params['userinfo'] = get_userinfo(authtoken.user, g.client, scope=authtoken.scope)
-    params['clientinfo'] = {
-        'title': authtoken.client.title,
-        'userid': authtoken.client.owner.userid,
-        'buid': authtoken.client.owner.userid,
-        'uuid': authtoken.client.owner.uuid,
-        'owner_title': authtoken.client.owner.pickername,
-        'website': authtoken.client.website,
-        'key': authtoken.client.key,
-        'trusted': authtoken.client.trusted,
-        'scope': client_resources,
-        }
-    return api_result('ok', **params)
+    user = authtoken.user
+    generations = token_cache_generations([authtoken])
+    # Period (in seconds) for which this assertion may be cached. Also sent as Cache-Control: max-age
+    params = {'validity': token_cache_timeout(authtoken)}
+    if user:
+        params['userinfo'] = get_userinfo(user, g.client, scope=authtoken.scope)
+    params['clientinfo'] = token_clientinfo(authtoken)
+    params['clientinfo']['scope'] = client_resources
+    set_cached_token_results([(cache_key, authtoken, params)], generations)
+    return api_cached_result(params)
 
 
 @lastuser_oauth.route('/api/1/resource/sync', methods=['POST'])
@@ -410,8 +784,7 @@ def user_getall(name):
     if not names:
         return api_result('error', error='no_name_provided')
     results = []
-    for name in names:
-        user = getuser(name)
+    for user in getusers(names):
         if user and user.userid not in userids:
             results.append({
                 'type': 'user',
@@ -441,7 +814,7 @@ def user_autocomplete():
     q = request.values.get('q', '')
     if not q:
         return api_result('error', error='no_query_provided')
-    users = User.autocomplete(q)
+    users = autocomplete_cache.autocomplete(q)
     result = [{
         'userid': u.userid,
         'buid': u.userid,
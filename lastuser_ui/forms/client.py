@@ -59,6 +59,10 @@ class RegisterClientForm(forms.Form):
         validators=[forms.validators.Optional(), forms.validators.URL()],
         description=__("When the user's data changes, Lastuser will POST a notice to this URL. "
         "Other notices may be posted too"))
+    notify_multiple_users = forms.BooleanField(__("Accept notices about multiple users"),
+        default=False,
+        description=__("Check this if your application can handle a notice with multiple userids. "
+        "Lastuser will then send one notice for changes to several users in quick succession"))
     iframe_uri = forms.URLField(__("IFrame URL"),
         validators=[forms.validators.Optional(), forms.validators.URL()],
         description=__("Front-end notifications URL. This is loaded in a hidden iframe to notify the app that the "
@@ -8,7 +8,7 @@ from baseframe.forms import render_form, render_redirect, render_delete_sqla
 from lastuser_core.models import (db, User, Client, Organization, Team, Permission, ClientCredential,
     UserClientPermissions, TeamClientPermissions, Resource, ResourceAction, ClientTeamAccess,
     CLIENT_TEAM_ACCESS)
-from lastuser_oauth.views.helpers import requires_login
+from lastuser_oauth.views.helpers import requires_login, credential_access
 from .. import lastuser_ui
 from ..forms import (RegisterClientForm, PermissionForm, UserPermissionAssignForm, ClientCredentialForm,
     TeamPermissionAssignForm, PermissionEditForm, ResourceForm, ResourceActionForm, ClientTeamAccessForm)
@@ -69,6 +69,8 @@ def client_new():
 @lastuser_ui.route('/apps/<key>')
 @load_model(Client, {'key': 'key'}, 'client', permission='view')
 def client_info(client):
+    # Write pending credential use so that "last used" is current (for this process at least)
+    credential_access.flush()
     if client.user:
         permassignments = UserClientPermissions.query.filter_by(client=client).all()
     else:
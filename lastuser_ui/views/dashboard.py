@@ -1,12 +1,14 @@
 # -*- coding: utf-8 -*-
 
+from datetime import datetime, timedelta
 from functools import wraps
 from collections import defaultdict
 from cStringIO import StringIO
 import unicodecsv
 from flask import g, current_app, abort, render_template
 
-from lastuser_core.models import db, User, USER_STATUS
+from lastuser_core.models import db, User, Client, ActiveUserSketch, USER_STATUS
+from lastuser_core.models.session import client_user_activity
 from .. import lastuser_ui
 
 
@@ -26,13 +28,12 @@ def requires_dashboard(f):
 @requires_dashboard
 def dashboard():
     user_count = User.query.filter_by(status=USER_STATUS.ACTIVE).count()
-    mau = db.session.query('mau').from_statement(db.text(
-        '''SELECT COUNT(DISTINCT(user_session.user_id)) AS mau FROM user_session, "user" WHERE user_session.user_id = "user".id AND "user".status = :status AND user_session.accessed_at >= (NOW() AT TIME ZONE 'UTC') - INTERVAL '30 days' '''
-        )).params(status=USER_STATUS.ACTIVE).first()[0]
 
     return render_template('dashboard.html',
         user_count=user_count,
-        mau=mau
+        dau=ActiveUserSketch.active_users(1),
+        wau=ActiveUserSketch.active_users(7),
+        mau=ActiveUserSketch.active_users(30)
         )
 
 
@@ -56,23 +57,31 @@ def dashboard_data_users_by_month():
 def dashboard_data_users_by_client():
     client_users = defaultdict(lambda: {'counts': {'hour': 0, 'day': 0, 'week': 0, 'month': 0, 'quarter': 0, 'halfyear': 0, 'year': 0}})
 
-    for label, interval in (
-            ('hour', '1 hour'),
-            ('day', '1 day'),
-            ('week', '1 week'),
-            ('month', '1 month'),
-            ('quarter', '3 months'),
-            ('halfyear', '6 months'),
-            ('year', '1 year'),
-            ):
-        clients = db.session.query('client_id', 'count', 'title', 'website').from_statement(db.text(
-            '''SELECT client_users.client_id, count(*) AS count, client.title AS title, client.website AS website FROM (SELECT user_session.user_id, session_client.client_id FROM user_session, session_client, "user" WHERE user_session.user_id = "user".id AND session_client.user_session_id = user_session.id AND "user".status = :status AND session_client.updated_at >= (NOW() AT TIME ZONE 'UTC') - INTERVAL :interval GROUP BY session_client.client_id, user_session.user_id) AS client_users, client WHERE client.id = client_users.client_id GROUP by client_users.client_id, client.title, client.website ORDER BY count DESC'''
-        )).params(status=USER_STATUS.ACTIVE, interval=interval).all()
-        for row in clients:
-            client_users[row.client_id]['title'] = row.title
-            client_users[row.client_id]['website'] = row.website
-            client_users[row.client_id]['id'] = row.client_id
-            client_users[row.client_id]['counts'][label] = row.count - sum(client_users[row.client_id]['counts'].values())
+    # Users are counted in the shortest period that includes their latest activity at the
+    # client, read from the rollup that update_client_user_activity maintains
+    now = datetime.utcnow()
+    periods = (
+        ('hour', timedelta(hours=1)),
+        ('day', timedelta(days=1)),
+        ('week', timedelta(weeks=1)),
+        ('month', timedelta(days=30)),
+        ('quarter', timedelta(days=91)),
+        ('halfyear', timedelta(days=182)),
+        ('year', timedelta(days=365)),
+        )
+    period = db.case([(client_user_activity.c.active_at >= now - interval, label) for label, interval in periods])
+    activity = db.session.query(client_user_activity.c.client_id, period.label('period')
+        ).join(User, User.id == client_user_activity.c.user_id
+        ).filter(User.status == USER_STATUS.ACTIVE, client_user_activity.c.active_at >= now - periods[-1][1]
+        ).subquery()
+    clients = db.session.query(Client.id, Client.title, Client.website, activity.c.period, db.func.count().label('count')
+        ).join(activity, activity.c.client_id == Client.id
+        ).group_by(Client.id, Client.title, Client.website, activity.c.period)
+    for row in clients:
+        client_users[row.id]['title'] = row.title
+        client_users[row.id]['website'] = row.website
+        client_users[row.id]['id'] = row.id
+        client_users[row.id]['counts'][row.period] = row.count
 
     users_by_client = sorted(client_users.values(), key=lambda r: sum(r['counts'].values()), reverse=True)
 
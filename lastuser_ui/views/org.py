@@ -48,8 +48,8 @@ def org_new():
         if g.user not in org.members.users:
             org.members.users.append(g.user)
         db.session.add(org)
-        db.session.commit()
         org_data_changed.send(org, changes=['new'], user=g.user)
+        db.session.commit()
         return render_redirect(url_for('.org_info', name=org.name), code=303)
     return render_form(form=form, title=_("New organization"), formid='org_new', submit=_("Create"), ajax=False)
 
@@ -71,8 +71,8 @@ def org_edit(org):
     form.title.description = current_app.config.get('ORG_TITLE_REASON')
     if form.validate_on_submit():
         form.populate_obj(org)
-        db.session.commit()
         org_data_changed.send(org, changes=['edit'], user=g.user)
+        db.session.commit()
         return render_redirect(url_for('.org_info', name=org.name), code=303)
     return render_form(form=form, title=_("Edit organization"), formid='org_edit', submit=_("Save"), ajax=False)
 
@@ -108,8 +108,8 @@ def team_new(org):
         team = Team(org=org)
         db.session.add(team)
         form.populate_obj(team)
-        db.session.commit()
         team_data_changed.send(team, changes=['new'], user=g.user)
+        db.session.commit()
         return render_redirect(url_for('.org_info', name=org.name), code=303)
     return render_form(form=form, title=_(u"Create new team"),
         formid='team_new', submit=_("Create"))
@@ -126,8 +126,8 @@ def team_edit(org, team):
     form = TeamForm(obj=team)
     if form.validate_on_submit():
         form.populate_obj(team)
-        db.session.commit()
         team_data_changed.send(team, changes=['edit'], user=g.user)
+        db.session.commit()
         return render_redirect(url_for('.org_info', name=org.name), code=303)
     return render_form(form=form,
         title=_(u"Edit team: {title}").format(title=team.title),
@@ -6,6 +6,7 @@ from baseframe import _
 from baseframe.forms import render_form, render_redirect, render_delete_sqla
 
 from lastuser_core.models import db, UserEmail, UserEmailClaim, UserPhone, UserPhoneClaim
+from lastuser_core.utils import PasswordHasherBusy
 from lastuser_core.signals import user_data_changed
 from lastuser_oauth.mailclient import send_email_verify_link
 from lastuser_oauth.views.helpers import requires_login
@@ -32,10 +33,14 @@ def change_password():
         form = PasswordChangeForm()
         form.edit_user = g.user
     if form.validate_on_submit():
-        g.user.password = form.password.data
-        db.session.commit()
-        flash(_("Your new password has been saved"), category='success')
-        return render_redirect(url_for('.profile'), code=303)
+        try:
+            g.user.password = form.password.data
+        except PasswordHasherBusy:
+            form.password.errors.append(_("We're receiving too many requests right now. Please try again"))
+        else:
+            db.session.commit()
+            flash(_("Your new password has been saved"), category='success')
+            return render_redirect(url_for('.profile'), code=303)
     return render_form(form=form, title=_("Change password"), formid='changepassword',
         submit=_("Change password"), ajax=True)
 
@@ -49,10 +54,10 @@ def add_email():
         if useremail is None:
             useremail = UserEmailClaim(user=g.user, email=form.email.data, type=form.type.data)
             db.session.add(useremail)
+            user_data_changed.send(g.user, changes=['email-claim'])
             db.session.commit()
         send_email_verify_link(useremail)
         flash(_("We sent you an email to confirm your address"), 'success')
-        user_data_changed.send(g.user, changes=['email-claim'])
         return render_redirect(url_for('.profile'), code=303)
     return render_form(form=form, title=_("Add an email address"), formid='email_add',
         submit=_("Add email"), ajax=True)
@@ -88,9 +93,9 @@ def add_phone():
             db.session.add(userphone)
         try:
             send_phone_verify_code(userphone)
+            user_data_changed.send(g.user, changes=['phone-claim'])
             db.session.commit()  # Commit after sending because send_phone_verify_code saves the message sent
             flash(_("We sent a verification code to your phone number"), 'success')
-            user_data_changed.send(g.user, changes=['phone-claim'])
             return render_redirect(url_for('.verify_phone', number=userphone.phone), code=303)
         except ValueError as e:
             db.session.rollback()
@@ -130,9 +135,9 @@ def verify_phone(phoneclaim):
             userphone = UserPhone(user=g.user, phone=phoneclaim.phone, gets_text=True, primary=primary)
             db.session.add(userphone)
             db.session.delete(phoneclaim)
+            user_data_changed.send(g.user, changes=['phone'])
             db.session.commit()
             flash(_("Your phone number has been verified"), 'success')
-            user_data_changed.send(g.user, changes=['phone'])
             return render_redirect(url_for('.profile'), code=303)
         else:
             db.session.delete(phoneclaim)
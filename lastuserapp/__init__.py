@@ -36,6 +36,7 @@ RQ(app)  # Pick up RQ configuration from the app
 baseframe.init_app(app, requires=['lastuser-oauth'],
     ext_requires=['baseframe-bs3', 'fontawesome>=4.0.0', 'jquery.cookie', 'timezone'])
 
+lastuser_core.resource_registry.init_app(app)
 lastuser_oauth.lastuser_oauth.init_app(app)
 lastuser_oauth.mailclient.mail.init_app(app)
 lastuser_oauth.views.login.oid.init_app(app)
@@ -11,7 +11,30 @@ from lastuser_core.models import db
 from lastuserapp import app
 
 
+def relay_notices():
+    """Relay notices to client apps from the outbox to the delivery queue"""
+    from lastuser_oauth.views.notify import notice_relay
+    notice_relay.run()
+
+
+def update_client_activity():
+    """Roll up recent client activity for the dashboard. Run this from cron at least hourly"""
+    from lastuser_core.models.session import update_client_user_activity
+    print "Updated activity for %d users and clients" % update_client_user_activity()
+    db.session.commit()
+
+
+def purge_expired():
+    """Delete expired codes, tokens, sessions and messages. Run this from cron"""
+    from lastuser_core.janitor import janitor
+    for name, count in janitor.purge().items():
+        print "%s: %d rows deleted" % (name, count)
+
+
 if __name__ == '__main__':
     db.init_app(app)
     manager = init_manager(app, db, lastuser_core=lastuser_core, lastuser_oauth=lastuser_oauth, lastuser_ui=lastuser_ui, lastuserapp=lastuserapp, models=models)
+    manager.command(relay_notices)
+    manager.command(update_client_activity)
+    manager.command(purge_expired)
     manager.run()
@@ -0,0 +1,26 @@
+"""User fullname search
+
+Revision ID: 1f2a9c7e0d34
+Revises: 3b8e54c4b5a6
+Create Date: 2026-10-17 10:02:17.530644
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '1f2a9c7e0d34'
+down_revision = '3b8e54c4b5a6'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    # pg_trgm provides the similarity() function used to rank autocomplete results.
+    # Creating an extension may need a superuser
+    op.execute(sa.DDL('CREATE EXTENSION IF NOT EXISTS pg_trgm;'))
+    op.execute(sa.DDL(
+        'CREATE INDEX ix_user_fullname_tsvector ON "user" USING gin (to_tsvector(\'simple\', fullname));'))
+
+
+def downgrade():
+    op.drop_index('ix_user_fullname_tsvector', table_name='user')
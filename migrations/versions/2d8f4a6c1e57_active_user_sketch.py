@@ -0,0 +1,33 @@
+"""Active user sketches
+
+Revision ID: 2d8f4a6c1e57
+Revises: 9c3e2f71b6a4
+Create Date: 2026-10-17 18:41:53.207115
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '2d8f4a6c1e57'
+down_revision = '9c3e2f71b6a4'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table('active_user_sketch',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('created_at', sa.DateTime(), nullable=False),
+        sa.Column('updated_at', sa.DateTime(), nullable=False),
+        sa.Column('day', sa.Date(), nullable=False),
+        sa.Column('client_id', sa.Integer(), nullable=True),
+        sa.Column('registers', sa.LargeBinary(), nullable=False),
+        sa.ForeignKeyConstraint(['client_id'], ['client.id'], ondelete='CASCADE'),
+        sa.PrimaryKeyConstraint('id')
+        )
+    op.create_index(op.f('ix_active_user_sketch_day'), 'active_user_sketch', ['day'], unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_active_user_sketch_day'), table_name='active_user_sketch')
+    op.drop_table('active_user_sketch')
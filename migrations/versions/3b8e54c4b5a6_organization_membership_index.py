@@ -0,0 +1,41 @@
+"""Organization membership index
+
+Revision ID: 3b8e54c4b5a6
+Revises: 83d3ede06c
+Create Date: 2026-10-17 09:12:41.208317
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '3b8e54c4b5a6'
+down_revision = '83d3ede06c'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table('organization_membership',
+        sa.Column('user_id', sa.Integer(), nullable=False),
+        sa.Column('org_id', sa.Integer(), nullable=False),
+        sa.Column('is_owner', sa.Boolean(), nullable=False),
+        sa.Column('is_member', sa.Boolean(), nullable=False),
+        sa.ForeignKeyConstraint(['org_id'], ['organization.id'], ondelete='CASCADE'),
+        sa.ForeignKeyConstraint(['user_id'], ['user.id'], ondelete='CASCADE'),
+        sa.PrimaryKeyConstraint('user_id', 'org_id')
+        )
+    op.create_index(op.f('ix_organization_membership_org_id'), 'organization_membership', ['org_id'], unique=False)
+    op.execute(sa.DDL('''
+        INSERT INTO organization_membership (user_id, org_id, is_owner, is_member)
+        SELECT team_membership.user_id, team.org_id,
+            bool_or(team.id = organization.owners_id), bool_or(team.id = organization.members_id)
+        FROM team_membership
+            JOIN team ON team_membership.team_id = team.id
+            JOIN organization ON team.org_id = organization.id
+        GROUP BY team_membership.user_id, team.org_id
+        '''))
+
+
+def downgrade():
+    op.drop_index(op.f('ix_organization_membership_org_id'), table_name='organization_membership')
+    op.drop_table('organization_membership')
@@ -0,0 +1,33 @@
+"""Client notice outbox
+
+Revision ID: 4e7c1b5d9a20
+Revises: 52c9ab1fe7d0
+Create Date: 2026-10-17 14:05:31.502114
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '4e7c1b5d9a20'
+down_revision = '52c9ab1fe7d0'
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+def upgrade():
+    op.create_table('client_notice',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('created_at', sa.DateTime(), nullable=False),
+        sa.Column('updated_at', sa.DateTime(), nullable=False),
+        sa.Column('client_id', sa.Integer(), nullable=False),
+        sa.Column('data', postgresql.JSON(), nullable=False),
+        sa.ForeignKeyConstraint(['client_id'], ['client.id'], ondelete='CASCADE'),
+        sa.PrimaryKeyConstraint('id')
+        )
+    op.create_index(op.f('ix_client_notice_client_id'), 'client_notice', ['client_id'], unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_client_notice_client_id'), table_name='client_notice')
+    op.drop_table('client_notice')
@@ -0,0 +1,24 @@
+"""Client notify multiple users
+
+Revision ID: 52c9ab1fe7d0
+Revises: 1f2a9c7e0d34
+Create Date: 2026-10-17 11:20:05.118730
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '52c9ab1fe7d0'
+down_revision = '1f2a9c7e0d34'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('client', sa.Column('notify_multiple_users', sa.Boolean(), nullable=False,
+        server_default=sa.sql.expression.false()))
+    op.alter_column('client', 'notify_multiple_users', server_default=None)
+
+
+def downgrade():
+    op.drop_column('client', 'notify_multiple_users')
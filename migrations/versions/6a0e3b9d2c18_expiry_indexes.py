@@ -0,0 +1,37 @@
+"""Token expiry and indexes for purging expired records
+
+Revision ID: 6a0e3b9d2c18
+Revises: 2d8f4a6c1e57
+Create Date: 2026-10-17 21:12:40.881364
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '6a0e3b9d2c18'
+down_revision = '2d8f4a6c1e57'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('authtoken', sa.Column('expires_at', sa.DateTime(), nullable=True))
+    op.execute(sa.DDL('''
+        UPDATE authtoken SET expires_at = created_at + validity * INTERVAL '1 second' WHERE validity != 0;
+        '''))
+    op.create_index(op.f('ix_authtoken_expires_at'), 'authtoken', ['expires_at'], unique=False)
+    op.create_index('ix_authcode_created_at', 'authcode', ['created_at'], unique=False)
+    op.create_index(op.f('ix_user_session_accessed_at'), 'user_session', ['accessed_at'], unique=False)
+    op.create_index(op.f('ix_user_session_revoked_at'), 'user_session', ['revoked_at'], unique=False)
+    op.create_index('ix_passwordresetrequest_created_at', 'passwordresetrequest', ['created_at'], unique=False)
+    op.create_index('ix_userflashmessage_created_at', 'userflashmessage', ['created_at'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_userflashmessage_created_at', table_name='userflashmessage')
+    op.drop_index('ix_passwordresetrequest_created_at', table_name='passwordresetrequest')
+    op.drop_index(op.f('ix_user_session_revoked_at'), table_name='user_session')
+    op.drop_index(op.f('ix_user_session_accessed_at'), table_name='user_session')
+    op.drop_index('ix_authcode_created_at', table_name='authcode')
+    op.drop_index(op.f('ix_authtoken_expires_at'), table_name='authtoken')
+    op.drop_column('authtoken', 'expires_at')
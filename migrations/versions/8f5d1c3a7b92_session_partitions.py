@@ -0,0 +1,144 @@
+"""Partitioned user sessions
+
+Revision ID: 8f5d1c3a7b92
+Revises: 6a0e3b9d2c18
+Create Date: 2026-10-18 10:03:17.655920
+
+On PostgreSQL, user_session is partitioned by ranges of id and session_client by
+the same ranges of user_session_id. Needs PostgreSQL 12 or later. The existing
+tables become the default partitions, so no rows are copied. Range partitions are
+created later by the janitor if SESSION_PARTITION_SIZE is set. A unique index on
+a partitioned table must include the partition key, so buid is kept unique in a
+user_session_buid table, filled by a trigger.
+"""
+
+# revision identifiers, used by Alembic.
+revision = '8f5d1c3a7b92'
+down_revision = '6a0e3b9d2c18'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+tables = (('user_session', 'id'), ('session_client', 'user_session_id'))
+
+
+def drop_references(bind):
+    """
+    Drop foreign keys to either table, returning them to be made again.
+    """
+    references = bind.execute(sa.text(
+        "SELECT conrelid::regclass::text, conname, pg_get_constraintdef(oid) FROM pg_constraint "
+        "WHERE contype = 'f' AND conparentid = 0 "
+        "AND confrelid IN ('user_session'::regclass, 'session_client'::regclass)")).fetchall()
+    for table, name, definition in references:
+        bind.execute(sa.text('ALTER TABLE {0} DROP CONSTRAINT {1}'.format(table, name)))
+    return references
+
+
+def add_references(bind, references):
+    for table, name, definition in references:
+        bind.execute(sa.text('ALTER TABLE {0} ADD CONSTRAINT {1} {2} NOT VALID'.format(table, name, definition)))
+        bind.execute(sa.text('ALTER TABLE {0} VALIDATE CONSTRAINT {1}'.format(table, name)))
+
+
+def describe(bind, table, key, references):
+    """
+    Return the table's primary key and foreign keys except references, as (name,
+    type, definition), its other indexes as (name, definition), and its sequence.
+    """
+    constraints = [(name, contype, definition) for name, contype, definition in bind.execute(sa.text(
+        "SELECT conname, contype, pg_get_constraintdef(oid) FROM pg_constraint "
+        "WHERE conrelid = to_regclass(:table) AND contype IN ('p', 'u', 'f')"), table=table)
+        if (table, name) not in [(ref[0], ref[1]) for ref in references]]
+    indexes = bind.execute(sa.text(
+        "SELECT indexname, indexdef FROM pg_indexes WHERE tablename = :table AND indexname NOT IN "
+        "(SELECT conname FROM pg_constraint WHERE conrelid = to_regclass(:table))"), table=table).fetchall()
+    sequence = bind.execute(sa.text("SELECT pg_get_serial_sequence(:table, :key)"),
+        table=table, key=key).scalar() if key == 'id' else None
+    return constraints, indexes, sequence
+
+
+def upgrade():
+    bind = op.get_bind()
+    if bind.dialect.name != 'postgresql':
+        return
+    if bind.dialect.server_version_info < (12,):
+        raise RuntimeError("Lastuser needs PostgreSQL 12 or later")
+    references = drop_references(bind)
+
+    for table, key in tables:
+        default = table + '_default'
+        constraints, indexes, sequence = describe(bind, table, key, references)
+        bind.execute(sa.text('ALTER TABLE {0} RENAME TO {1}'.format(table, default)))
+        for name, contype, definition in constraints:
+            if contype == 'p':
+                bind.execute(sa.text('ALTER TABLE {0} RENAME CONSTRAINT {1} TO {0}_pkey'.format(default, name)))
+            elif contype == 'u':  # buid, now unique in user_session_buid
+                bind.execute(sa.text('ALTER TABLE {0} DROP CONSTRAINT {1}'.format(default, name)))
+        for name, definition in indexes:
+            bind.execute(sa.text('ALTER INDEX {0} RENAME TO {0}_default'.format(name)))
+
+        bind.execute(sa.text('CREATE TABLE {0} (LIKE {1} INCLUDING DEFAULTS) PARTITION BY RANGE ({2})'.format(
+            table, default, key)))
+        for name, contype, definition in constraints:
+            if contype in ('p', 'f'):
+                bind.execute(sa.text('ALTER TABLE {0} ADD CONSTRAINT {1} {2}'.format(table, name, definition)))
+        for name, definition in indexes:
+            bind.execute(sa.text(definition))
+        if table == 'user_session':
+            bind.execute(sa.text('CREATE INDEX ix_user_session_buid ON user_session (buid)'))
+        if sequence:
+            bind.execute(sa.text('ALTER SEQUENCE {0} OWNED BY {1}.id'.format(sequence, table)))
+        bind.execute(sa.text('ALTER TABLE {0} ATTACH PARTITION {1} DEFAULT'.format(table, default)))
+
+    bind.execute(sa.text('''
+        CREATE TABLE user_session_buid (
+            buid VARCHAR(22) NOT NULL PRIMARY KEY,
+            user_session_id INTEGER NOT NULL REFERENCES user_session (id) ON DELETE CASCADE);
+        CREATE INDEX ix_user_session_buid_user_session_id ON user_session_buid (user_session_id);
+        INSERT INTO user_session_buid (buid, user_session_id) SELECT buid, id FROM user_session;
+        CREATE OR REPLACE FUNCTION user_session_buid() RETURNS trigger LANGUAGE plpgsql AS $$
+        BEGIN
+            IF TG_OP = 'INSERT' THEN
+                INSERT INTO user_session_buid (buid, user_session_id) VALUES (NEW.buid, NEW.id);
+            ELSIF NEW.buid IS DISTINCT FROM OLD.buid THEN
+                UPDATE user_session_buid SET buid = NEW.buid WHERE user_session_id = NEW.id;
+            END IF;
+            RETURN NULL;
+        END $$;
+        CREATE TRIGGER user_session_buid AFTER INSERT OR UPDATE OF buid ON user_session
+            FOR EACH ROW EXECUTE FUNCTION user_session_buid();
+        '''))
+    add_references(bind, references)
+
+
+def downgrade():
+    bind = op.get_bind()
+    if bind.dialect.name != 'postgresql':
+        return
+    bind.execute(sa.text('''
+        DROP TABLE user_session_buid;
+        DROP TRIGGER user_session_buid ON user_session;
+        DROP FUNCTION user_session_buid();
+        DROP INDEX ix_user_session_buid;
+        '''))
+    references = drop_references(bind)
+
+    # Copy rows back into plain tables, as partitions can't be merged
+    for table, key in tables:
+        plain = table + '_unpartitioned'
+        constraints, indexes, sequence = describe(bind, table, key, references)
+        bind.execute(sa.text('CREATE TABLE {0} (LIKE {1} INCLUDING DEFAULTS)'.format(plain, table)))
+        bind.execute(sa.text('INSERT INTO {0} SELECT * FROM {1}'.format(plain, table)))
+        if sequence:
+            bind.execute(sa.text('ALTER SEQUENCE {0} OWNED BY {1}.id'.format(sequence, plain)))
+        bind.execute(sa.text('DROP TABLE {0}'.format(table)))
+        bind.execute(sa.text('ALTER TABLE {0} RENAME TO {1}'.format(plain, table)))
+        for name, contype, definition in constraints:
+            bind.execute(sa.text('ALTER TABLE {0} ADD CONSTRAINT {1} {2}'.format(table, name, definition)))
+        for name, definition in indexes:
+            bind.execute(sa.text(definition))
+        if table == 'user_session':
+            bind.execute(sa.text('ALTER TABLE user_session ADD CONSTRAINT user_session_buid_key UNIQUE (buid)'))
+    add_references(bind, references)
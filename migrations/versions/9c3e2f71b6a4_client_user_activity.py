@@ -0,0 +1,31 @@
+"""Client user activity rollup
+
+Revision ID: 9c3e2f71b6a4
+Revises: 4e7c1b5d9a20
+Create Date: 2026-10-17 16:22:08.419302
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '9c3e2f71b6a4'
+down_revision = '4e7c1b5d9a20'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table('client_user_activity',
+        sa.Column('client_id', sa.Integer(), nullable=False),
+        sa.Column('user_id', sa.Integer(), nullable=False),
+        sa.Column('active_at', sa.DateTime(), nullable=False),
+        sa.ForeignKeyConstraint(['client_id'], ['client.id'], ondelete='CASCADE'),
+        sa.ForeignKeyConstraint(['user_id'], ['user.id'], ondelete='CASCADE'),
+        sa.PrimaryKeyConstraint('client_id', 'user_id')
+        )
+    op.create_index(op.f('ix_client_user_activity_active_at'), 'client_user_activity', ['active_at'], unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_client_user_activity_active_at'), table_name='client_user_activity')
+    op.drop_table('client_user_activity')
@@ -1,3 +1,5 @@
 #!/bin/bash
 
-rqworker -c rqinit lastuser
+# SimpleWorker runs jobs in the worker process instead of forking for each job,
+# so notice delivery keeps its connections and per-host state between jobs
+rqworker -c rqinit -w rq.worker.SimpleWorker lastuser
@@ -11,3 +11,7 @@ REDIS_HOST = r.hostname
 REDIS_PORT = r.port
 REDIS_PASSWORD = r.password
 REDIS_DB = 0
+
+# Jobs run in the worker process itself (see rq.sh), so give them the app's
+# context for database access and config
+app.app_context().push()
@@ -0,0 +1,16 @@
+# -*- coding: utf-8 -*-
+
+"""
+Benchmarks for the hot paths, against a SQLite database of synthetic data.
+
+Run from the repository root::
+
+    python -m tests.benchmarks.run --scale 10000
+
+See ``python -m tests.benchmarks.run --help`` for options. Results are
+compared with ``tests/benchmarks/baseline-<scale>.json`` if it exists, and
+the run fails if any benchmark makes more queries. Query counts are the same
+on any machine, but latency isn't, so it is only compared with
+``--check-latency``. Use that with a baseline saved with ``--save-baseline``
+on the same machine, passing it as ``--baseline``.
+"""
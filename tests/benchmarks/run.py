@@ -0,0 +1,264 @@
+# -*- coding: utf-8 -*-
+
+"""
+Run the benchmarks and compare them with a baseline. See the package docstring.
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import argparse
+from base64 import b64encode
+from urllib import urlencode
+from urlparse import urlparse, parse_qs
+from ..helpers import QueryCounter
+
+#: Default database, in the instance folder
+DATABASE = os.path.join('instance', 'benchmark-{scale}.db')
+#: Default baseline, next to this file
+BASELINE = os.path.join(os.path.dirname(__file__), 'baseline-{scale}.json')
+
+
+def enable_savepoints(engine):
+    """
+    Let pysqlite run SAVEPOINT, which :func:`coaster.sqlalchemy.failsafe_add` uses, by
+    having SQLAlchemy emit BEGIN instead of the driver.
+    """
+    from sqlalchemy import event
+
+    @event.listens_for(engine, 'connect')
+    def connect(dbapi_connection, connection_record):
+        dbapi_connection.isolation_level = None
+
+    @event.listens_for(engine, 'begin')
+    def begin(connection):
+        connection.connection.execute('BEGIN')
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))]
+
+
+class BenchmarkRunner(object):
+    """
+    Runs each benchmark ``iterations`` times after one warmup run, and records the
+    median and 95th percentile latency in milliseconds and the median number of
+    queries. Each run uses a different random user, so caches are cold.
+    """
+    def __init__(self, app, db, dataset, iterations=50, seed=0):
+        self.app = app
+        self.db = db
+        self.dataset = dataset
+        self.iterations = iterations
+        self.random = random.Random(seed)
+        self.client = app.test_client()
+        self.server_name = (app.config.get('SERVER_NAME') or 'localhost').split(':')[0]
+        self.results = {}
+        self._used = set([1])  # user1 owns the clients
+
+    def measure(self, name, run, setup=None):
+        """
+        Measure ``run(args)``, where ``args`` is returned by ``setup()`` outside the timing.
+        """
+        timings = []
+        queries = []
+        for iteration in xrange(self.iterations + 1):
+            args = setup() if setup is not None else None
+            self.db.session.remove()
+            with QueryCounter(self.db.engine) as counter:
+                started = time.time()
+                run(args)
+                elapsed = time.time() - started
+            self.db.session.remove()
+            if iteration:  # Skip the warmup
+                timings.append(elapsed * 1000)
+                queries.append(counter.count)
+        self.results[name] = {
+            'median_ms': round(percentile(timings, 0.5), 3),
+            'p95_ms': round(percentile(timings, 0.95), 3),
+            'queries': percentile(queries, 0.5),
+            }
+        print "%-32s %10.2f ms %10.2f ms %6d queries" % (
+            name, self.results[name]['median_ms'], self.results[name]['p95_ms'], self.results[name]['queries'])
+
+    def user_id(self, unused=False):
+        """
+        Return a random user id. If unused, one not returned before.
+        """
+        while True:
+            user_id = self.random.randint(1, self.dataset.scale)
+            if not unused or user_id not in self._used:
+                self._used.add(user_id)
+                return user_id
+
+    def token(self, client_key=None):
+        from lastuser_core.models import AuthToken, ClientCredential
+        client = ClientCredential.get(client_key or self.dataset.client_key).client
+        return AuthToken.query.filter_by(user_id=self.user_id(), client=client).one().token
+
+    def basic_auth(self, key=None, secret=None):
+        return {'Authorization': 'Basic ' + b64encode(
+            '%s:%s' % (key or self.dataset.client_key, secret or self.dataset.client_secret))}
+
+    def request(self, method, path, status=200, **kwargs):
+        response = self.client.open(path, method=method, **kwargs)
+        if response.status_code != status:
+            raise AssertionError("%s %s returned %d: %s" % (method, path, response.status_code, response.data[:500]))
+        return response
+
+    def run_all(self):
+        from lastuser_core.models import User, UserSession, AuthCode, ClientCredential, USER_STATUS, merge_users
+        from lastuser_core.search import autocomplete_cache
+        from lastuser_oauth import lastuser_oauth
+        from .seed import PASSWORD
+        client = ClientCredential.get(self.dataset.client_key).client
+        silent = ClientCredential.get(self.dataset.silent_key).client
+        redirect_uri = client.redirect_uri
+
+        self.measure('token_verify', lambda token: self.request('POST', '/api/1/token/verify',
+            data={'access_token': token, 'resource': 'data'}, headers=self.basic_auth()), self.token)
+        self.measure('token_get_scope', lambda token: self.request('POST', '/api/1/token/get_scope',
+            data={'access_token': token}, headers=self.basic_auth()), self.token)
+
+        def make_code():
+            code = AuthCode(user=User.query.get(self.user_id()), client=client, scope=[u'id'], redirect_uri=redirect_uri)
+            self.db.session.add(code)
+            self.db.session.commit()
+            return code.code
+        self.measure('token_authorization_code', lambda code: self.request('POST', '/token', data={
+            'grant_type': 'authorization_code', 'code': code, 'redirect_uri': redirect_uri, 'scope': 'id'},
+            headers=self.basic_auth()), make_code)
+        self.measure('token_password', lambda args: self.request('POST', '/token', data={
+            'grant_type': 'password', 'username': 'user1', 'password': PASSWORD, 'scope': 'id'},
+            headers=self.basic_auth()))
+        self.measure('token_client_credentials', lambda args: self.request('POST', '/token', data={
+            'grant_type': 'client_credentials', 'scope': 'id'}, headers=self.basic_auth()))
+
+        def login():
+            user_id = self.user_id()
+            usersession = UserSession.query.filter_by(user_id=user_id).first()
+            self.client.set_cookie(self.server_name, 'lastuser', lastuser_oauth.serializer.dumps(
+                {'sessionid': usersession.buid, 'userid': usersession.user.userid}))
+            return '/auth?' + urlencode({'client_id': self.dataset.silent_key, 'response_type': 'code',
+                'redirect_uri': silent.redirect_uri, 'scope': 'id'})
+
+        def silent_auth(path):
+            response = self.request('GET', path, status=303)
+            if 'code' not in parse_qs(urlparse(response.headers['Location']).query):
+                raise AssertionError("Authorization was not silent: %s" % response.headers['Location'])
+        self.measure('auth_silent', silent_auth, login)
+        self.client.delete_cookie(self.server_name, 'lastuser')
+
+        self.measure('api_id', lambda token: self.request('GET', '/api/1/id',
+            headers={'Authorization': 'Bearer ' + token}), self.token)
+        self.measure('user_get_by_userids', lambda userids: self.request('GET', '/api/1/user/get_by_userids?' + urlencode(
+            [('userid', userid) for userid in userids]), headers=self.basic_auth()),
+            lambda: [User.query.get(self.user_id()).userid for i in range(10)])
+
+        def autocomplete_query():
+            # Measure the search, not the result cache
+            autocomplete_cache.clear()
+            return u'user%d' % self.random.randint(100, 999)
+        self.measure('user_autocomplete', lambda q: self.request('GET', '/api/1/user/autocomplete?' + urlencode(
+            {'q': q}), headers=self.basic_auth()), autocomplete_query)
+
+        def unmerged_user_id():
+            # With --reuse, users merged by an earlier run are still merged
+            while True:
+                user_id = self.user_id(unused=True)
+                if User.query.get(user_id).status == USER_STATUS.ACTIVE:
+                    return user_id
+
+        def merge(user_ids):
+            merge_users(User.query.get(user_ids[0]), User.query.get(user_ids[1]))
+        self.measure('merge_users', merge, lambda: (unmerged_user_id(), unmerged_user_id()))
+        return self.results
+
+
+def compare(results, baseline, tolerance=None):
+    """
+    Return a list of regressions: benchmarks that make more queries than the
+    baseline, or if ``tolerance`` (a fraction) is given, whose median latency is
+    more than that much slower.
+    """
+    regressions = []
+    for name, result in sorted(results.items()):
+        base = baseline.get(name)
+        if base is None:
+            continue
+        if result['queries'] > base['queries']:
+            regressions.append("%s: %d queries, was %d" % (name, result['queries'], base['queries']))
+        if tolerance is not None and result['median_ms'] > base['median_ms'] * (1 + tolerance):
+            regressions.append("%s: %.2f ms, was %.2f ms" % (name, result['median_ms'], base['median_ms']))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark Lastuser's hot paths on synthetic data")
+    parser.add_argument('--scale', type=int, default=10000, help="Number of users (10000, 100000 or 1000000)")
+    parser.add_argument('--database', help="SQLite database path (default %s)" % DATABASE)
+    parser.add_argument('--reuse', action='store_true', help="Reuse the database from an earlier run at this scale")
+    parser.add_argument('--iterations', type=int, default=50, help="Runs of each benchmark (default 50)")
+    parser.add_argument('--output', help="Save results as JSON to this path")
+    parser.add_argument('--baseline', help="Baseline to compare with (default %s)" % BASELINE)
+    parser.add_argument('--save-baseline', action='store_true', help="Save results as the baseline")
+    parser.add_argument('--check-latency', action='store_true',
+        help="Also compare latency, with a baseline saved on this machine")
+    parser.add_argument('--tolerance', type=float, default=0.25,
+        help="Fraction by which median latency may exceed the baseline with --check-latency (default 0.25)")
+    args = parser.parse_args(argv)
+
+    database = os.path.abspath(args.database or DATABASE.format(scale=args.scale))
+    baseline_path = args.baseline or BASELINE.format(scale=args.scale)
+    # Configure the app before it's imported
+    os.environ.setdefault('FLASK_ENV', 'TESTING')
+    os.environ['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + database
+    from lastuserapp import app, db
+    from baseframe import cache
+    from .seed import SCALES, Dataset, seed
+
+    if args.scale not in SCALES:
+        parser.error("Scale must be one of %s" % ', '.join(str(scale) for scale in SCALES))
+    enable_savepoints(db.engine)
+    with app.test_request_context():
+        # Don't serve results cached by an earlier run
+        cache.clear()
+        dataset_path = database + '.json'
+        if args.reuse and os.path.exists(database) and os.path.exists(dataset_path):
+            with open(dataset_path) as f:
+                dataset = Dataset(**json.load(f))
+        else:
+            print "Seeding %d users in %s" % (args.scale, database)
+            dataset = seed(args.scale)
+            with open(dataset_path, 'w') as f:
+                json.dump(dataset._asdict(), f)
+        results = BenchmarkRunner(app, db, dataset, iterations=args.iterations).run_all()
+
+    report = {'scale': args.scale, 'iterations': args.iterations, 'results': results}
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True, separators=(',', ': '))
+    if args.save_baseline:
+        with open(baseline_path, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True, separators=(',', ': '))
+        print "Saved baseline to %s" % baseline_path
+        return 0
+    if not os.path.exists(baseline_path):
+        print "No baseline at %s to compare with" % baseline_path
+        return 0
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    if baseline['scale'] != args.scale:
+        print "Baseline is for scale %d, not comparing" % baseline['scale']
+        return 0
+    regressions = compare(results, baseline['results'], args.tolerance if args.check_latency else None)
+    for regression in regressions:
+        print "Regression: " + regression
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
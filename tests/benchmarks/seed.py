@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+
+"""
+Synthetic data for benchmarks
+"""
+
+from collections import namedtuple
+from datetime import datetime, timedelta
+from hashlib import md5
+from lastuser_core.models import (db, User, UserEmail, Organization, Client, ClientCredential, Resource,
+    AuthToken, UserSession)
+from lastuser_core.models.user import team_membership, refresh_organization_membership
+
+#: Supported scales, in number of users
+SCALES = (10000, 100000, 1000000)
+
+#: Password of user1, the only user with a password
+PASSWORD = 'benchmark'
+
+#: What a benchmark needs to know about the seeded database
+Dataset = namedtuple('Dataset', ['scale', 'client_key', 'client_secret', 'silent_key', 'silent_secret'])
+
+
+def chunks(start, stop, size):
+    for lower in xrange(start, stop, size):
+        yield xrange(lower, min(lower + size, stop))
+
+
+def seed(scale, batch=10000):
+    """
+    Create all tables in an empty database and fill them with ``scale`` users, each
+    with an email address, a session and a token for each of two clients, and one
+    organization for every 100 users, owned by the first and with all as members.
+    Rows are inserted in bulk, so user ids run from 1 to ``scale``.
+
+    There are two confidential clients: a trusted one with a resource, for the API
+    and token endpoints, and an untrusted one for silent authorization. Returns a
+    :class:`Dataset`.
+    """
+    db.drop_all()
+    db.create_all()
+    now = datetime.utcnow()
+
+    for ids in chunks(1, scale + 1, batch):
+        db.session.execute(User.__table__.insert(), [
+            {'username': u'user%d' % i, 'fullname': u'User %d' % i} for i in ids])
+        db.session.execute(UserEmail.__table__.insert(), [
+            {'user_id': i, 'email': u'user%d@example.com' % i, 'md5sum': md5('user%d@example.com' % i).hexdigest(),
+                'domain': u'example.com', 'primary': True} for i in ids])
+    user = User.query.get(1)
+    user.password = PASSWORD
+    # SQLite can't add an interval to utcnow() in SQL, as the password setter does
+    user.pw_set_at = now
+    user.pw_expires_at = now + timedelta(days=365)
+
+    orgs = [Organization(name=u'org%d' % i, title=u'Organization %d' % i) for i in xrange(scale // 100)]
+    db.session.add_all(orgs)
+    db.session.flush()
+    for index, org in enumerate(orgs):
+        first = index * 100 + 1
+        db.session.execute(team_membership.insert(), [{'team_id': org.owners_id, 'user_id': first}] + [
+            {'team_id': org.members_id, 'user_id': i} for i in xrange(first, first + 100)])
+    for index in xrange(0, len(orgs), 500):
+        refresh_organization_membership(db.session.connection(), org_ids=[org.id for org in orgs[index:index + 500]])
+
+    client = Client(title=u"Benchmark", user=user, confidential=True, trusted=True, namespace=u'benchmark',
+        website=u'http://benchmark.example.com', redirect_uri=u'http://benchmark.example.com/login/redirect')
+    silent = Client(title=u"Silent", user=user, confidential=True, namespace=u'silent',
+        website=u'http://silent.example.com', redirect_uri=u'http://silent.example.com/login/redirect')
+    db.session.add_all([client, silent, Resource(name=u'data', title=u"Data", client=client)])
+    cred, secret = ClientCredential.new(client)
+    silent_cred, silent_secret = ClientCredential.new(silent)
+    db.session.flush()
+
+    for ids in chunks(1, scale + 1, batch):
+        db.session.execute(UserSession.__table__.insert(), [
+            {'user_id': i, 'ipaddr': '127.0.0.1', 'user_agent': u'Benchmark', 'accessed_at': now} for i in ids])
+        db.session.execute(AuthToken.__table__.insert(), [
+            {'user_id': i, 'client_id': client.id, 'scope': u'id email organizations benchmark:data'} for i in ids] + [
+            {'user_id': i, 'client_id': silent.id, 'scope': u'id email'} for i in ids])
+    db.session.commit()
+    return Dataset(scale=scale, client_key=cred.name, client_secret=secret,
+        silent_key=silent_cred.name, silent_secret=silent_secret)
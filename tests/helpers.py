@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+
+"""
+Helpers shared by the unit tests and the benchmarks. This module doesn't import
+the app, so the benchmarks can configure it first.
+"""
+
+from sqlalchemy import event
+
+
+class QueryCounter(object):
+    """
+    Context manager that counts the SQL statements executed within it.
+
+    :param engine: Engine to count statements on (default the app's)
+    """
+    def __init__(self, engine=None):
+        self.engine = engine
+        self.count = 0
+
+    def __enter__(self):
+        if self.engine is None:
+            from lastuserapp import db  # Imported here so the app is configured first
+            self.engine = db.engine
+        self.count = 0
+        event.listen(self.engine, 'before_cursor_execute', self.before_cursor_execute)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        event.remove(self.engine, 'before_cursor_execute', self.before_cursor_execute)
+
+    def before_cursor_execute(self, *args):
+        self.count += 1
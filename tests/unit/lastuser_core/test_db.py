@@ -3,6 +3,7 @@
 import unittest
 from lastuserapp import app, db, init_for
 from .fixtures import Fixtures
+from ...helpers import QueryCounter  # NOQA
 
 
 class TestDatabaseFixture(unittest.TestCase):
@@ -11,6 +12,9 @@ class TestDatabaseFixture(unittest.TestCase):
         """
         Initialize a test DB and call to make fixtures.
         """
+        # Signal receivers use the app's config and cache
+        self.ctx = app.app_context()
+        self.ctx.push()
         init_for('testing')
         self.app = app
         db.create_all()
@@ -26,3 +30,4 @@ class TestDatabaseFixture(unittest.TestCase):
         db.session.rollback()
         db.drop_all()
         db.session.remove()
+        self.ctx.pop()
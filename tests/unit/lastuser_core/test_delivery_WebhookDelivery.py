@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+
+import unittest
+import threading
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+from lastuser_core.delivery import WebhookDelivery, DeliveryError, CircuitOpen
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class NoticeHandler(BaseHTTPRequestHandler):
+    """Stand-in client app. Responds with the status code in the path, as in /status/500"""
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self.server.requests.append(self.path)
+        status = int(self.path.split('/')[-1]) if self.path.startswith('/status/') else 200
+        self.send_response(status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class TestWebhookDelivery(unittest.TestCase):
+
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), NoticeHandler)
+        self.server.requests = []
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.base = 'http://127.0.0.1:%d' % self.server.server_address[1]
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_deliver_many(self):
+        delivery = WebhookDelivery(concurrency=4, per_host=2, retries=0)
+        notices = [{'url': self.base + '/notify', 'data': {'userid': str(i), 'changes': ['profile']}}
+            for i in range(10)]
+        results = delivery.deliver_many(notices)
+        self.assertEqual([r.status_code for r in results], [200] * 10)
+        stats = delivery.stats()
+        self.assertEqual(stats['delivered'], 10)
+        self.assertEqual(stats['failed'], 0)
+        self.assertTrue(stats['latency_max'] >= stats['latency_avg'] > 0)
+
+    def test_retry_and_circuit_breaker(self):
+        delivery = WebhookDelivery(retries=2, backoff=0.01, failure_threshold=3, reset_after=60)
+        with self.assertRaises(DeliveryError):
+            delivery.deliver(self.base + '/status/500', data={'changes': ['profile']})
+        # One attempt and two retries, after which the circuit is open
+        self.assertEqual(len(self.server.requests), 3)
+        self.assertEqual(delivery.stats()['retried'], 2)
+        with self.assertRaises(CircuitOpen):
+            delivery.deliver(self.base + '/notify', data={'changes': ['profile']})
+        self.assertEqual(len(self.server.requests), 3)
+        self.assertEqual(delivery.stats()['rejected'], 1)
+
+    def test_circuit_resets(self):
+        delivery = WebhookDelivery(retries=0, failure_threshold=1, reset_after=0)
+        with self.assertRaises(DeliveryError):
+            delivery.deliver(self.base + '/status/503')
+        # reset_after has passed, so the next delivery is attempted
+        self.assertEqual(delivery.deliver(self.base + '/notify').status_code, 200)
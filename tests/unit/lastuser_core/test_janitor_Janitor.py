@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+
+from datetime import datetime, timedelta
+from coaster.utils import buid
+from lastuserapp import db
+import lastuser_core.models as models
+from lastuser_core.models.session import session_client
+from lastuser_core.janitor import Janitor
+from .test_db import TestDatabaseFixture
+
+
+class TestJanitor(TestDatabaseFixture):
+
+    def test_purge(self):
+        """Test that only expired records are purged, in batches"""
+        client = self.fixtures.client
+        crusoe, oakley, piglet = self.fixtures.crusoe, self.fixtures.oakley, self.fixtures.piglet
+        now = datetime.utcnow()
+        old = now - timedelta(days=3)
+
+        def make_session(user, **kwargs):
+            return models.UserSession(user=user, ipaddr='192.168.1.7', buid=buid(), user_agent=u'Mozilla/5.0', **kwargs)
+
+        active_session = make_session(crusoe, accessed_at=now)
+        revoked_session = make_session(oakley, accessed_at=now - timedelta(days=40), revoked_at=now - timedelta(days=40))
+        idle_session = make_session(piglet, accessed_at=now - timedelta(days=400))
+        db.session.add_all([active_session, revoked_session, idle_session])
+        db.session.add_all([
+            models.AuthCode(user=crusoe, client=client, session=revoked_session, redirect_uri=u'http://example.com', scope=[u'id'], created_at=old),
+            models.AuthCode(user=crusoe, client=client, redirect_uri=u'http://example.com', scope=[u'id'], created_at=old, used=True),
+            models.AuthCode(user=crusoe, client=client, redirect_uri=u'http://example.com', scope=[u'id']),
+            models.AuthToken(user=oakley, client=client, scope=[u'id'], validity=60, created_at=old),
+            models.AuthToken(user=piglet, client=client, scope=[u'id'], validity=60),
+            models.AuthToken(user_session=revoked_session, client=client, scope=[u'id']),
+            models.PasswordResetRequest(user=crusoe, created_at=old),
+            models.PasswordResetRequest(user=crusoe),
+            models.UserFlashMessage(user=crusoe, category=u'info', message=u'Old', created_at=now - timedelta(days=8)),
+            models.UserFlashMessage(user=crusoe, category=u'info', message=u'New'),
+            ])
+        db.session.commit()
+        revoked_session.access(client=client)
+        db.session.commit()
+
+        # Only the expired token is matched by the expiry column
+        self.assertEqual(models.AuthToken.query.filter(models.AuthToken.valid_clause()).count(),
+            models.AuthToken.query.count() - 1)
+
+        counts = Janitor(batch_size=1).purge()
+        self.assertEqual(dict(counts), {
+            'authcode': 2,
+            'authtoken': 1,
+            'user_session': 2,
+            'passwordresetrequest': 1,
+            'userflashmessage': 1,
+            })
+        self.assertEqual(models.UserSession.query.all(), [active_session])
+        self.assertEqual(db.session.query(session_client).count(), 0)
+        self.assertEqual(models.AuthToken.query.filter_by(client=client).count(), 1)
+        self.assertEqual(models.AuthCode.query.count(), 1)
+        self.assertEqual([message.message for message in models.UserFlashMessage.query.all()], [u'New'])
+        # Nothing is left to purge
+        self.assertFalse(any(Janitor().purge().values()))
+
+    def test_purge_partitions(self):
+        """Test that session partitions are made ahead, and dropped once every session in them has ended"""
+        client, crusoe = self.fixtures.client, self.fixtures.crusoe
+        now = datetime.utcnow()
+        janitor = Janitor(partition_size=5, partitions_ahead=2)
+        self.assertEqual(janitor.session_partitions(), [])
+        janitor.purge(now)
+        partitions = janitor.session_partitions()
+        self.assertEqual([(lower, upper) for name, lower, upper in partitions], [
+            (janitor.last_session_id() + 1, janitor.last_session_id() + 6),
+            (janitor.last_session_id() + 6, janitor.last_session_id() + 11)])
+        self.assertEqual(janitor.purge(now)['user_session'], 0)
+        self.assertEqual(janitor.session_partitions(), partitions)
+
+        # Fill the first partition with ended sessions, and start the next
+        ended = [models.UserSession(user=crusoe, ipaddr='192.168.1.7', user_agent=u'Mozilla/5.0',
+            accessed_at=now - timedelta(days=400)) for i in range(5)]
+        db.session.add_all(ended)
+        db.session.commit()
+        ended_ids = [usersession.id for usersession in ended]
+        self.assertEqual(ended_ids, range(partitions[0][1], partitions[0][2]))
+        for usersession in ended:
+            usersession.access(client=client)
+            usersession.accessed_at = now - timedelta(days=400)
+            db.session.add(models.AuthToken(user_session=usersession, client=client, scope=[u'id']))
+        active = models.UserSession(user=crusoe, ipaddr='192.168.1.7', user_agent=u'Mozilla/5.0', accessed_at=now)
+        db.session.add(active)
+        db.session.commit()
+
+        self.assertEqual(janitor.purge(now)['user_session'], 5)
+        self.assertEqual(models.UserSession.query.filter(models.UserSession.id.in_(ended_ids)).count(), 0)
+        self.assertEqual(models.AuthToken.query.filter(models.AuthToken.user_session_id.in_(ended_ids)).count(), 0)
+        self.assertEqual(db.session.execute(db.text(
+            "SELECT to_regclass('session_client_p%d')" % partitions[0][1])).scalar(), None)
+        self.assertEqual(models.UserSession.get(active.buid), active)
+        # The active session's partition stays, and another is made ahead
+        self.assertEqual([(lower, upper) for name, lower, upper in janitor.session_partitions()], [
+            (partitions[1][1], partitions[1][2]), (partitions[1][2], partitions[1][2] + 5)])
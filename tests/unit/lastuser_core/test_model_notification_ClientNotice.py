@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+
+from lastuserapp import db
+import lastuser_core.models as models
+from lastuser_oauth.views.notify import NoticeRelay, queue_notice, org_notice_recipients
+from .test_db import TestDatabaseFixture
+
+
+class TestClientNotice(TestDatabaseFixture):
+
+    def test_rollback(self):
+        """Test that notices are discarded along with the transaction they were added in"""
+        queue_notice(self.fixtures.client.id, {'userid': self.fixtures.crusoe.userid, 'type': 'user', 'changes': ['profile']})
+        db.session.rollback()
+        self.assertEqual(models.ClientNotice.query.count(), 0)
+
+    def test_relay(self):
+        """Test that the relay merges notices, hands them over in one batch and clears the outbox"""
+        client = self.fixtures.client
+        client.notification_uri = u'https://example.com/notify'
+        db.session.commit()
+        crusoe = self.fixtures.crusoe.userid
+        oakley = self.fixtures.oakley.userid
+        queue_notice(client.id, {'userid': crusoe, 'type': 'user', 'changes': ['profile']})
+        queue_notice(client.id, {'userid': oakley, 'type': 'user', 'changes': ['phone']})
+        queue_notice(client.id, {'userid': crusoe, 'type': 'user', 'changes': ['email', 'profile']})
+        db.session.commit()
+
+        batches = []
+        relay = NoticeRelay(limit=1000)
+        self.assertEqual(relay.relay(send=batches.append), 3)
+        self.assertEqual(batches, [[
+            {'url': client.notification_uri,
+                'data': {'userid': crusoe, 'type': 'user', 'changes': ['profile', 'email']}},
+            {'url': client.notification_uri,
+                'data': {'userid': oakley, 'type': 'user', 'changes': ['phone']}},
+            ]])
+        self.assertEqual(models.ClientNotice.query.count(), 0)
+        self.assertEqual(relay.relay(send=batches.append), 0)
+        self.assertEqual(len(batches), 1)
+
+    def test_org_notice_recipients(self):
+        """Test that org and team notices go to apps with the org owners' tokens"""
+        crusoe = self.fixtures.crusoe
+        batdog = self.fixtures.batdog
+        client = self.fixtures.client
+        client.notification_uri = u'https://example.com/notify'
+        other = models.Client(title=u"Other", user=crusoe, website=u"http://example.com", confidential=True,
+            notification_uri=u'https://example.com/other')
+        silent = models.Client(title=u"Silent", user=crusoe, website=u"http://example.com", confidential=True)
+        db.session.add_all([other, silent])
+        db.session.add_all([
+            models.AuthToken(client=client, user=crusoe, scope=[u'id', u'organizations']),
+            models.AuthToken(client=other, user=crusoe, scope=[u'organizations/*']),
+            models.AuthToken(client=silent, user=crusoe, scope=[u'organizations']),
+            # Not an owner of batdog
+            models.AuthToken(client=other, user=self.fixtures.oakley, scope=[u'organizations']),
+            ])
+        db.session.flush()
+
+        self.assertEqual(sorted(org_notice_recipients(batdog, crusoe)),
+            sorted([(client.id, crusoe.userid), (other.id, crusoe.userid)]))
+        # Only the batdog client has access to batdog's teams
+        self.assertEqual(org_notice_recipients(batdog, None, team=self.fixtures.dachshunds),
+            [(client.id, crusoe.userid)])
+        db.session.rollback()
@@ -195,6 +195,72 @@ class TestOrganization(TestDatabaseFixture):
         self.assertEqual(erudite.domain, u'erudites.com')
         self.assertItemsEqual(erudite.teams, [erudite.owners, erudite.members])
 
+    def test_organization_domain_members(self):
+        """
+        Test that users with email addresses at the domain join the members team on commit
+        """
+        dauntless = models.Organization(name=u'dauntless', title=u'Dauntless')
+        eric = models.User(username=u'eric', fullname=u'Eric')
+        four = models.User(username=u'four', fullname=u'Four')
+        max = models.User(username=u'max', fullname=u'Max')
+        dauntless.owners.users.append(max)
+        db.session.add_all([dauntless, eric, four, max,
+            models.UserEmail(email=u'eric@dauntless.org', user=eric),
+            models.UserEmail(email=u'four@dauntless.org', user=four),
+            models.UserEmail(email=u'four@candor.org', user=four),
+            models.UserEmail(email=u'max@dauntless.org', user=max)])
+        db.session.commit()
+        dauntless.members.users.append(four)
+        dauntless.domain = u'dauntless.org'
+        self.assertEqual(dauntless.members.users.count(), 1)
+        db.session.commit()
+        self.assertItemsEqual(dauntless.members.users.all(), [eric, four, max])
+        self.assertIn(dauntless, eric.organizations_memberof())
+
+    def test_organization_domain_members_savepoint(self):
+        """
+        Test that domain members are added when the transaction commits, not when a savepoint ends
+        """
+        abnegation = models.Organization(name=u'abnegation', title=u'Abnegation')
+        tris = models.User(username=u'tris', fullname=u'Tris')
+        db.session.add_all([abnegation, tris, models.UserEmail(email=u'tris@abnegation.org', user=tris)])
+        db.session.commit()
+        abnegation.domain = u'abnegation.org'
+        db.session.begin_nested()
+        db.session.rollback()  # As failsafe_add does on an IntegrityError
+        db.session.begin_nested()
+        db.session.commit()
+        self.assertEqual(abnegation.members.users.count(), 0)
+        self.assertIn('domain_teams', db.session.info)
+        db.session.commit()
+        self.assertItemsEqual(abnegation.members.users.all(), [tris])
+
+    def test_insert_domain_members(self):
+        """
+        Test that domain members are counted, then added once, with the added rows returned
+        """
+        amity = models.Organization(name=u'amity_insert', title=u'Amity')
+        johanna = models.User(username=u'johanna', fullname=u'Johanna')
+        robert = models.User(username=u'robert', fullname=u'Robert')
+        db.session.add_all([amity, johanna, robert,
+            models.UserEmail(email=u'johanna@amity-insert.org', user=johanna),
+            models.UserEmail(email=u'robert@amity-insert.org', user=robert)])
+        db.session.commit()
+        team = models.Team(title=u'Orchard', org=amity)
+        db.session.add(team)
+        db.session.flush()
+        team.domain = u'amity-insert.org'  # Set after the flush, so joining is left to us
+        db.session.flush()
+        connection = db.session.connection()
+        self.assertEqual(models.user.count_domain_members(connection, team_ids=[team.id]), 2)
+        self.assertEqual(models.user.count_domain_members(connection, team_ids=[team.id], limit=1), 1)
+        self.assertItemsEqual(models.user.insert_domain_members(connection, team_ids=[team.id]),
+            [(johanna.id, team.id), (robert.id, team.id)])
+        self.assertEqual(models.user.insert_domain_members(connection, team_ids=[team.id]), [])
+        self.assertEqual(models.user.count_domain_members(connection, team_ids=[team.id]), 0)
+        db.session.commit()
+        self.assertItemsEqual(team.users, [johanna, robert])
+
     def test_organization_name(self):
         """
         Test for retrieving Organization's name
@@ -2,10 +2,12 @@
 
 from lastuserapp import db
 import lastuser_core.models as models
-from .test_db import TestDatabaseFixture
+from .test_db import TestDatabaseFixture, QueryCounter
 from sqlalchemy.orm.collections import InstrumentedList
 from datetime import datetime, timedelta
 import time
+from werkzeug.security import generate_password_hash
+from lastuser_core.utils import password_hasher
 
 
 class TestUser(TestDatabaseFixture):
@@ -140,6 +142,81 @@ class TestUser(TestDatabaseFixture):
         self.assertIsInstance(result, list)
         self.assertItemsEqual(result, [batdog.id])
 
+    def test_user_organization_membership_index(self):
+        """
+        Test that organization roles follow changes to team membership
+        """
+        boxer = models.User(username=u'boxer', fullname=u'Boxer')
+        org = models.Organization(name=u'windmill', title=u'Windmill')
+        db.session.add_all([boxer, org])
+        db.session.commit()
+        self.assertEqual(boxer.organizations(), [])
+
+        org.members.users.append(boxer)
+        db.session.commit()
+        self.assertEqual(boxer.organizations_memberof_ids(), [org.id])
+        self.assertEqual(boxer.organizations_owned_ids(), [])
+
+        boxer.teams.append(org.owners)
+        db.session.commit()
+        self.assertEqual(boxer.organizations_owned(), [org])
+
+        # Reassigning the owners team changes who owns the organization
+        old_owners = org.owners
+        org.owners = models.Team(title=u'New owners', org=org)
+        db.session.commit()
+        self.assertEqual(boxer.organizations_owned(), [])
+        self.assertEqual(boxer.organizations(), [org])
+
+        boxer.teams.remove(old_owners)
+        boxer.teams.remove(org.members)
+        db.session.commit()
+        self.assertEqual(boxer.organizations(), [])
+
+    def test_user_organization_graph(self):
+        """
+        Test that the organization graph matches the individual organization lists
+        """
+        oakley = self.fixtures.oakley
+        graph = oakley.organization_graph(owned_org_teams=True)
+        self.assertItemsEqual(graph.teams, oakley.teams)
+        self.assertEqual(graph.owned, oakley.organizations_owned())
+        self.assertEqual(graph.memberof, oakley.organizations_memberof())
+        self.assertEqual(graph.all, oakley.organizations())
+        self.assertItemsEqual(graph.owned_org_teams, [team for org in graph.owned for team in org.teams])
+
+    def test_user_organization_graph_query_count(self):
+        """
+        Test that loading the organization graph takes the same number of queries
+        however many organizations the user is in
+        """
+        def count_queries(user):
+            db.session.expire_all()
+            with QueryCounter() as counter:
+                graph = user.organization_graph(owned_org_teams=True)
+                for org in graph.all:
+                    org.domain
+                for team in graph.teams + graph.owned_org_teams:
+                    team.org.userid
+            return counter.count
+
+        snowball = models.User(username=u'snowball', fullname=u'Snowball')
+        db.session.add(snowball)
+        org = models.Organization(name=u'animalfarm', title=u'Animal Farm')
+        org.owners.users.append(snowball)
+        db.session.add(org)
+        db.session.commit()
+        baseline = count_queries(snowball)
+
+        for counter in range(10):
+            org = models.Organization(name=u'farm%d' % counter, title=u'Farm %d' % counter)
+            org.owners.users.append(snowball)
+            org.members.users.append(snowball)
+            db.session.add(org)
+            db.session.add(models.Team(title=u'Pigs', org=org))
+        db.session.commit()
+        self.assertEqual(count_queries(snowball), baseline)
+
     def test_user_available_permissions(self):
         """
         Test for verifying all permission objects available to a user
@@ -292,6 +369,28 @@ class TestUser(TestDatabaseFixture):
         dumbeldore_password=u'dissendium'
         dumbeldore._set_password(password=dumbeldore_password)
         self.assertTrue(dumbeldore.password_is(dumbeldore_password))
+        # scenario 4: legacy hashes are upgraded on a successful check
+        boxer = models.User(username=u'boxer_legacy')
+        boxer.pw_hash = generate_password_hash(u'iwillworkharder', method='sha1')
+        self.assertFalse(boxer.password_is(u'napoleonisalwaysright'))
+        self.assertTrue(boxer.pw_hash.startswith('sha1$'))
+        self.assertTrue(boxer.password_is(u'iwillworkharder'))
+        self.assertTrue(boxer.pw_hash.startswith('$2'))
+        self.assertTrue(boxer.password_is(u'iwillworkharder'))
+        # scenario 5: a correct password is accepted even if there's no time to upgrade its hash
+        clover = models.User(username=u'clover_legacy')
+        clover.pw_hash = generate_password_hash(u'fourlegsgood', method='sha1')
+        timeout, password_hasher.timeout = password_hasher.timeout, 0
+        slots = [u'held%d' % counter for counter in range(password_hasher.concurrency)]
+        try:
+            for slot in slots:
+                self.assertTrue(password_hasher._acquire(slot))
+            self.assertTrue(clover.password_is(u'fourlegsgood'))
+            self.assertTrue(clover.pw_hash.startswith('sha1$'))
+        finally:
+            for slot in slots:
+                password_hasher._release(slot)
+            password_hasher.timeout = timeout
 
     def test_user_is_active(self):
         """
@@ -436,6 +535,66 @@ class TestUser(TestDatabaseFixture):
         self.assertIsInstance(lookup_by_userid_merged, list)
         self.assertEqual(lookup_by_userid_merged[0].username, jykll.username)
 
+    def test_User_all_query_count(self):
+        """
+        Test that User.all takes the same number of queries however many users it finds
+        """
+        def count_queries(userids):
+            db.session.expire_all()
+            with QueryCounter() as counter:
+                for user in models.User.all(userids=userids):
+                    [(o.userid, o.uuid) for o in user.oldids]
+            return counter.count
+
+        napoleon = models.User(username=u'napoleon')
+        squealer = models.User(username=u'squealer')
+        db.session.add_all([napoleon, squealer])
+        db.session.commit()
+        models.merge_users(napoleon, squealer)
+        db.session.commit()
+        baseline = count_queries([napoleon.userid, squealer.userid])
+
+        userids = [napoleon.userid, squealer.userid]
+        # These users stay in the database shared by this class, so their names
+        # must not match the queries in test_User_autocomplete
+        for counter in range(10):
+            sheep = models.User(username=u'sheep%d' % counter)
+            lamb = models.User(username=u'lamb%d' % counter)
+            db.session.add_all([sheep, lamb])
+            db.session.commit()
+            models.merge_users(sheep, lamb)
+            db.session.commit()
+            userids.extend([sheep.userid, lamb.userid])
+        self.assertEqual(count_queries(userids), baseline)
+
+    def test_user_add_email_teams_query_count(self):
+        """
+        Test that adding an email address joins all teams with its domain, with
+        the same number of queries however many teams there are
+        """
+        def add_email(username, email):
+            user = models.User(username=username)
+            db.session.add(user)
+            db.session.commit()
+            with QueryCounter() as counter:
+                user.add_email(email)
+            db.session.commit()
+            return user, counter.count
+
+        amity = models.Organization(name=u'amity', title=u'Amity')
+        teams = [models.Team(title=u'Orchard', org=amity, domain=u'amity.org')]
+        db.session.add_all([amity] + teams)
+        db.session.commit()
+        peach, baseline = add_email(u'peach', u'peach@amity.org')
+        self.assertItemsEqual(peach.teams, teams)
+
+        teams.extend(models.Team(title=u'Orchard %d' % counter, org=amity, domain=u'amity.org') for counter in range(5))
+        db.session.add_all(teams)
+        db.session.commit()
+        johanna, count = add_email(u'johanna', u'johanna@amity.org')
+        self.assertItemsEqual(johanna.teams, teams)
+        self.assertEqual(count, baseline)
+
     def test_user_add_email(self):
         """
         Test to add email address for a user
@@ -1,6 +1,6 @@
 from lastuserapp import db
 import lastuser_core.models as models
-from .test_db import TestDatabaseFixture
+from .test_db import TestDatabaseFixture, QueryCounter
 from hashlib import md5
 from os import environ
 
@@ -38,6 +38,45 @@ class TestModels(TestDatabaseFixture):
         self.assertEqual(tyrion.status, 0)
         self.assertEqual(subramanian.status, 2)
 
+    def test_merge_users_conflicts(self):
+        """
+        Test that merging moves rows in bulk and resolves rows both users have
+        """
+        client = self.fixtures.client
+        dachshunds = self.fixtures.dachshunds
+        arya = models.User(username=u'arya', fullname=u'Arya Stark')
+        db.session.add(arya)
+        db.session.commit()
+        nymeria = models.User(username=u'nymeria', fullname=u'Nymeria')
+        db.session.add(nymeria)
+        dachshunds.users.extend([arya, nymeria])
+        db.session.add_all([
+            models.AuthToken(client=client, user=arya, scope=[u'id', u'email']),
+            models.AuthToken(client=client, user=nymeria, scope=[u'id', u'phone']),
+            models.UserEmailClaim(user=arya, email=u'arya@winterfell.co'),
+            models.UserEmailClaim(user=nymeria, email=u'arya@winterfell.co'),
+            models.UserEmailClaim(user=nymeria, email=u'nymeria@winterfell.co'),
+            ])
+        db.session.commit()
+
+        counts = models.merge_users(arya, nymeria, dry_run=True)
+        self.assertEqual(counts['authtoken'], 1)
+        self.assertEqual(counts['useremailclaim'], 2)
+        self.assertEqual(counts['team_membership'], 1)
+        self.assertEqual(nymeria.status, models.USER_STATUS.ACTIVE)
+
+        merged = models.merge_users(arya, nymeria)
+        self.assertEqual(merged, arya)
+        self.assertEqual(models.merge_users(arya, nymeria, dry_run=True), {})
+        token = models.AuthToken.query.filter_by(user=arya, client=client).one()
+        self.assertEqual(token.scope, (u'email', u'id', u'phone'))
+        self.assertEqual(sorted(claim.email for claim in models.UserEmailClaim.query.filter_by(user=arya)),
+            [u'arya@winterfell.co', u'nymeria@winterfell.co'])
+        self.assertEqual(dachshunds.users.filter_by(id=arya.id).count(), 1)
+        self.assertEqual(dachshunds.users.filter_by(id=nymeria.id).count(), 0)
+        self.assertIn(self.fixtures.batdog, arya.organizations())
+        self.assertNotIn(self.fixtures.batdog, nymeria.organizations())
+
     def test_getuser(self):
         """
         Test for retrieving username by prepending @
@@ -89,6 +128,29 @@ class TestModels(TestDatabaseFixture):
         result6 = models.getuser(u'cersei@thelannisters.co.uk')
         self.assertIsNone(result6)
 
+    def test_getusers(self):
+        """
+        Test that getusers resolves names like getuser, in order, with a fixed number of queries
+        """
+        tyrion = models.User(username=u'tyrion', fullname=u'Tyrion Lannister')
+        tyrion_email = models.UserEmail(email=u'tyrion@thelannisters.co.uk', user=tyrion)
+        sansa = models.User(username=u'sansa', fullname=u'Sansa Stark')
+        sansa_claim = models.UserEmailClaim(email=u'sansa@winterfell.co.uk', owner=sansa)
+        bran = models.User(username=u'bran', fullname=u'Bran Stark')
+        bran_extid = models.UserExternalId(service=u'twitter', user=bran, userid=u'bran', username=u'threeeyedraven', oauth_token=u'token', oauth_token_type=u'bearer')
+        db.session.add_all([tyrion, tyrion_email, sansa, sansa_claim, bran, bran_extid])
+        db.session.commit()
+
+        names = [u'sansa@winterfell.co.uk', u'nobody', u'@threeeyedraven', u'Tyrion@TheLannisters.co.uk', u'tyrion']
+        self.assertEqual(models.getusers(names), [sansa, None, bran, tyrion, tyrion])
+        self.assertEqual(models.getusers(names), [models.getuser(name) for name in names])
+
+        with QueryCounter() as few:
+            models.getusers(names)
+        with QueryCounter() as many:
+            models.getusers(names * 20 + [u'user%d' % counter for counter in range(100)])
+        self.assertEqual(few.count, many.count)
+
     def test_getextid(self):
         """
         Test for retrieving user given service and userid
@@ -1,4 +1,5 @@
 from lastuserapp import db
+import lastuser_core.models as models
 from lastuser_core import registry
 from .test_db import TestDatabaseFixture
 try:
@@ -12,3 +13,74 @@ class TestResourceRegistry(TestDatabaseFixture):
         """Test for verifying creation of ResourceRegistry instance"""
         result = registry.ResourceRegistry()
         self.assertIsInstance(result, OrderedDict)
+
+    def test_TokenRecord_get(self):
+        """Test that token records are cached and invalidated when the token changes"""
+        client = self.fixtures.client
+        crusoe = self.fixtures.crusoe
+        auth_token = models.AuthToken(client=client, user=crusoe, scope=[u'id', u'email'], validity=0)
+        db.session.add(auth_token)
+        db.session.commit()
+        token = auth_token.token
+
+        record = registry.TokenRecord.get(token)
+        self.assertEqual(record.user_id, crusoe.id)
+        self.assertEqual(record.client_id, client.id)
+        self.assertEqual(record.scope, frozenset([u'id', u'email']))
+        self.assertTrue(record.is_valid())
+        self.assertIs(registry.token_cache.get(token), record)
+
+        # Changing scope drops the cached record
+        auth_token.add_scope(u'phone')
+        db.session.commit()
+        self.assertIsNone(registry.token_cache.get(token))
+        self.assertIn(u'phone', registry.TokenRecord.get(token).scope)
+
+        # Refreshing the token drops the record for the old token string
+        auth_token.refresh()
+        db.session.commit()
+        self.assertIsNone(registry.token_cache.get(token))
+        self.assertIsNone(registry.TokenRecord.get(token))
+
+        # Deleting the token drops the record for the new token string
+        token = auth_token.token
+        registry.TokenRecord.get(token)
+        db.session.delete(auth_token)
+        db.session.commit()
+        self.assertIsNone(registry.token_cache.get(token))
+
+    def test_ResourceToken(self):
+        """Test that a ResourceToken exposes the token's user and client"""
+        client = self.fixtures.client
+        oakley = self.fixtures.oakley
+        auth_token = models.AuthToken(client=client, user=oakley, scope=[u'id'], validity=0)
+        db.session.add(auth_token)
+        db.session.commit()
+        resource_token = registry.ResourceToken(registry.TokenRecord.get(auth_token.token))
+        self.assertEqual(resource_token.user, oakley)
+        self.assertEqual(resource_token.client, client)
+        self.assertEqual(resource_token.scope, (u'id',))
+
+    def test_TokenRecord_merged(self):
+        """Test that merging users drops cached records for both users' tokens"""
+        client = self.fixtures.client
+        snowball = models.User(username=u'snowball')
+        db.session.add(snowball)
+        db.session.commit()
+        boxer = models.User(username=u'boxer_merged')  # Newer, so merged into snowball
+        db.session.add(boxer)
+        db.session.commit()
+        kept = models.AuthToken(client=client, user=snowball, scope=[u'id'], validity=0)
+        merged = models.AuthToken(client=client, user=boxer, scope=[u'email'], validity=0)
+        db.session.add_all([kept, merged])
+        db.session.commit()
+        kept_token, merged_token = kept.token, merged.token
+        self.assertEqual(registry.TokenRecord.get(kept_token).scope, frozenset([u'id']))
+        self.assertEqual(registry.TokenRecord.get(merged_token).user_id, boxer.id)
+
+        models.merge_users(snowball, boxer)
+        self.assertIsNone(registry.token_cache.get(kept_token))
+        self.assertIsNone(registry.token_cache.get(merged_token))
+        # Tokens for the same client are merged into the kept user's token
+        self.assertEqual(registry.TokenRecord.get(kept_token).scope, frozenset([u'id', u'email']))
+        self.assertIsNone(registry.TokenRecord.get(merged_token))
@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+
+from lastuserapp import db
+import lastuser_core.models as models
+from lastuser_core.search import AutocompleteCache
+from .test_db import TestDatabaseFixture
+
+
+class TestAutocompleteCache(TestDatabaseFixture):
+
+    def test_autocomplete(self):
+        """Test exact and prefix hits, and invalidation when users change"""
+        minimus = models.User(username=u'minimus', fullname=u'Minimus Poet')
+        mrsjones = models.User(username=u'mrsjones', fullname=u'Mrs Jones')
+        db.session.add_all([minimus, mrsjones])
+        db.session.commit()
+
+        cache = AutocompleteCache(limit=10)
+        with self.app.app_context():
+            self.assertEqual([m.userid for m in cache.autocomplete(u'm')], [minimus.userid, mrsjones.userid])
+            self.assertEqual((cache.hits, cache.prefix_hits, cache.misses), (0, 0, 1))
+            self.assertEqual(cache.autocomplete(u'[m]'), cache.autocomplete(u'm'))
+            self.assertEqual((cache.hits, cache.prefix_hits, cache.misses), (2, 0, 1))
+
+            # Answered by filtering the cached result for 'm'
+            result = cache.autocomplete(u'Mi')
+            self.assertEqual([m.userid for m in result], [minimus.userid])
+            self.assertEqual(result[0].pickername, minimus.pickername)
+            self.assertEqual((cache.hits, cache.prefix_hits, cache.misses), (2, 1, 1))
+            self.assertEqual(cache.hit_rate, 0.75)
+
+            # Email lookups can't be answered from a username/fullname prefix
+            cache.autocomplete(u'mi@')
+            self.assertEqual(cache.misses, 2)
+
+            # The shared cache is cleared when a user changes
+            from lastuser_core.search import autocomplete_cache
+            autocomplete_cache.results.set(u'mi', [])
+            minimus.fullname = u'Minimus the Poet'
+            db.session.commit()
+            self.assertEqual(len(autocomplete_cache.results), 0)
@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+
+from lastuserapp import db
+import lastuser_core.models as models
+from lastuser_core.search import MemoryUserSearch, normalize_query
+from .test_db import TestDatabaseFixture
+
+
+class TestMemoryUserSearch(TestDatabaseFixture):
+
+    def test_search(self):
+        """Test ranking, de-duplication and limits in the in-memory search backend"""
+        clover = models.User(username=u'clover', fullname=u'Clover Mare')
+        mollie = models.User(username=u'mollie', fullname=u'Mollie Clover')
+        muriel = models.User(username=u'muriel', fullname=u'Muriel Goat')
+        clover_email = models.UserEmail(email=u'clover@animalfarm.co.uk', user=clover)
+        db.session.add_all([clover, mollie, muriel, clover_email])
+        db.session.commit()
+
+        search = MemoryUserSearch()
+        # Username and fullname prefixes rank above words in the fullname, each user appears once
+        self.assertEqual(search.search(u'clover'), [clover, mollie])
+        self.assertEqual(search.search(u'clover', limit=1), [clover])
+        self.assertEqual(search.search(u'Clover@Animal'), [clover])
+        # Email addresses only match queries containing '@'
+        self.assertEqual(search.search(u'clover@'), [clover])
+        self.assertEqual(search.search(u'animalfarm'), [])
+        self.assertEqual(search.search(u'mu'), [muriel])
+        self.assertEqual(search.search(muriel.userid), [muriel])
+        self.assertEqual(search.search(u'boxer'), [])
+
+        # The index is rebuilt after invalidation
+        benjamin = models.User(username=u'benjamin', fullname=u'Benjamin Donkey')
+        db.session.add(benjamin)
+        db.session.commit()
+        self.assertEqual(search.search(u'benj'), [])
+        search.invalidate()
+        self.assertEqual(search.search(u'benj'), [benjamin])
+
+    def test_normalize_query(self):
+        """Test that queries lose brackets and whitespace but keep their case"""
+        self.assertEqual(normalize_query(u' [Oa] '), u'Oa')
@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+
+from lastuserapp import db
+import lastuser_core.models as models
+from lastuser_core.search import SQLUserSearch
+from .test_db import TestDatabaseFixture
+
+
+class TestSQLUserSearch(TestDatabaseFixture):
+
+    def test_search(self):
+        """Test ranking, de-duplication and limits in the PostgreSQL search backend"""
+        pincher = models.User(username=u'pincher', fullname=u'Pincher Hen')
+        minimus = models.User(username=u'minimus', fullname=u'Minimus Pincher')
+        moses = models.User(username=u'moses', fullname=u'Moses Raven')
+        pincher_email = models.UserEmail(email=u'pincher@animalfarm.co.uk', user=pincher)
+        db.session.add_all([pincher, minimus, moses, pincher_email])
+        db.session.commit()
+
+        search = SQLUserSearch()
+        # Username and fullname prefixes rank above words in the fullname, each user appears once
+        self.assertEqual(search.search(u'pincher'), [pincher, minimus])
+        self.assertEqual(search.search(u'pincher', limit=1), [pincher])
+        self.assertEqual(search.search(u'mo'), [moses])
+        self.assertEqual(search.search(moses.userid), [moses])
+        self.assertEqual(search.search(u'snowball'), [])
+        # Wildcards in the query are matched literally
+        self.assertEqual(search.search(u'%cher'), [])
+        self.assertEqual(search.search(u'_oses'), [])
+
+        # Email addresses only match queries containing '@'
+        self.assertEqual(search.search(u'Pincher@Animal'), [pincher])
+        self.assertEqual(search.search(u'animalfarm'), [])
+
+        # Changes are seen at once, with no index to invalidate
+        moses.status = models.USER_STATUS.SUSPENDED
+        db.session.commit()
+        self.assertEqual(search.search(u'mo'), [])
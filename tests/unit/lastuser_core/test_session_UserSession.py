@@ -1,7 +1,13 @@
 # -*- coding: utf-8 -*-
 
+import os
+import imp
+from sqlalchemy.exc import IntegrityError
+from alembic.migration import MigrationContext
+from alembic.operations import Operations
 from lastuserapp import db
 import lastuser_core.models as models
+from lastuser_core.models.session import session_client
 from .test_db import TestDatabaseFixture
 from coaster.utils import buid
 from datetime import datetime
@@ -64,3 +70,109 @@ class TestUser(TestDatabaseFixture):
         result = models.UserSession.authenticate(chandler_buid)
         self.assertIsInstance(result, models.UserSession)
         self.assertEqual(result, chandler_session)
+
+    def test_UserSession_access_client(self):
+        """Test that repeated client access records the client once"""
+        crusoe = self.fixtures.crusoe
+        client = self.fixtures.client
+        crusoe_session = models.UserSession(user=crusoe, ipaddr='192.168.1.5', buid=buid(), user_agent=u'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_11_3) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/49.0.2623.110 Safari/537.36', accessed_at=datetime.utcnow())
+        db.session.add(crusoe_session)
+        db.session.commit()
+        crusoe_session.access(client=client)
+        crusoe_session.access(client=client)
+        db.session.commit()
+        self.assertEqual(crusoe_session.clients.all(), [client])
+        self.assertEqual(client.sessions.filter_by(id=crusoe_session.id).count(), 1)
+
+    def test_update_client_user_activity(self):
+        """Test that client activity is rolled up once per user and client"""
+        from lastuser_core.models.session import client_user_activity, update_client_user_activity
+        client = self.fixtures.client
+        sessions = [models.UserSession(user=user, ipaddr='192.168.1.6', buid=buid(), user_agent=u'Mozilla/5.0', accessed_at=datetime.utcnow())
+            for user in (self.fixtures.crusoe, self.fixtures.crusoe, self.fixtures.oakley)]
+        db.session.add_all(sessions)
+        db.session.commit()
+        for user_session in sessions[:2]:
+            user_session.access(client=client)
+        db.session.commit()
+        self.assertEqual(update_client_user_activity(), 1)
+        sessions[2].access(client=client)
+        db.session.commit()
+        update_client_user_activity()
+        update_client_user_activity()
+        db.session.commit()
+        rows = db.session.query(client_user_activity.c.user_id).filter(client_user_activity.c.client_id == client.id).all()
+        self.assertItemsEqual([user_id for (user_id,) in rows], [self.fixtures.crusoe.id, self.fixtures.oakley.id])
+
+    def test_UserSession_access_client_created_at(self):
+        """Test that repeated client access keeps the first access time"""
+        crusoe = self.fixtures.crusoe
+        client = self.fixtures.client
+        crusoe_session = models.UserSession(user=crusoe, ipaddr='192.168.1.6', buid=buid(), user_agent=u'Mozilla/5.0', accessed_at=datetime.utcnow())
+        db.session.add(crusoe_session)
+        db.session.commit()
+        query = db.select([session_client.c.created_at, session_client.c.updated_at]).where(
+            session_client.c.user_session_id == crusoe_session.id)
+        crusoe_session.access(client=client)
+        db.session.commit()
+        created_at, updated_at = db.session.execute(query).first()
+        crusoe_session.access(client=client)
+        db.session.commit()
+        row = db.session.execute(query).first()
+        self.assertEqual(row.created_at, created_at)
+        self.assertGreaterEqual(row.updated_at, updated_at)
+
+    def partitioned(self):
+        return db.session.execute(db.text(
+            "SELECT count(*) FROM pg_partitioned_table WHERE partrelid = to_regclass('user_session')")).scalar() > 0
+
+    def test_UserSession_buid_unique(self):
+        """Test that buid is unique in the partitioned table"""
+        self.assertTrue(self.partitioned())
+        crusoe = self.fixtures.crusoe
+        usersession = models.UserSession(user=crusoe, ipaddr='192.168.1.1', user_agent=u'Mozilla/5.0',
+            accessed_at=datetime.utcnow())
+        db.session.add(usersession)
+        db.session.commit()
+        db.session.add(models.UserSession(user=crusoe, buid=usersession.buid, ipaddr='192.168.1.1',
+            user_agent=u'Mozilla/5.0', accessed_at=datetime.utcnow()))
+        self.assertRaises(IntegrityError, db.session.commit)
+        db.session.rollback()
+        self.assertEqual(models.UserSession.get(usersession.buid), usersession)
+
+    def test_session_partitions_migration(self):
+        """Test that the session_partitions migration keeps rows, references and unique buids both ways"""
+        migration = imp.load_source('session_partitions', os.path.join(os.path.dirname(__file__),
+            '..', '..', '..', 'migrations', 'versions', '8f5d1c3a7b92_session_partitions.py'))
+        crusoe, client = self.fixtures.crusoe, self.fixtures.client
+        usersession = models.UserSession(user=crusoe, ipaddr='192.168.1.1', user_agent=u'Mozilla/5.0',
+            accessed_at=datetime.utcnow())
+        db.session.add(usersession)
+        db.session.commit()
+        usersession.access(client=client)
+        authtoken = models.AuthToken(user_session=usersession, client=client, scope=[u'id'])
+        db.session.add(authtoken)
+        db.session.commit()
+        counts = (models.UserSession.query.count(), db.session.query(session_client).count())
+
+        def migrate(step):
+            with Operations.context(MigrationContext.configure(db.session.connection())):
+                step()
+            db.session.commit()
+
+        for step, partitioned in ((migration.downgrade, False), (migration.upgrade, True)):
+            migrate(step)
+            self.assertEqual(self.partitioned(), partitioned)
+            self.assertEqual((models.UserSession.query.count(), db.session.query(session_client).count()), counts)
+            self.assertEqual(models.AuthToken.query.get(authtoken.id).user_session, usersession)
+            # Tokens must refer to a session, and buids are unique
+            self.assertRaises(IntegrityError, db.session.execute, models.AuthToken.__table__.update().where(
+                models.AuthToken.id == authtoken.id).values(user_session_id=0))
+            db.session.rollback()
+            db.session.add(models.UserSession(user=crusoe, buid=usersession.buid, ipaddr='192.168.1.1',
+                user_agent=u'Mozilla/5.0', accessed_at=datetime.utcnow()))
+            self.assertRaises(IntegrityError, db.session.commit)
+            db.session.rollback()
+        self.assertEqual(db.session.execute(db.text(
+            "SELECT user_session_id FROM user_session_buid WHERE buid = :buid"), {'buid': usersession.buid}).scalar(),
+            usersession.id)
@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+
+import unittest
+from lastuser_core.sketch import HyperLogLog
+
+
+class TestHyperLogLog(unittest.TestCase):
+    # Three standard errors at the default precision of 12: 3 * 1.04 / 64
+    tolerance = 0.05
+
+    def test_count(self):
+        """Test that estimates are within the documented error of exact counts"""
+        for count in (10, 1000, 10000, 100000):
+            sketch = HyperLogLog()
+            for i in range(count):
+                sketch.add(u'user%d' % i)
+                sketch.add(u'user%d' % (i // 2))  # Repeats must not be counted
+            self.assertLessEqual(abs(sketch.count() - count), count * self.tolerance)
+        # Small counts use linear counting, which is nearly exact
+        sketch = HyperLogLog()
+        for i in range(100):
+            sketch.add(u'user%d' % i)
+        self.assertLessEqual(abs(sketch.count() - 100), 1)
+        self.assertEqual(HyperLogLog().count(), 0)
+
+    def test_update(self):
+        """Test that merged sketches count the union of values"""
+        # Thirty days of users, each active on a week's worth of days
+        days = [HyperLogLog() for day in range(30)]
+        exact = set()
+        for user in range(20000):
+            for day in range(user % 30, min(user % 30 + 7, 30)):
+                days[day].add(str(user))
+                exact.add(user)
+        merged = HyperLogLog()
+        for sketch in days:
+            merged.update(sketch)
+        self.assertLessEqual(abs(merged.count() - len(exact)), len(exact) * self.tolerance)
+        with self.assertRaises(ValueError):
+            merged.update(HyperLogLog(precision=10))
+
+    def test_to_bytes(self):
+        """Test that sketches survive serialization"""
+        sketch = HyperLogLog()
+        for i in range(5000):
+            sketch.add(str(i))
+        data = sketch.to_bytes()
+        self.assertEqual(len(data), 4096)
+        self.assertEqual(HyperLogLog(registers=data).count(), sketch.count())
+        with self.assertRaises(ValueError):
+            HyperLogLog(registers=data[:100])
@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+
+from datetime import datetime, timedelta
+from lastuserapp import db
+import lastuser_core.models as models
+from lastuser_core.tracking import AccessTracker
+from .test_db import TestDatabaseFixture
+
+
+class TestAccessTracker(TestDatabaseFixture):
+
+    def test_record_and_flush(self):
+        """Test that recorded accesses are only written on flush"""
+        client = self.fixtures.client
+        cred, secret = models.ClientCredential.new(client)
+        db.session.commit()
+        cred_id = cred.id
+        tracker = AccessTracker(models.ClientCredential.__table__, interval=3600)
+        now = datetime.utcnow()
+        tracker.record(cred_id, now)
+        self.assertEqual(tracker.pending(cred_id)['accessed_at'], now)
+        db.session.expire_all()
+        self.assertIsNone(models.ClientCredential.query.get(cred_id).accessed_at)
+
+        self.assertEqual(tracker.flush(), 1)
+        self.assertIsNone(tracker.pending(cred_id))
+        db.session.expire_all()
+        self.assertEqual(models.ClientCredential.query.get(cred_id).accessed_at, now)
+
+        # An older timestamp never replaces a newer one
+        tracker.record(cred_id, now - timedelta(hours=1))
+        tracker.flush()
+        db.session.expire_all()
+        self.assertEqual(models.ClientCredential.query.get(cred_id).accessed_at, now)
+
+    def test_is_fresh(self):
+        """Test that recent timestamps don't need to be recorded again"""
+        tracker = AccessTracker(models.ClientCredential.__table__, precision=60)
+        now = datetime.utcnow()
+        self.assertFalse(tracker.is_fresh(None))
+        self.assertTrue(tracker.is_fresh(now - timedelta(seconds=30), now))
+        self.assertFalse(tracker.is_fresh(now - timedelta(seconds=90), now))
+
+    def test_flush_if_due(self):
+        """Test that pending records are flushed without a further record once the interval passes"""
+        client = self.fixtures.client
+        cred, secret = models.ClientCredential.new(client)
+        db.session.commit()
+        cred_id = cred.id
+        tracker = AccessTracker(models.ClientCredential.__table__, interval=3600)
+        now = datetime.utcnow()
+        tracker.record(cred_id, now)
+        self.assertEqual(tracker.flush_if_due(), 0)
+        self.assertIsNotNone(tracker.pending(cred_id))
+
+        tracker.interval = 0
+        self.assertEqual(tracker.flush_if_due(), 1)
+        db.session.expire_all()
+        self.assertEqual(models.ClientCredential.query.get(cred_id).accessed_at, now)
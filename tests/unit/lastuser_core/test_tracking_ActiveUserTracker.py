@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+
+from datetime import datetime, timedelta
+from lastuserapp import db
+import lastuser_core.models as models
+from lastuser_core.tracking import ActiveUserTracker
+from .test_db import TestDatabaseFixture
+
+
+class TestActiveUserTracker(TestDatabaseFixture):
+
+    def test_record_and_flush(self):
+        """Test that active users are counted site-wide and per client, merged across days"""
+        client = self.fixtures.client
+        today = datetime.utcnow().date()
+        yesterday = today - timedelta(days=1)
+        tracker = ActiveUserTracker(interval=3600)
+        for i in range(300):
+            tracker.record(u'user%d' % i, day=today)
+        for i in range(200, 400):
+            tracker.record(u'user%d' % i, client.id, day=yesterday)
+        self.assertEqual(models.ActiveUserSketch.active_users(1), 0)
+        self.assertEqual(tracker.flush(), 3)
+
+        # A second flush for the same day merges into the existing row
+        tracker.record(u'user0', day=today)
+        tracker.record(u'user1000', day=today)
+        tracker.flush()
+        self.assertEqual(models.ActiveUserSketch.query.filter_by(day=today).count(), 1)
+
+        # Small counts are estimated by linear counting, within about 1%
+        self.assertAlmostEqual(models.ActiveUserSketch.active_users(1, today=today), 301, delta=5)
+        self.assertAlmostEqual(models.ActiveUserSketch.active_users(7, today=today), 401, delta=5)
+        self.assertAlmostEqual(models.ActiveUserSketch.active_users(7, client=client, today=today), 200, delta=5)
+        self.assertEqual(models.ActiveUserSketch.active_users(1, client=client, today=today), 0)
+        self.assertAlmostEqual(models.ActiveUserSketch.active_users(1, today=yesterday), 200, delta=5)
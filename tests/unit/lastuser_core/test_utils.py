@@ -1,6 +1,8 @@
 # -*- coding: utf-8 -*-
 
 import unittest
+import multiprocessing
+from redis import StrictRedis
 from lastuser_core.utils import *
 
 
@@ -46,3 +48,96 @@ class FlaskrTestCase(unittest.TestCase):
         result = make_redirect_url('http://example.com/?foo=bar', use_fragment=True, foo='baz')
         expected_result = 'http://example.com/?foo=bar#foo=baz'
         self.assertEqual(result, expected_result)
+
+
+class TestTTLCache(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 1000.0
+        self.cache = TTLCache(maxsize=2, ttl=10, timer=lambda: self.now)
+
+    def test_get_set(self):
+        """Test that stored values are returned until they expire"""
+        self.cache.set('a', 1)
+        self.assertEqual(self.cache.get('a'), 1)
+        self.assertTrue('a' in self.cache)
+        self.now += 11
+        self.assertIsNone(self.cache.get('a'))
+        self.assertFalse('a' in self.cache)
+
+    def test_lru_eviction(self):
+        """Test that the least recently used entry is evicted when the cache is full"""
+        self.cache.set('a', 1)
+        self.cache.set('b', 2)
+        self.cache.get('a')
+        self.cache.set('c', 3)
+        self.assertEqual(len(self.cache), 2)
+        self.assertIsNone(self.cache.get('b'))
+        self.assertEqual(self.cache.get('a'), 1)
+        self.assertEqual(self.cache.get('c'), 3)
+
+    def test_pop_and_counters(self):
+        """Test invalidation and the hit rate counters"""
+        self.cache.set('a', 1)
+        self.assertEqual(self.cache.pop('a'), 1)
+        self.assertIsNone(self.cache.pop('a'))
+        self.assertIsNone(self.cache.get('a'))
+        self.cache.set('a', 1)
+        self.cache.get('a')
+        self.assertEqual(self.cache.hits, 1)
+        self.assertEqual(self.cache.misses, 1)
+        self.assertEqual(self.cache.hit_rate, 0.5)
+
+
+class TestPasswordHasher(unittest.TestCase):
+
+    def test_hash_verify(self):
+        hasher = PasswordHasher(rounds=4, concurrency=1)
+        pw_hash = hasher.hash(u'animalism')
+        self.assertTrue(hasher.verify(u'animalism', pw_hash))
+        self.assertFalse(hasher.verify(u'four legs good', pw_hash))
+
+    def test_needs_rehash(self):
+        hasher = PasswordHasher(rounds=4, concurrency=1)
+        self.assertFalse(hasher.needs_rehash(hasher.hash(u'animalism')))
+        self.assertTrue(PasswordHasher(rounds=5).needs_rehash(hasher.hash(u'animalism')))
+        self.assertTrue(hasher.needs_rehash('sha1$salt$0123456789abcdef'))
+
+    def test_busy(self):
+        # Hashers in different processes share slots through Redis
+        redis = StrictRedis()
+        redis.delete('lastuser/test_bcrypt_slots')
+        hasher = PasswordHasher(rounds=4, concurrency=1, timeout=0, redis=redis, key='lastuser/test_bcrypt_slots')
+        other = PasswordHasher(rounds=4, concurrency=1, timeout=0, redis=redis, key='lastuser/test_bcrypt_slots')
+        self.assertTrue(other._acquire(u'held'))
+        self.assertRaises(PasswordHasherBusy, hasher.hash, u'animalism')
+        other._release(u'held')
+        pw_hash = hasher.hash(u'animalism')
+        self.assertTrue(hasher.verify(u'animalism', pw_hash))
+
+        # A slot held past its lease is reclaimed
+        self.assertTrue(other._acquire(u'held'))
+        hasher.lease = 0
+        self.assertTrue(hasher.verify(u'animalism', pw_hash))
+        redis.delete('lastuser/test_bcrypt_slots')
+
+    def test_busy_without_redis(self):
+        hasher = PasswordHasher(rounds=4, concurrency=1, timeout=0)
+        self.assertTrue(hasher._acquire(u'held'))
+        self.assertRaises(PasswordHasherBusy, hasher.hash, u'animalism')
+        hasher._release(u'held')
+        self.assertTrue(hasher.hash(u'animalism'))
+
+    def test_redis_down(self):
+        # While Redis can't be reached, each process has its own slots
+        redis = StrictRedis(port=1, socket_connect_timeout=0.1)
+        hasher = PasswordHasher(rounds=4, concurrency=1, timeout=0, redis=redis, key='lastuser/test_bcrypt_slots')
+        pw_hash = hasher.hash(u'animalism')
+        self.assertTrue(hasher.verify(u'animalism', pw_hash))
+        self.assertTrue(hasher._acquire(u'held'))
+        self.assertRaises(PasswordHasherBusy, hasher.hash, u'animalism')
+        hasher._release(u'held')
+        self.assertTrue(hasher.verify(u'animalism', pw_hash))
+
+    def test_default_concurrency(self):
+        self.assertEqual(PasswordHasher().concurrency, multiprocessing.cpu_count())
@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+
+from datetime import datetime, timedelta
+from lastuserapp import app, db
+import lastuser_core.models as models
+from lastuser_oauth.views.helpers import session_access, track_session_access
+from ..lastuser_core.test_db import TestDatabaseFixture
+
+
+class TestTrackSessionAccess(TestDatabaseFixture):
+    def setUp(self):
+        super(TestTrackSessionAccess, self).setUp()
+        session_access.flush()
+        self.interval = session_access.interval
+        session_access.interval = 3600  # Flush only when asked to
+
+    def tearDown(self):
+        session_access.interval = self.interval
+        super(TestTrackSessionAccess, self).tearDown()
+
+    def make_session(self, accessed_at):
+        usersession = models.UserSession(user=self.fixtures.crusoe, ipaddr=u'192.168.1.1',
+            user_agent=u'Browser/1.0', accessed_at=accessed_at)
+        db.session.add(usersession)
+        db.session.commit()
+        return usersession
+
+    def track(self, usersession, ipaddr=u'192.168.1.1', user_agent=u'Browser/1.0'):
+        with app.test_request_context(environ_base={'REMOTE_ADDR': ipaddr}, headers={'User-Agent': user_agent}):
+            track_session_access(usersession)
+        return session_access.pending(usersession.id)
+
+    def test_recent_access_is_throttled(self):
+        """A recent access from the same IP address and User-Agent isn't recorded again"""
+        usersession = self.make_session(datetime.utcnow() - timedelta(seconds=30))
+        self.assertIsNone(self.track(usersession))
+
+        usersession = self.make_session(datetime.utcnow() - timedelta(hours=1))
+        pending = self.track(usersession)
+        self.assertIsNotNone(pending)
+        # Now pending, so the next access is throttled against it
+        self.assertIs(self.track(usersession), pending)
+
+    def test_changed_client_is_recorded(self):
+        """A recent access from a different IP address or User-Agent is recorded and written"""
+        accessed_at = datetime.utcnow() - timedelta(seconds=30)
+        usersession = self.make_session(accessed_at)
+        pending = self.track(usersession, ipaddr=u'10.0.0.1')
+        self.assertEqual(pending['ipaddr'], u'10.0.0.1')
+        pending = self.track(usersession, ipaddr=u'10.0.0.1', user_agent=u'Browser/2.0')
+        self.assertEqual(pending['user_agent'], u'Browser/2.0')
+
+        session_access.flush()
+        db.session.expire_all()
+        self.assertEqual(usersession.ipaddr, u'10.0.0.1')
+        self.assertEqual(usersession.user_agent, u'Browser/2.0')
+        self.assertEqual(usersession.accessed_at, pending['accessed_at'])
+        self.assertEqual(usersession.updated_at, pending['accessed_at'])
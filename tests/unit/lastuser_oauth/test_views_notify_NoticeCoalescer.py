@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+
+from lastuserapp import db
+import lastuser_core.models as models
+from lastuser_oauth.views.notify import NoticeCoalescer, NoticeRelay, queue_notice
+from ..lastuser_core.test_db import TestDatabaseFixture
+
+
+class TestNoticeCoalescer(TestDatabaseFixture):
+    def setUp(self):
+        super(TestNoticeCoalescer, self).setUp()
+        crusoe = self.fixtures.crusoe
+        self.single = models.Client(title=u"Single", user=crusoe, website=u"http://example.com", confidential=True,
+            notification_uri=u'https://example.com/single')
+        self.multiple = models.Client(title=u"Multiple", user=crusoe, website=u"http://example.com", confidential=True,
+            notification_uri=u'https://example.com/multiple', notify_multiple_users=True)
+        db.session.add_all([self.single, self.multiple])
+        db.session.commit()
+
+    def tearDown(self):
+        models.ClientNotice.query.delete()
+        db.session.delete(self.single)
+        db.session.delete(self.multiple)
+        db.session.commit()
+        super(TestNoticeCoalescer, self).tearDown()
+
+    def test_repeated_changes(self):
+        """Repeated changes to the same subject make one notice, with each change once"""
+        coalescer = NoticeCoalescer()
+        batdog = self.fixtures.batdog
+        dachshunds = self.fixtures.dachshunds
+        coalescer.add(self.single, {'userid': u'u1', 'type': 'user', 'changes': ['profile']})
+        coalescer.add(self.single, {'userid': u'u1', 'type': 'user', 'changes': ['email', 'profile']})
+        coalescer.add(self.single, {'userid': u'u1', 'type': 'org', 'orgid': batdog.userid, 'teamid': None,
+            'changes': ['profile']})
+        coalescer.add(self.single, {'userid': u'u2', 'type': 'org', 'orgid': batdog.userid, 'teamid': None,
+            'changes': ['profile']})
+        coalescer.add(self.single, {'userid': u'u1', 'type': 'team', 'orgid': batdog.userid,
+            'teamid': dachshunds.userid, 'changes': ['team-membership']})
+        self.assertEqual(coalescer.notices(), [
+            {'url': self.single.notification_uri,
+                'data': {'userid': u'u1', 'type': 'user', 'changes': ['profile', 'email']}},
+            {'url': self.single.notification_uri,
+                'data': {'userid': u'u1', 'type': 'org', 'orgid': batdog.userid, 'teamid': None,
+                    'changes': ['profile']}},
+            {'url': self.single.notification_uri,
+                'data': {'userid': u'u1', 'type': 'team', 'orgid': batdog.userid, 'teamid': dachshunds.userid,
+                    'changes': ['team-membership']}},
+            ])
+
+    def test_logout_not_merged(self):
+        """Logout notices are about a session each, and are never merged"""
+        coalescer = NoticeCoalescer()
+        for client in (self.single, self.multiple):
+            coalescer.add(client, {'userid': u'u1', 'type': 'user', 'changes': ['logout'], 'sessionid': u's1'})
+            coalescer.add(client, {'userid': u'u1', 'type': 'user', 'changes': ['logout'], 'sessionid': u's2'})
+        self.assertEqual([notice['data']['sessionid'] for notice in coalescer.notices()], [u's1', u's2', u's1', u's2'])
+        self.assertEqual([notice['data']['userid'] for notice in coalescer.notices()], [u'u1'] * 4)
+
+    def test_multiple_users(self):
+        """Clients that accept notices for multiple users get one notice with all of them"""
+        coalescer = NoticeCoalescer()
+        for client in (self.single, self.multiple):
+            coalescer.add(client, {'userid': u'u1', 'type': 'user', 'changes': ['profile']})
+            coalescer.add(client, {'userid': u'u2', 'type': 'user', 'changes': ['email']})
+            coalescer.add(client, {'userid': u'u1', 'type': 'user', 'changes': ['phone']})
+        self.assertEqual(coalescer.notices(), [
+            {'url': self.single.notification_uri,
+                'data': {'userid': u'u1', 'type': 'user', 'changes': ['profile', 'phone']}},
+            {'url': self.single.notification_uri,
+                'data': {'userid': u'u2', 'type': 'user', 'changes': ['email']}},
+            {'url': self.multiple.notification_uri,
+                'data': {'userid': [u'u1', u'u2'], 'type': 'user', 'changes': ['profile', 'email', 'phone']}},
+            ])
+
+    def test_relay_per_client(self):
+        """The relay batches notices per client, and skips clients that no longer take notices"""
+        silent = models.Client(title=u"Silent", user=self.fixtures.crusoe, website=u"http://example.com",
+            confidential=True, notification_uri=u'https://example.com/silent')
+        db.session.add(silent)
+        db.session.commit()
+        for userid in (u'u1', u'u2', u'u3'):
+            for client in (self.single, self.multiple, silent):
+                queue_notice(client.id, {'userid': userid, 'type': 'user', 'changes': ['profile']})
+        silent.notification_uri = u''
+        db.session.commit()
+
+        batches = []
+        self.assertEqual(NoticeRelay(limit=1000).relay(send=batches.append), 9)
+        self.assertEqual(len(batches), 1)
+        urls = [notice['url'] for notice in batches[0]]
+        self.assertEqual(urls.count(self.single.notification_uri), 3)
+        self.assertEqual(urls.count(self.multiple.notification_uri), 1)
+        self.assertEqual(len(urls), 4)
+        multiple = [notice for notice in batches[0] if notice['url'] == self.multiple.notification_uri][0]
+        self.assertEqual(multiple['data']['userid'], [u'u1', u'u2', u'u3'])
+        db.session.delete(silent)
+        db.session.commit()
@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+
+import json
+from base64 import b64encode
+from lastuserapp import db
+import lastuser_core.models as models
+from lastuser_core.signals import user_data_changed
+from ..lastuser_core.test_db import TestDatabaseFixture
+
+
+class TestTokenVerify(TestDatabaseFixture):
+    def setUp(self):
+        super(TestTokenVerify, self).setUp()
+        self.client = self.fixtures.client
+        credential, secret = models.ClientCredential.new(self.client)
+        db.session.commit()
+        self.headers = {'Authorization': 'Basic ' + b64encode('%s:%s' % (credential.name, secret))}
+        self.scope = [u'id', self.client.namespace + u':test_resource']
+
+    def make_user(self, username):
+        user = models.User(username=username, fullname=username.title())
+        db.session.add(user)
+        db.session.commit()
+        return user
+
+    def make_token(self, user, **kwargs):
+        authtoken = models.AuthToken(user=user, client=self.client, scope=self.scope, **kwargs)
+        db.session.add(authtoken)
+        db.session.commit()
+        return authtoken
+
+    def verify(self, token):
+        response = self.fixtures.test_client.post('/api/1/token/verify', headers=self.headers,
+            data={'access_token': token, 'resource': u'test_resource'})
+        return response, json.loads(response.data)
+
+    def test_token_verify_cached(self):
+        """Results are cached for the token's remaining validity, and say so"""
+        user = self.make_user(u'cached')
+        authtoken = self.make_token(user, validity=60)
+        response, result = self.verify(authtoken.token)
+        self.assertEqual(result['status'], 'ok')
+        self.assertLessEqual(result['validity'], 60)
+        self.assertEqual(response.headers['Cache-Control'], 'private, max-age=%d' % result['validity'])
+
+        # Served from the cache: a change that doesn't expire the result isn't seen
+        db.session.execute(models.User.__table__.update().where(
+            models.User.id == user.id).values(fullname=u'Unseen'))
+        db.session.commit()
+        response, cached = self.verify(authtoken.token)
+        self.assertEqual(cached['userinfo']['fullname'], result['userinfo']['fullname'])
+        self.assertLessEqual(cached['validity'], result['validity'])
+        self.assertEqual(response.headers['Cache-Control'], 'private, max-age=%d' % cached['validity'])
+
+    def test_token_verify_revoked(self):
+        """A deleted token is no longer verified"""
+        authtoken = self.make_token(self.make_user(u'revoked'))
+        token = authtoken.token
+        self.assertEqual(self.verify(token)[1]['status'], 'ok')
+        db.session.delete(authtoken)
+        db.session.commit()
+        self.assertEqual(self.verify(token)[1], {'status': 'error', 'error': 'no_token'})
+
+    def test_token_verify_refreshed(self):
+        """A refreshed token replaces the old one, and a change in scope is seen at once"""
+        authtoken = self.make_token(self.make_user(u'refreshed'))
+        token = authtoken.token
+        self.assertEqual(self.verify(token)[1]['status'], 'ok')
+        authtoken.refresh()
+        db.session.commit()
+        self.assertEqual(self.verify(token)[1], {'status': 'error', 'error': 'no_token'})
+
+        token = authtoken.token
+        self.assertEqual(self.verify(token)[1]['status'], 'ok')
+        authtoken.scope = [u'id']
+        db.session.commit()
+        self.assertEqual(self.verify(token)[1], {'status': 'error', 'error': 'access_denied'})
+
+    def test_token_verify_merged(self):
+        """After a merge, the merged user's tokens identify the user they were merged into"""
+        keep_user = self.make_user(u'kept')
+        merge_user = self.make_user(u'merged')
+        authtoken = self.make_token(merge_user)
+        token = authtoken.token
+        self.assertEqual(self.verify(token)[1]['userinfo']['userid'], merge_user.userid)
+
+        merged_userid = merge_user.userid
+        models.merge_users(keep_user, merge_user)
+        userinfo = self.verify(token)[1]['userinfo']
+        self.assertEqual(userinfo['userid'], keep_user.userid)
+        self.assertIn(merged_userid, userinfo['oldids'])
+
+    def test_token_verify_permissions(self):
+        """A change in team permissions for the client is seen at once"""
+        user = self.make_user(u'permitted')
+        self.fixtures.dachshunds.users.append(user)
+        db.session.commit()
+        authtoken = self.make_token(user)
+        self.assertEqual(self.verify(authtoken.token)[1]['userinfo']['permissions'], [u'admin'])
+        self.fixtures.team_client_permission.access_permissions = u'admin view'
+        db.session.commit()
+        self.assertEqual(self.verify(authtoken.token)[1]['userinfo']['permissions'], [u'admin', u'view'])
+
+    def test_token_verify_many(self):
+        """Valid, invalid and unknown tokens get a result each, in order"""
+        authtoken = self.make_token(self.make_user(u'many'))
+        response = self.fixtures.test_client.post('/api/1/token/verify_many', headers=self.headers,
+            content_type='application/json', data=json.dumps({'tokens': [
+                {'access_token': authtoken.token, 'resource': u'test_resource'},
+                {'access_token': u'unknown', 'resource': u'test_resource'},
+                {'access_token': [authtoken.token], 'resource': u'test_resource'},
+                {'access_token': authtoken.token, 'resource': {'name': u'test_resource'}},
+                {'access_token': authtoken.token},
+                u'not-a-dict',
+                {'access_token': authtoken.token, 'resource': u'unknown_resource'},
+                ]}))
+        self.assertEqual(response.status_code, 200)
+        results = json.loads(response.data)['results']
+        self.assertEqual(results[0]['status'], 'ok')
+        self.assertEqual(results[0]['userinfo']['username'], u'many')
+        self.assertEqual(results[1:], [
+            {'status': 'error', 'error': 'no_token'},
+            {'status': 'error', 'error': 'invalid_request'},
+            {'status': 'error', 'error': 'invalid_request'},
+            {'status': 'error', 'error': 'no_resource'},
+            {'status': 'error', 'error': 'no_resource'},
+            {'status': 'error', 'error': 'access_denied'},
+            ])
+
+        # The second call is served from the cache, and agrees
+        response = self.fixtures.test_client.post('/api/1/token/verify_many', headers=self.headers,
+            content_type='application/json', data=json.dumps({'tokens': [
+                {'access_token': authtoken.token, 'resource': u'test_resource'}]}))
+        self.assertEqual(json.loads(response.data)['results'][0]['userinfo'], results[0]['userinfo'])
+
+    def test_token_verify_expired_on_commit(self):
+        """Results cached between a change being signalled and committed are expired by the commit"""
+        user = self.make_user(u'committed')
+        authtoken = self.make_token(user)
+        self.assertEqual(self.verify(authtoken.token)[1]['userinfo']['fullname'], u'Committed')
+
+        user_data_changed.send(user, changes=['profile'])
+        # A verify before the change is committed caches the old name again
+        self.assertEqual(self.verify(authtoken.token)[1]['userinfo']['fullname'], u'Committed')
+        db.session.execute(models.User.__table__.update().where(
+            models.User.id == user.id).values(fullname=u'Changed'))
+        db.session.commit()
+        self.assertEqual(self.verify(authtoken.token)[1]['userinfo']['fullname'], u'Changed')
+
+        # Nothing is left to expire after a rollback
+        user_data_changed.send(user, changes=['profile'])
+        db.session.rollback()
+        self.assertNotIn('token_cache_expiry', db.session.info)
+
+    def test_token_verify_expired_after_savepoint(self):
+        """A savepoint released or rolled back before the commit doesn't take the pending expiry with it"""
+        user = self.make_user(u'savepoint')
+        authtoken = self.make_token(user)
+        for fullname, end_savepoint in ((u'Released', db.session.commit), (u'Rolled Back', db.session.rollback)):
+            self.assertNotEqual(self.verify(authtoken.token)[1]['userinfo']['fullname'], fullname)
+            user_data_changed.send(user, changes=['profile'])
+            db.session.begin_nested()
+            end_savepoint()
+            self.assertIn('token_cache_expiry', db.session.info)
+            # A verify after the savepoint caches the old name again
+            self.assertNotEqual(self.verify(authtoken.token)[1]['userinfo']['fullname'], fullname)
+            db.session.execute(models.User.__table__.update().where(
+                models.User.id == user.id).values(fullname=fullname))
+            db.session.commit()
+            self.assertEqual(self.verify(authtoken.token)[1]['userinfo']['fullname'], fullname)
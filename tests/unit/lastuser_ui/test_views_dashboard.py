@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+
+from datetime import datetime, timedelta
+from flask import g
+from lastuserapp import app, db
+import lastuser_core.models as models
+from lastuser_core.models.session import client_user_activity
+from lastuser_ui.views.dashboard import dashboard_data_users_by_client
+from ..lastuser_core.test_db import TestDatabaseFixture
+
+
+class TestDashboard(TestDatabaseFixture):
+
+    def test_users_by_client(self):
+        """Each user is counted in the shortest period that includes their latest activity"""
+        client = self.fixtures.client
+        now = datetime.utcnow()
+        # A different number of users in each period: one in the last hour, two in the last day, and so on
+        periods = [timedelta(minutes=30), timedelta(hours=5), timedelta(days=3), timedelta(days=20),
+            timedelta(days=60), timedelta(days=120), timedelta(days=300)]
+        ages = [age for count, age in enumerate(periods, 1) for counter in range(count)] + [timedelta(days=400)]
+        users = [models.User(username=u'dashboard%d' % counter) for counter in range(len(ages) + 1)]
+        db.session.add_all(users)
+        db.session.commit()
+        users[-1].status = models.USER_STATUS.MERGED  # Not counted, though recently active
+        db.session.execute(client_user_activity.insert(), [
+            {'client_id': client.id, 'user_id': user.id, 'active_at': now - age}
+            for user, age in zip(users, ages + [timedelta(minutes=1)])])
+        db.session.commit()
+
+        app.config['DASHBOARD_USERS'] = [self.fixtures.crusoe.userid]
+        try:
+            with app.test_request_context():
+                g.user = self.fixtures.crusoe
+                body, status, headers = dashboard_data_users_by_client()
+        finally:
+            del app.config['DASHBOARD_USERS']
+        rows = [line.split(',') for line in body.strip().splitlines()]
+        self.assertEqual(rows[0], ['title', 'hour', 'day', 'week', 'month', 'quarter', 'halfyear', 'year'])
+        self.assertEqual(rows[1:], [[client.title, '1', '2', '3', '4', '5', '6', '7']])